@@ -0,0 +1,295 @@
+from PIL import Image, ImageChops
+from collections import namedtuple
+import io
+import struct
+import zlib
+
+# APNGエンコーダー
+# フレーム画像をzlib圧縮（PNGフィルタ込み）し、IHDR/acTL/fcTL/IDAT/fdAT チャンクを出力ストリームへ直接書き込む
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# PILモード -> (ビット深度, PNGカラータイプ)
+PNG_COLOR_TYPES = {
+    'L': (8, 0),
+    'RGB': (8, 2),
+    'P': (8, 3),
+    'LA': (8, 4),
+    'RGBA': (8, 6),
+}
+
+# fcTL の dispose_op / blend_op
+APNG_DISPOSE_OP_NONE = 0
+APNG_DISPOSE_OP_BACKGROUND = 1
+APNG_DISPOSE_OP_PREVIOUS = 2
+APNG_BLEND_OP_SOURCE = 0
+APNG_BLEND_OP_OVER = 1
+
+# PNGの行フィルタ種別
+PNG_FILTER_NONE = 0
+PNG_FILTER_SUB = 1
+PNG_FILTER_UP = 2
+
+# 圧縮プロファイル
+# fast: プレビュー・試行錯誤用（低い圧縮レベル）
+# balanced: 既定（zlib既定レベル・Pillowの適応フィルタ）
+# max: 入稿用。zlib戦略と行フィルタの組み合わせを総当たりして最小のものを採用する
+#   filters の 'adaptive' はPillowの行ごとの適応フィルタ（パレット画像ではフィルタなし）
+COMPRESSION_PROFILES = {
+    'fast': {
+        'compress_level': 1,
+        'strategies': (zlib.Z_DEFAULT_STRATEGY,),
+        'filters': ('adaptive',),
+    },
+    'balanced': {
+        'compress_level': 6,
+        'strategies': (zlib.Z_DEFAULT_STRATEGY,),
+        'filters': ('adaptive',),
+    },
+    'max': {
+        'compress_level': 9,
+        'strategies': (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED, zlib.Z_RLE),
+        'filters': ('adaptive', PNG_FILTER_NONE, PNG_FILTER_SUB, PNG_FILTER_UP),
+    },
+}
+DEFAULT_COMPRESSION_PROFILE = 'balanced'
+
+# 圧縮済みフレーム（同一内容のフレームは == で比較できる）
+# palette / transparency はパレットモード（P）の場合のみ使用
+EncodedFrame = namedtuple('EncodedFrame', ['size', 'mode', 'data', 'palette', 'transparency'])
+
+# フレーム画像を1回の圧縮パスで IDAT/fdAT 用のデータに変換
+# compress_level: zlib圧縮レベル（-1はzlib既定）、compress_type: zlib圧縮戦略（-1は既定）
+def compress_frame(img, compress_level=-1, optimize=False, compress_type=-1):
+    if img.mode not in PNG_COLOR_TYPES:
+        img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+    data = img.tobytes('zip', img.mode, int(optimize), compress_level, compress_type)
+    return make_encoded_frame(img, data)
+
+# 圧縮済みデータに画像のサイズ・モード・パレット情報を付けて EncodedFrame にする
+def make_encoded_frame(img, data):
+    palette = None
+    transparency = None
+    if img.mode == 'P':
+        palette = bytes(img.getpalette() or [])
+        transparency = img.info.get('transparency')
+    return EncodedFrame(img.size, img.mode, data, palette, transparency)
+
+def get_compression_profile(profile):
+    if profile not in COMPRESSION_PROFILES:
+        raise ValueError(f"不明な圧縮プロファイルです: {profile}（{', '.join(COMPRESSION_PROFILES)} から選択）")
+    return COMPRESSION_PROFILES[profile]
+
+# 全行に同じフィルタを掛けたPNG画像データ（フィルタ種別バイト＋行データ）を作成
+# Sub/Up はバイト単位の差分なので、1画素ずらした画像との subtract_modulo で求められる
+def filter_scanlines(img, filter_type):
+    plane = palette_index_plane(img) if img.mode == 'P' else img
+    width, height = plane.size
+    if filter_type == PNG_FILTER_SUB:
+        shifted = Image.new(plane.mode, plane.size, 0)
+        shifted.paste(plane.crop((0, 0, width - 1, height)), (1, 0))
+        plane = ImageChops.subtract_modulo(plane, shifted)
+    elif filter_type == PNG_FILTER_UP:
+        shifted = Image.new(plane.mode, plane.size, 0)
+        shifted.paste(plane.crop((0, 0, width, height - 1)), (0, 1))
+        plane = ImageChops.subtract_modulo(plane, shifted)
+    raw = memoryview(plane.tobytes())
+    stride = len(raw) // height
+    filter_byte = bytes([filter_type])
+    return b''.join(filter_byte + raw[y * stride:(y + 1) * stride] for y in range(height))
+
+# 圧縮プロファイルに従ってフレームを圧縮し、候補の中で最小のものを返す
+def compress_frame_with_profile(img, profile=DEFAULT_COMPRESSION_PROFILE):
+    settings = get_compression_profile(profile)
+    if img.mode not in PNG_COLOR_TYPES:
+        img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+    compress_level = settings['compress_level']
+    best = None
+    for filter_type in settings['filters']:
+        if filter_type == 'adaptive':
+            candidates = [compress_frame(img, compress_level, compress_type=strategy) for strategy in settings['strategies']]
+        else:
+            if img.mode == 'P' and filter_type == PNG_FILTER_NONE and 'adaptive' in settings['filters']:
+                # パレット画像の 'adaptive' はフィルタなしと同じ
+                continue
+            scanlines = filter_scanlines(img, filter_type)
+            candidates = []
+            for strategy in settings['strategies']:
+                compressor = zlib.compressobj(compress_level, zlib.DEFLATED, zlib.MAX_WBITS, 9, strategy)
+                candidates.append(make_encoded_frame(img, compressor.compress(scanlines) + compressor.flush()))
+        for candidate in candidates:
+            if best is None or len(candidate.data) < len(best.data):
+                best = candidate
+    return best
+
+# チャンクを書き込む（データは複数に分けて渡せるので連結用のコピーが不要）
+def write_chunk(fp, chunk_type, *parts):
+    crc = zlib.crc32(chunk_type)
+    for part in parts:
+        crc = zlib.crc32(part, crc)
+    fp.write(struct.pack('>I', sum(len(part) for part in parts)))
+    fp.write(chunk_type)
+    for part in parts:
+        fp.write(part)
+    fp.write(struct.pack('>I', crc & 0xffffffff))
+
+# 表示時間（ミリ秒）を fcTL の分子・分母に変換
+def delay_fraction(delay_ms):
+    delay_ms = max(0, int(round(delay_ms)))
+    if delay_ms <= 0xffff:
+        return delay_ms, 1000
+    return min(0xffff, int(round(delay_ms / 10))), 100
+
+def write_palette_chunks(fp, frame):
+    write_chunk(fp, b'PLTE', frame.palette)
+    transparency = frame.transparency
+    if transparency is None:
+        return
+    if isinstance(transparency, int):
+        write_chunk(fp, b'tRNS', b'\xff' * transparency + b'\x00')
+    else:
+        write_chunk(fp, b'tRNS', bytes(transparency))
+
+# 2フレーム間で1画素でも値が変わった位置を255とするマスク
+def changed_pixel_mask(previous, current):
+    diff_bands = ImageChops.difference(previous, current).split()
+    mask = diff_bands[0]
+    for band in diff_bands[1:]:
+        mask = ImageChops.lighter(mask, band)
+    return mask.point(lambda value: 255 if value else 0)
+
+# パレット画像のインデックス値をそのまま L 画像として取り出す
+def palette_index_plane(img):
+    return Image.frombytes('L', img.size, img.tobytes())
+
+# 複数フレームから共通パレットを作成（パレットモード出力用）
+# reserve_transparent=True の場合は差分フレームの透明色用に1色分を空けておく
+def build_palette(images, colors=256, reserve_transparent=False):
+    unique_images = list({id(img): img.convert('RGB') for img in images}.values())
+    width = max(img.width for img in unique_images)
+    height = sum(img.height for img in unique_images)
+    sample = Image.new('RGB', (width, height), 'white')
+    y = 0
+    for img in unique_images:
+        sample.paste(img, (0, y))
+        y += img.height
+    num_colors = max(2, min(256, colors) - (1 if reserve_transparent else 0))
+    return sample.quantize(colors=num_colors, method=Image.Quantize.MEDIANCUT)
+
+# 共通パレットで各フレームを減色する（同じ画像オブジェクトは1回だけ変換）
+# transparent_index を指定した場合はパレット末尾に透明色を追加する
+def quantize_frames(frames, palette_image, dither=True, transparent_index=None):
+    dither_mode = Image.Dither.FLOYDSTEINBERG if dither else Image.Dither.NONE
+    palette = palette_image.getpalette()
+    if transparent_index is not None:
+        palette = palette + [0, 0, 0]
+    quantized = {}
+    for frame in frames:
+        if id(frame) not in quantized:
+            indexed = frame.convert('RGB').quantize(palette=palette_image, dither=dither_mode)
+            indexed.putpalette(palette)
+            if transparent_index is not None:
+                indexed.info['transparency'] = transparent_index
+            quantized[id(frame)] = indexed
+    return [quantized[id(frame)] for frame in frames]
+
+# 差分フレーム化：2フレーム目以降は前フレームから変化した矩形だけを出力する
+# 矩形内で変化していない画素は透明にし、blend_op=OVER で前フレームの上に重ねる
+# （枠線や4隅アイコンのように離れた位置の変化でも、変化した画素以外はほぼ圧縮ゼロになる）
+# パレットモード（P）のフレームは info['transparency'] の透明インデックスで同様に処理する
+# 同じ組み合わせの差分（点滅の 点灯→消灯 など）は同じ画像オブジェクトを再利用する
+def build_delta_frames(frames):
+    if frames[0].mode == 'P':
+        first, build_delta = frames[0], build_palette_delta
+    else:
+        frames = to_rgba_frames(frames)
+        first, build_delta = frames[0], build_rgba_delta
+    delta_images = [first]
+    offsets = [(0, 0)]
+    blend_ops = [APNG_BLEND_OP_SOURCE]
+    delta_cache = {}
+    for previous, current in zip(frames, frames[1:]):
+        cache_key = (id(previous), id(current))
+        if cache_key not in delta_cache:
+            delta_cache[cache_key] = build_delta(previous, current)
+        delta, offset, blend_op = delta_cache[cache_key]
+        delta_images.append(delta)
+        offsets.append(offset)
+        blend_ops.append(blend_op)
+    options = {
+        'offsets': offsets,
+        'dispose_ops': [APNG_DISPOSE_OP_NONE] * len(frames),
+        'blend_ops': blend_ops,
+        'canvas_size': first.size,
+    }
+    return delta_images, options
+
+# 同じ画像オブジェクトは1回だけ RGBA に変換する
+def to_rgba_frames(frames):
+    converted = {}
+    for frame in frames:
+        if id(frame) not in converted:
+            converted[id(frame)] = frame if frame.mode == 'RGBA' else frame.convert('RGBA')
+    return [converted[id(frame)] for frame in frames]
+
+def build_rgba_delta(previous, current):
+    mask = changed_pixel_mask(previous, current)
+    bbox = mask.getbbox() or (0, 0, 1, 1)
+    region = current.crop(bbox)
+    if region.getextrema()[3][0] < 255:
+        # 半透明を含む矩形は OVER で重ねられないため矩形全体を置き換える
+        return region, bbox[:2], APNG_BLEND_OP_SOURCE
+    delta = Image.new('RGBA', region.size, (0, 0, 0, 0))
+    delta.paste(region, (0, 0), mask.crop(bbox))
+    return delta, bbox[:2], APNG_BLEND_OP_OVER
+
+def build_palette_delta(previous, current):
+    transparent_index = current.info['transparency']
+    mask = changed_pixel_mask(palette_index_plane(previous), palette_index_plane(current))
+    bbox = mask.getbbox() or (0, 0, 1, 1)
+    delta = Image.new('P', (bbox[2] - bbox[0], bbox[3] - bbox[1]), transparent_index)
+    delta.putpalette(current.getpalette())
+    delta.paste(current.crop(bbox), (0, 0), mask.crop(bbox))
+    delta.info['transparency'] = transparent_index
+    return delta, bbox[:2], APNG_BLEND_OP_OVER
+
+# APNGを出力ストリームに書き込む
+# frames: PIL画像または EncodedFrame のリスト
+# offsets: 各フレームの描画位置 (x, y)。省略時は全フレーム (0, 0)
+# canvas_size: 省略時は先頭フレームのサイズ
+def write_apng(fp, frames, delays, num_plays=0, offsets=None, dispose_ops=None, blend_ops=None, canvas_size=None, compress_level=-1):
+    frames = [frame if isinstance(frame, EncodedFrame) else compress_frame(frame, compress_level) for frame in frames]
+    if not frames:
+        raise ValueError("APNGには少なくとも1フレームが必要です")
+    first = frames[0]
+    width, height = canvas_size or first.size
+    bit_depth, color_type = PNG_COLOR_TYPES[first.mode]
+
+    fp.write(PNG_SIGNATURE)
+    write_chunk(fp, b'IHDR', struct.pack('>IIBBBBB', width, height, bit_depth, color_type, 0, 0, 0))
+    write_chunk(fp, b'acTL', struct.pack('>II', len(frames), num_plays))
+    if first.mode == 'P':
+        write_palette_chunks(fp, first)
+
+    sequence = 0
+    for frame_idx, frame in enumerate(frames):
+        x_offset, y_offset = offsets[frame_idx] if offsets else (0, 0)
+        dispose_op = dispose_ops[frame_idx] if dispose_ops else APNG_DISPOSE_OP_NONE
+        blend_op = blend_ops[frame_idx] if blend_ops else APNG_BLEND_OP_SOURCE
+        delay_num, delay_den = delay_fraction(delays[frame_idx])
+        write_chunk(fp, b'fcTL', struct.pack('>IIIIIHHBB', sequence, frame.size[0], frame.size[1],
+                                             x_offset, y_offset, delay_num, delay_den, dispose_op, blend_op))
+        sequence += 1
+        if frame_idx == 0:
+            write_chunk(fp, b'IDAT', frame.data)
+        else:
+            write_chunk(fp, b'fdAT', struct.pack('>I', sequence), frame.data)
+            sequence += 1
+
+    write_chunk(fp, b'IEND')
+
+# APNGをバイト列として生成
+def encode_apng(frames, delays, num_plays=0, **kwargs):
+    output = io.BytesIO()
+    write_apng(output, frames, delays, num_plays=num_plays, **kwargs)
+    return output.getvalue()
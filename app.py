@@ -1,11 +1,29 @@
 import streamlit as st
-from PIL import Image, ImageDraw, ImageFont
-from apng import APNG
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from PIL import Image, features
 import io
-import os
-import zipfile
 import base64
+import functools
+import hashlib
+import json
+import os
+import time
 from datetime import datetime
+from renderer import (
+    WIDTH, HEIGHT, MAX_IMAGE_SCALE, DEFAULT_MAX_WORKERS, DEFAULT_ENCODE_THREADS,
+    ICON_DIR, LRUCache, config_digest, get_font, get_font_registry, create_preview_image, load_icon_source, load_upload_image,
+)
+from apng_writer import DEFAULT_COMPRESSION_PROFILE
+from archive_writer import BatchArchive
+from batch_queue import BATCH_DONE, BATCH_CANCELLED, BATCH_QUEUED, get_batch_queue
+from render_cache import get_render_cache
+from session_memory import SpillableImage, get_session_memory
+from stage_timing import STAGE_LABELS, StageTimings, collect_stage_timings, merge_stage_timings, stage_timer
+from engine import (
+    DEFAULT_TEXT_VARIATION, DEFAULT_ANNOTATION_VARIATION, DEFAULT_IMAGE_VARIATION,
+    DEFAULT_ANNOTATION_TEXT, DEFAULT_NEUMO_ANNOTATION_TEXT,
+    build_batch_matrix, default_folder_name, default_zip_name, parse_output_sizes,
+)
 
 # ページ設定
 st.set_page_config(
@@ -209,568 +227,115 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-# グローバル設定
-WIDTH = 600
-HEIGHT = 400
-
-# 画像をBase64に変換する関数
-def image_to_base64(img):
-    buffered = io.BytesIO()
-    img.save(buffered, format="PNG")
-    return base64.b64encode(buffered.getvalue()).decode()
+# 圧縮プロファイルの表示名
+COMPRESSION_PROFILE_LABELS = {
+    'fast': "fast（高速・プレビュー向け）",
+    'balanced': "balanced（標準）",
+    'max': "max（最小サイズ・入稿向け）",
+}
 
-# 日本語フォント読み込み関数
-def get_font(font_type="ゴシック", weight="W7", size=40):
-    font_paths = []
-    if font_type == "ゴシック":
-        linux_paths = [
-            "/usr/share/fonts/opentype/noto/NotoSansCJK-Bold.ttc",
-            "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
-            "/usr/share/fonts/truetype/noto/NotoSansCJK-Bold.ttc",
-            "/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc",
-            "/usr/share/fonts/opentype/noto/NotoSansMonoCJKjp-Bold.otf",
-            "/usr/share/fonts/opentype/noto/NotoSansMonoCJKjp-Regular.otf",
-        ]
-        font_paths.extend(linux_paths)
-        hiragino_std_paths = {
-            "W3": "/Library/Fonts/ヒラギノ角ゴ Std W4.otf",
-            "W4": "/Library/Fonts/ヒラギノ角ゴ Std W4.otf",
-            "W5": "/Library/Fonts/ヒラギノ角ゴ Std W6.otf",
-            "W6": "/Library/Fonts/ヒラギノ角ゴ Std W6.otf",
-            "W7": "/Library/Fonts/ヒラギノ角ゴ Std W8.otf",
-            "W8": "/Library/Fonts/ヒラギノ角ゴ Std W8.otf",
-            "W9": "/Library/Fonts/ヒラギノ角ゴ Std W8.otf",
-        }
-        hiragino_paths = {
-            "W3": "/System/Library/Fonts/ヒラギノ角ゴシック W3.ttc",
-            "W4": "/System/Library/Fonts/ヒラギノ角ゴシック W4.ttc",
-            "W5": "/System/Library/Fonts/ヒラギノ角ゴシック W5.ttc",
-            "W6": "/System/Library/Fonts/ヒラギノ角ゴシック W6.ttc",
-            "W7": "/System/Library/Fonts/ヒラギノ角ゴシック W7.ttc",
-            "W8": "/System/Library/Fonts/ヒラギノ角ゴシック W8.ttc",
-            "W9": "/System/Library/Fonts/ヒラギノ角ゴシック W9.ttc",
-        }
-        windows_paths = {
-            "W3": ["C:\\Windows\\Fonts\\meiryo.ttc", "C:\\Windows\\Fonts\\YuGothL.ttc"],
-            "W4": ["C:\\Windows\\Fonts\\meiryo.ttc", "C:\\Windows\\Fonts\\YuGothR.ttc"],
-            "W5": ["C:\\Windows\\Fonts\\meiryo.ttc", "C:\\Windows\\Fonts\\YuGothM.ttc"],
-            "W6": ["C:\\Windows\\Fonts\\meiryob.ttc", "C:\\Windows\\Fonts\\YuGothB.ttc"],
-            "W7": ["C:\\Windows\\Fonts\\meiryob.ttc", "C:\\Windows\\Fonts\\YuGothB.ttc"],
-            "W8": ["C:\\Windows\\Fonts\\meiryob.ttc", "C:\\Windows\\Fonts\\YuGothB.ttc"],
-            "W9": ["C:\\Windows\\Fonts\\meiryob.ttc", "C:\\Windows\\Fonts\\YuGothB.ttc"],
-        }
-        if weight in hiragino_std_paths: font_paths.append(hiragino_std_paths[weight])
-        if weight in hiragino_paths: font_paths.append(hiragino_paths[weight])
-        if weight in windows_paths: font_paths.extend(windows_paths[weight])
-        font_paths.extend(["msgothic.ttc", "C:\\Windows\\Fonts\\msgothic.ttc"])
-    else:
-        linux_paths = [
-            "/usr/share/fonts/opentype/noto/NotoSerifCJK-Bold.ttc",
-            "/usr/share/fonts/opentype/noto/NotoSerifCJK-Regular.ttc",
-            "/usr/share/fonts/truetype/noto/NotoSerifCJK-Bold.ttc",
-            "/usr/share/fonts/truetype/noto/NotoSerifCJK-Regular.ttc",
-            "/usr/share/fonts/opentype/noto/NotoSansCJK-Bold.ttc",
-            "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
-        ]
-        font_paths.extend(linux_paths)
-        font_paths.extend([
-            "/System/Library/Fonts/ヒラギノ明朝 ProN W6.ttc",
-            "/Library/Fonts/ヒラギノ明朝 Std W6.otf",
-            "/System/Library/Fonts/ヒラギノ明朝 ProN W3.ttc",
-            "/Library/Fonts/ヒラギノ明朝 Std W3.otf",
-            "C:\\Windows\\Fonts\\msmincho.ttc",
-            "msmincho.ttc"
-        ])
-    for font_path in font_paths:
-        try:
-            return ImageFont.truetype(font_path, size)
-        except Exception as e:
-            continue
-    st.warning(f"日本語フォントが見つかりませんでした。デフォルトフォントを使用します。")
-    return ImageFont.load_default()
+# プレビュー画像の形式（低負荷設定のWebP。使えない環境ではJPEG）
+PREVIEW_FORMAT = ("WEBP", "image/webp", {'quality': 80, 'method': 0}) if features.check('webp') else ("JPEG", "image/jpeg", {'quality': 85})
+PREVIEW_SCALE = 0.5
+# セッションごとに保持するプレビューの上限
+PREVIEW_CACHE_MAX_SIZE = 200
+PREVIEW_CACHE_MAX_BYTES = 16 * 1024 * 1024
 
-# 描画関連関数群
-def draw_text_bold(draw, position, text, font, fill, anchor="mm", is_mincho_bold=False):
-    x, y = position
-    if is_mincho_bold:
-        offsets = [(0, 0), (1, 0), (0, 1), (1, 1)]
-        for dx, dy in offsets:
-            draw.text((x + dx, y + dy), text, fill=fill, font=font, anchor=anchor)
-    else:
-        draw.text((x, y), text, fill=fill, font=font, anchor=anchor)
-
-def load_icon_image(icon_name, size):
-    icon_path = f"icons/{icon_name}"
-    if os.path.exists(icon_path):
-        icon = Image.open(icon_path).convert("RGBA")
-        icon = icon.resize((size, size), Image.Resampling.LANCZOS)
-        return icon
-    return None
+def image_to_data_uri(img):
+    image_format, mime, save_options = PREVIEW_FORMAT
+    buffered = io.BytesIO()
+    img.convert('RGB').save(buffered, format=image_format, **save_options)
+    return f"data:{mime};base64,{base64.b64encode(buffered.getvalue()).decode()}"
 
-# 文字描画関数（アラインメント対応）
-def draw_text_with_spacing(img, draw, text, x, y, font, color, char_spacing=0, line_spacing=0, aspect_ratio=1.0, is_mincho_bold=False, align="center"):
-    lines = text.split('\n')
-    current_y = y
-    
-    for line in lines:
-        if not line:
-            bbox = draw.textbbox((0, 0), "A", font=font)
-            current_y += (bbox[3] - bbox[1]) + line_spacing
-            continue
-        
-        if char_spacing != 0 or aspect_ratio != 1.0 or align != "center":
-            total_width = 0
-            char_data = []
-            
-            # 1行の合計幅を計算
-            for char in line:
-                bbox = draw.textbbox((0, 0), char, font=font)
-                char_width = (bbox[2] - bbox[0])
-                char_height = (bbox[3] - bbox[1])
-                scaled_width = char_width * aspect_ratio
-                char_data.append((char, scaled_width, char_height))
-                total_width += scaled_width + char_spacing
-            
-            total_width -= char_spacing
-            
-            # アラインメントによる開始位置計算
-            if align == "left":
-                start_x = x
-            elif align == "right":
-                start_x = x - total_width
-            else: # center
-                start_x = x - total_width / 2
-                
-            current_x = start_x
-            
-            for char, scaled_width, char_height in char_data:
-                temp_size = int(font.size * 3)
-                temp_img = Image.new('RGBA', (temp_size, temp_size), (255, 255, 255, 0))
-                temp_draw = ImageDraw.Draw(temp_img)
-                
-                if is_mincho_bold:
-                    offsets = [(0, 0), (1, 0), (0, 1), (1, 1)]
-                    for dx, dy in offsets:
-                        temp_draw.text((temp_size // 2 + dx, temp_size // 2 + dy), char, fill=color, font=font, anchor="mm")
-                else:
-                    temp_draw.text((temp_size // 2, temp_size // 2), char, fill=color, font=font, anchor="mm")
-                
-                if aspect_ratio != 1.0:
-                    new_width = int(temp_img.width * aspect_ratio)
-                    temp_img = temp_img.resize((new_width, temp_img.height), Image.Resampling.LANCZOS)
-                
-                # ペースト位置（temp_imgの中心が文字の中心）
-                paste_x = int(current_x + scaled_width / 2 - temp_img.width / 2)
-                paste_y = int(current_y - temp_img.height / 2)
-                img.paste(temp_img, (paste_x, paste_y), temp_img)
-                
-                current_x += scaled_width + char_spacing
-        else:
-            # 標準描画（アスペクト比1.0、文字間0、中央揃え）
-            draw_text_bold(draw, (x, current_y), line, font, color, "mm", is_mincho_bold)
-        
-        bbox = draw.textbbox((0, 0), line, font=font)
-        current_y += (bbox[3] - bbox[1]) + line_spacing
-    
-    return current_y
+# プレビュー画像をセッション内でキャッシュする
+# 描画に影響する入力（テキスト・注釈・画像設定・テンプレート引数・倍率）のハッシュをキーにし、変更されたものだけ再描画する
+def get_preview_data_uri(text_var, annotation_elements, image_config, template_type, **kwargs):
+    if 'preview_cache' not in st.session_state:
+        st.session_state.preview_cache = LRUCache(PREVIEW_CACHE_MAX_SIZE, PREVIEW_CACHE_MAX_BYTES, sizeof=len)
+        get_session_memory().track(get_session_id(), "プレビュー", st.session_state.preview_cache)
+    # アップロード画像はダイジェストがあればそれで識別する（毎回画像全体をハッシュしない）
+    image_key = {key: value for key, value in image_config.items() if key != 'image' or not image_config.get('digest')}
+    cache_key = config_digest(template_type, text_var, annotation_elements, image_key, kwargs, PREVIEW_SCALE, PREVIEW_FORMAT[0])
+    return st.session_state.preview_cache.get_or_create(cache_key, lambda: image_to_data_uri(create_preview_image(
+        [text_var], annotation_elements, image_config['image'], image_config,
+        template_type, scale=PREVIEW_SCALE, **kwargs
+    )))
 
-# テンプレート関数群
-def create_red_border_blink_frames(width, height, text_elements, annotation_elements, uploaded_image, image_config, border_width=13, border_color="red", num_frames=5):
-    frames = []
-    color_map = {"red": "#FF0000", "blue": "#0000FF", "green": "#00FF00", "black": "#000000", "orange": "#FF6600"}
-    border_rgb = color_map.get(border_color, "#FF0000")
-    for i in range(num_frames):
-        img = Image.new('RGB', (width, height), 'white')
-        draw = ImageDraw.Draw(img)
-        if uploaded_image is not None and image_config is not None:
-            img_scale = image_config.get('scale', 1.0)
-            original_width = image_config.get('original_width', 100)
-            original_height = image_config.get('original_height', 100)
-            img_width = int(original_width * img_scale)
-            img_height = int(original_height * img_scale)
-            img_x = image_config.get('x', width // 2)
-            img_y = image_config.get('y', height // 2)
-            resized_img = uploaded_image.resize((img_width, img_height), Image.Resampling.LANCZOS)
-            paste_x = img_x - img_width // 2
-            paste_y = img_y - img_height // 2
-            if uploaded_image.mode == 'RGBA':
-                img.paste(resized_img, (paste_x, paste_y), resized_img)
-            else:
-                img.paste(resized_img, (paste_x, paste_y))
-        if i % 2 == 0:
-            draw.rectangle([0, 0, width-1, height-1], outline=border_rgb, width=border_width)
-        
-        for elem in text_elements:
-            if elem.get('enabled', True):
-                font = get_font(elem['font'], elem.get('weight', 'W7'), elem['size'])
-                is_mincho_bold = elem['font'] == "明朝" and elem.get('weight', 'W7') in ["W7", "W8", "W9"]
-                draw_text_with_spacing(img, draw, elem['text'], elem['x'], elem['y'], font, elem['color'],
-                                     char_spacing=elem.get('char_spacing', 0),
-                                     line_spacing=elem.get('line_spacing', 0),
-                                     aspect_ratio=elem.get('aspect_ratio', 1.0),
-                                     is_mincho_bold=is_mincho_bold,
-                                     align="center")
-        
-        for elem in annotation_elements:
-            if elem.get('enabled', True):
-                font = get_font(elem['font'], elem.get('weight', 'W7'), elem['size'])
-                is_mincho_bold = elem['font'] == "明朝" and elem.get('weight', 'W7') in ["W7", "W8", "W9"]
-                # 注釈は左揃え、アスペクト比対応
-                draw_text_with_spacing(img, draw, elem['text'], elem['x'], elem['y'], font, elem['color'],
-                                     aspect_ratio=elem.get('aspect_ratio', 1.0),
-                                     is_mincho_bold=is_mincho_bold,
-                                     align="left")
-        
-        buffer = io.BytesIO()
-        img.save(buffer, format='PNG')
-        frames.append(buffer.getvalue())
-    return frames
+# フォント・アイコンの準備（プロセス内で1回だけ行い、再実行やフラグメントの再実行では作り直さない）
+# 既定のテキスト・注釈のプレビュー用フォントとアイコン原画像を読み込んでおき、最初の操作でも待たないようにする
+@st.cache_resource(show_spinner=False)
+def load_render_resources():
+    font_registry = get_font_registry()
+    for default_var in (DEFAULT_TEXT_VARIATION, DEFAULT_ANNOTATION_VARIATION):
+        get_font(default_var['font'], default_var['weight'], max(1, int(default_var['size'] * PREVIEW_SCALE)))
+    icon_names = sorted(entry.name for entry in os.scandir(ICON_DIR) if entry.name.lower().endswith('.png')) if os.path.isdir(ICON_DIR) else []
+    for icon_name in icon_names:
+        icon_path = os.path.join(ICON_DIR, icon_name)
+        load_icon_source(icon_path, os.path.getmtime(icon_path))
+    return {'fonts': font_registry, 'icons': icon_names}
 
-def create_corner_icon_blink_frames(width, height, text_elements, annotation_elements, uploaded_image, image_config, icon_name="check.png", icon_size=85, num_frames=5):
-    frames = []
-    for i in range(num_frames):
-        img = Image.new('RGB', (width, height), 'white')
-        draw = ImageDraw.Draw(img)
-        if uploaded_image is not None and image_config is not None:
-            img_scale = image_config.get('scale', 1.0)
-            original_width = image_config.get('original_width', 100)
-            original_height = image_config.get('original_height', 100)
-            img_width = int(original_width * img_scale)
-            img_height = int(original_height * img_scale)
-            img_x = image_config.get('x', width // 2)
-            img_y = image_config.get('y', height // 2)
-            resized_img = uploaded_image.resize((img_width, img_height), Image.Resampling.LANCZOS)
-            paste_x = img_x - img_width // 2
-            paste_y = img_y - img_height // 2
-            if uploaded_image.mode == 'RGBA':
-                img.paste(resized_img, (paste_x, paste_y), resized_img)
-            else:
-                img.paste(resized_img, (paste_x, paste_y))
-        if i % 2 == 0:
-            icon_img = load_icon_image(icon_name, icon_size)
-            if icon_img:
-                positions = [(10, 10), (width - icon_size - 10, 10),
-                            (10, height - icon_size - 10), (width - icon_size - 10, height - icon_size - 10)]
-                for pos in positions:
-                    img.paste(icon_img, pos, icon_img)
-        
-        for elem in text_elements:
-            if elem.get('enabled', True):
-                font = get_font(elem['font'], elem.get('weight', 'W7'), elem['size'])
-                is_mincho_bold = elem['font'] == "明朝" and elem.get('weight', 'W7') in ["W7", "W8", "W9"]
-                draw_text_with_spacing(img, draw, elem['text'], elem['x'], elem['y'], font, elem['color'],
-                                     char_spacing=elem.get('char_spacing', 0),
-                                     line_spacing=elem.get('line_spacing', 0),
-                                     aspect_ratio=elem.get('aspect_ratio', 1.0),
-                                     is_mincho_bold=is_mincho_bold,
-                                     align="center")
-        
-        for elem in annotation_elements:
-            if elem.get('enabled', True):
-                font = get_font(elem['font'], elem.get('weight', 'W7'), elem['size'])
-                is_mincho_bold = elem['font'] == "明朝" and elem.get('weight', 'W7') in ["W7", "W8", "W9"]
-                draw_text_with_spacing(img, draw, elem['text'], elem['x'], elem['y'], font, elem['color'],
-                                     aspect_ratio=elem.get('aspect_ratio', 1.0),
-                                     is_mincho_bold=is_mincho_bold,
-                                     align="left")
-        
-        buffer = io.BytesIO()
-        img.save(buffer, format='PNG')
-        frames.append(buffer.getvalue())
-    return frames
+# メモリ管理用のセッション識別子
+def get_session_id():
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else "local"
 
-def create_icon_increase_frames(width, height, icon_text_config, annotation_elements, uploaded_image, image_config, icon_name="check.png", icon_size=60, num_frames=5):
-    frames = []
-    text_content = icon_text_config.get('text', 'サンプルテキスト').replace('\n', '')
-    text_font_type = icon_text_config.get('font', 'ゴシック')
-    text_weight = icon_text_config.get('weight', 'W7')
-    text_size = icon_text_config.get('icon_size', 40)
-    text_color = icon_text_config.get('color', '#000000')
-    text_x = icon_text_config.get('icon_x', 74)
-    text_y_base = icon_text_config.get('icon_y', 320)
-    char_spacing = icon_text_config.get('icon_char_spacing', 0)
-    aspect_ratio = icon_text_config.get('icon_aspect_ratio', 1.0)
-    row_spacing = icon_text_config.get('icon_row_spacing', 62)
-    is_mincho_bold = text_font_type == "明朝" and text_weight in ["W7", "W8", "W9"]
-    
-    for frame_idx in range(num_frames):
-        img = Image.new('RGB', (width, height), 'white')
-        draw = ImageDraw.Draw(img)
-        if uploaded_image is not None and image_config is not None:
-            img_scale = image_config.get('scale', 1.0)
-            original_width = image_config.get('original_width', 100)
-            original_height = image_config.get('original_height', 100)
-            img_width = int(original_width * img_scale)
-            img_height = int(original_height * img_scale)
-            img_x = image_config.get('x', width // 2)
-            img_y = image_config.get('y', height // 2)
-            resized_img = uploaded_image.resize((img_width, img_height), Image.Resampling.LANCZOS)
-            paste_x = img_x - img_width // 2
-            paste_y = img_y - img_height // 2
-            if uploaded_image.mode == 'RGBA':
-                img.paste(resized_img, (paste_x, paste_y), resized_img)
-            else:
-                img.paste(resized_img, (paste_x, paste_y))
-        
-        num_lines = frame_idx + 1
-        start_y = text_y_base - ((num_lines - 1) * row_spacing)
-        icon_img = load_icon_image(icon_name, icon_size)
-        font = get_font(text_font_type, text_weight, text_size)
-        
-        for line_idx in range(num_lines):
-            current_y = start_y + (line_idx * row_spacing)
-            # アイコン増加のテキストは左揃え基準で描画
-            # アイコン位置計算のために1文字目の左端が必要
-            
-            # draw_text_with_spacingは使わず、従来のロジックを維持しつつアスペクト比対応
-            # （アイコン位置との関係が密接なため）
-            
-            first_char_left_edge = None
-            current_x = text_x
-            
-            for char_idx, char in enumerate(text_content):
-                temp_size = int(font.size * 3)
-                temp_img = Image.new('RGBA', (temp_size, temp_size), (255, 255, 255, 0))
-                temp_draw = ImageDraw.Draw(temp_img)
-                if is_mincho_bold:
-                    offsets = [(0, 0), (1, 0), (0, 1), (1, 1)]
-                    for dx, dy in offsets:
-                        temp_draw.text((temp_size // 2 + dx, temp_size // 2 + dy), char, fill=text_color, font=font, anchor="mm")
-                else:
-                    temp_draw.text((temp_size // 2, temp_size // 2), char, fill=text_color, font=font, anchor="mm")
-                
-                bbox_text = temp_draw.textbbox((0, 0), char, font=font)
-                original_char_width = bbox_text[2] - bbox_text[0]
-                scaled_char_width = original_char_width * aspect_ratio
-                
-                if aspect_ratio != 1.0:
-                    new_width = int(temp_img.width * aspect_ratio)
-                    temp_img = temp_img.resize((new_width, temp_img.height), Image.Resampling.LANCZOS)
-                
-                bbox_img = temp_img.getbbox()
-                if bbox_img:
-                    cropped = temp_img.crop(bbox_img)
-                    paste_x = int(current_x + bbox_img[0])
-                    paste_y = int(current_y - temp_img.height // 2 + bbox_img[1])
-                    if char_idx == 0: first_char_left_edge = paste_x
-                    img.paste(cropped, (paste_x, paste_y), cropped)
-                    current_x += scaled_char_width + char_spacing
-                else:
-                    current_x += scaled_char_width + char_spacing
-                    if char_idx == 0: first_char_left_edge = current_x
-            
-            if first_char_left_edge is not None:
-                icon_x_pos = int(first_char_left_edge - icon_size - 5)
-            else:
-                icon_x_pos = text_x - icon_size - 5
-            
-            icon_y_pos = current_y - icon_size // 2
-            if icon_img:
-                img.paste(icon_img, (icon_x_pos, icon_y_pos), icon_img)
-        
-        for elem in annotation_elements:
-            if elem.get('enabled', True):
-                font_annot = get_font(elem['font'], elem.get('weight', 'W7'), elem['size'])
-                is_mincho_bold_annot = elem['font'] == "明朝" and elem.get('weight', 'W7') in ["W7", "W8", "W9"]
-                draw_text_with_spacing(img, draw, elem['text'], elem['x'], elem['y'], font, elem['color'],
-                                     aspect_ratio=elem.get('aspect_ratio', 1.0),
-                                     is_mincho_bold=is_mincho_bold_annot,
-                                     align="left")
-        
-        buffer = io.BytesIO()
-        img.save(buffer, format='PNG')
-        frames.append(buffer.getvalue())
-    return frames
+# 画像設定のアップロード画像を取り出す（ディスクへ退避されていれば読み直す）
+def resolve_image_variation(img_var):
+    image = img_var.get('image')
+    if isinstance(image, SpillableImage):
+        return dict(img_var, image=image.get())
+    return img_var
 
-def save_apng(frames, num_frames, num_plays=4):
-    frame_delay = 1000 // num_frames
-    apng_obj = APNG()
-    for frame_data in frames:
-        apng_obj.append_file(io.BytesIO(frame_data), delay=frame_delay)
-    apng_obj.num_plays = num_plays
-    output = io.BytesIO()
-    apng_obj.save(output)
-    output.seek(0)
-    return output.getvalue()
+# 一括生成の処理時間の内訳（画面表示とJSONダウンロード用）
+# handler: ボタン押下から完成までのこのプロセスの内訳、jobs: 作業単位ごとの内訳
+# jobs_total: 作業単位の合計（並列ワーカーの時間を足し合わせるため、全体の経過時間より長くなることがある）
+def build_timing_report(handler_timings, job_timings, settings):
+    return {
+        'generated_at': datetime.now().isoformat(timespec='seconds'),
+        'settings': settings,
+        'handler': handler_timings.to_dict(),
+        'jobs_total': merge_stage_timings(job_timings),
+        'jobs': job_timings,
+    }
 
-def create_preview_image(text_elements, annotation_elements, uploaded_image, image_config, template_type, scale=0.5, **kwargs):
-    preview_width = int(WIDTH * scale)
-    preview_height = int(HEIGHT * scale)
-    img = Image.new('RGB', (preview_width, preview_height), 'white')
-    draw = ImageDraw.Draw(img)
-    if uploaded_image is not None and image_config is not None:
-        img_scale = image_config.get('scale', 1.0)
-        original_width = image_config.get('original_width', 100)
-        original_height = image_config.get('original_height', 100)
-        img_width = int(original_width * img_scale * scale)
-        img_height = int(original_height * img_scale * scale)
-        img_x = int(image_config.get('x', WIDTH // 2) * scale)
-        img_y = int(image_config.get('y', HEIGHT // 2) * scale)
-        resized_img = uploaded_image.resize((img_width, img_height), Image.Resampling.LANCZOS)
-        paste_x = img_x - img_width // 2
-        paste_y = img_y - img_height // 2
-        if uploaded_image.mode == 'RGBA':
-            img.paste(resized_img, (paste_x, paste_y), resized_img)
-        else:
-            img.paste(resized_img, (paste_x, paste_y))
-    
-    if template_type == "赤枠点滅":
-        border_width = max(1, int(kwargs.get('border_width', 13) * scale))
-        border_color = kwargs.get('border_color', 'red')
-        color_map = {"red": "#FF0000", "blue": "#0000FF", "green": "#00FF00", "black": "#000000", "orange": "#FF6600"}
-        draw.rectangle([0, 0, preview_width-1, preview_height-1], outline=color_map.get(border_color, "#FF0000"), width=border_width)
-    elif template_type == "4隅アイコン点滅":
-        icon_size = int(kwargs.get('icon_size', 85) * scale)
-        icon_name = kwargs.get('icon_name', 'check.png')
-        icon_img = load_icon_image(icon_name, icon_size)
-        if icon_img:
-            positions = [(10, 10), (preview_width - icon_size - 10, 10),
-                        (10, preview_height - icon_size - 10), (preview_width - icon_size - 10, preview_height - icon_size - 10)]
-            for pos in positions: img.paste(icon_img, pos, icon_img)
-    elif template_type == "アイコン増加":
-        icon_text_config = text_elements[0]
-        text_content = icon_text_config.get('text', 'サンプルテキスト').replace('\n', '')
-        text_font_type = icon_text_config.get('font', 'ゴシック')
-        text_weight = icon_text_config.get('weight', 'W7')
-        text_size = int(icon_text_config.get('icon_size', 40) * scale)
-        text_color = icon_text_config.get('color', '#000000')
-        text_x = int(icon_text_config.get('icon_x', 74) * scale)
-        text_y_base = int(icon_text_config.get('icon_y', 320) * scale)
-        char_spacing = int(icon_text_config.get('icon_char_spacing', 0) * scale)
-        aspect_ratio = icon_text_config.get('icon_aspect_ratio', 1.0)
-        row_spacing = int(icon_text_config.get('icon_row_spacing', 62) * scale)
-        icon_size = int(kwargs.get('icon_size', 60) * scale)
-        icon_name = kwargs.get('icon_name', 'check.png')
-        is_mincho_bold = text_font_type == "明朝" and text_weight in ["W7", "W8", "W9"]
-        num_lines = 5
-        start_y = text_y_base - ((num_lines - 1) * row_spacing)
-        icon_img = load_icon_image(icon_name, icon_size)
-        font = get_font(text_font_type, text_weight, text_size)
-        
-        for line_idx in range(num_lines):
-            current_y = start_y + (line_idx * row_spacing)
-            
-            first_char_left_edge = None
-            current_x = text_x
-            
-            for char_idx, char in enumerate(text_content):
-                temp_size = int(font.size * 3)
-                temp_img = Image.new('RGBA', (temp_size, temp_size), (255, 255, 255, 0))
-                temp_draw = ImageDraw.Draw(temp_img)
-                if is_mincho_bold:
-                    offsets = [(0, 0), (1, 0), (0, 1), (1, 1)]
-                    for dx, dy in offsets:
-                        temp_draw.text((temp_size // 2 + dx, temp_size // 2 + dy), char, fill=text_color, font=font, anchor="mm")
-                else:
-                    temp_draw.text((temp_size // 2, temp_size // 2), char, fill=text_color, font=font, anchor="mm")
-                
-                bbox_text = temp_draw.textbbox((0, 0), char, font=font)
-                original_char_width = bbox_text[2] - bbox_text[0]
-                scaled_char_width = original_char_width * aspect_ratio
-                
-                if aspect_ratio != 1.0:
-                    new_width = int(temp_img.width * aspect_ratio)
-                    temp_img = temp_img.resize((new_width, temp_img.height), Image.Resampling.LANCZOS)
-                
-                bbox_img = temp_img.getbbox()
-                if bbox_img:
-                    cropped = temp_img.crop(bbox_img)
-                    paste_x = int(current_x + bbox_img[0])
-                    paste_y = int(current_y - temp_img.height // 2 + bbox_img[1])
-                    if char_idx == 0: first_char_left_edge = paste_x
-                    img.paste(cropped, (paste_x, paste_y), cropped)
-                    current_x += scaled_char_width + char_spacing
-                else:
-                    current_x += scaled_char_width + char_spacing
-                    if char_idx == 0: first_char_left_edge = current_x
-            
-            if first_char_left_edge is not None:
-                icon_x = int(first_char_left_edge - icon_size - int(5 * scale))
-            else:
-                icon_x = text_x - icon_size - int(5 * scale)
-            
-            icon_y = current_y - icon_size // 2
-            if icon_img:
-                img.paste(icon_img, (icon_x, icon_y), icon_img)
-    
-    if template_type != "アイコン増加":
-        for elem in text_elements:
-            if elem.get('enabled', True):
-                font = get_font(elem['font'], elem.get('weight', 'W7'), int(elem['size'] * scale))
-                scaled_x = int(elem['x'] * scale)
-                scaled_y = int(elem['y'] * scale)
-                scaled_char_spacing = int(elem.get('char_spacing', 0) * scale)
-                scaled_line_spacing = int(elem.get('line_spacing', 0) * scale)
-                is_mincho_bold = elem['font'] == "明朝" and elem.get('weight', 'W7') in ["W7", "W8", "W9"]
-                draw_text_with_spacing(img, draw, elem['text'], scaled_x, scaled_y, font, elem['color'],
-                                     char_spacing=scaled_char_spacing,
-                                     line_spacing=scaled_line_spacing,
-                                     aspect_ratio=elem.get('aspect_ratio', 1.0),
-                                     is_mincho_bold=is_mincho_bold,
-                                     align="center")
-    
-    for elem in annotation_elements:
-        if elem.get('enabled', True):
-            font = get_font(elem['font'], elem.get('weight', 'W7'), int(elem['size'] * scale))
-            is_mincho_bold = elem['font'] == "明朝" and elem.get('weight', 'W7') in ["W7", "W8", "W9"]
-            draw_text_with_spacing(img, draw, elem['text'], int(elem['x'] * scale), int(elem['y'] * scale), font, elem['color'],
-                                 aspect_ratio=elem.get('aspect_ratio', 1.0),
-                                 is_mincho_bold=is_mincho_bold,
-                                 align="left")
-    
-    return img
+# 内訳を表示用の行に変換
+def timing_rows(timings):
+    total_ms = timings['total_ms']
+    entries = [(STAGE_LABELS.get(stage, stage), stage_stats['ms'], stage_stats['calls']) for stage, stage_stats in timings['stages'].items()]
+    entries.append(("その他", timings['untracked_ms'], None))
+    return [
+        {'段階': label, 'ms': round(ms, 1), '割合': f"{ms / total_ms:.1%}" if total_ms else "-", '回数': calls}
+        for label, ms, calls in entries
+    ]
 
 # メインアプリ
 st.title("APNG Generator")
 
+render_resources = load_render_resources()
+if not any(render_resources['fonts'].values()):
+    st.warning("日本語フォントが見つかりませんでした。デフォルトフォントを使用します。")
+
 # セッション状態の初期化
 if 'text_variations' not in st.session_state:
-    st.session_state.text_variations = [{
-        'text': 'サンプルテキスト',
-        'font': 'ゴシック',
-        'weight': 'W7',
-        'size': 100,
-        'color': '#000000',
-        'char_spacing': 0,
-        'line_spacing': 0,
-        'aspect_ratio': 1.0,
-        'x': WIDTH // 2,
-        'y': HEIGHT // 2,
-        'enabled': True,
-        'icon_size': 40,
-        'icon_x': 74,
-        'icon_y': 320,
-        'icon_char_spacing': 0,
-        'icon_aspect_ratio': 1.0,
-        'icon_row_spacing': 62
-    }]
+    st.session_state.text_variations = [dict(DEFAULT_TEXT_VARIATION)]
 
-default_annot_text = "※定期初回限定クーポンのこと。定期初回価格、1世帯1回限り。すでにキャンペーンで購入済みの方は対象外"
-default_neumo_text = "※定期初回限定のクーポンのこと※定期初回価格。初回限定、1世帯1回限り。既にニューモVをキャンペーンで購入済みの方は対象外となります"
+default_annot_text = DEFAULT_ANNOTATION_TEXT
+default_neumo_text = DEFAULT_NEUMO_ANNOTATION_TEXT
 
 if 'annotation_variations' not in st.session_state:
-    st.session_state.annotation_variations = [{
-        'text': default_annot_text,
-        'font': 'ゴシック',
-        'weight': 'W7',
-        'size': 10,
-        'color': '#000000',
-        'x': 10,
-        'y': 390,
-        'enabled': True,
-        'is_neumo': False,
-        'aspect_ratio': 1.0
-    }]
+    st.session_state.annotation_variations = [dict(DEFAULT_ANNOTATION_VARIATION)]
 
 if 'image_variations' not in st.session_state:
-    st.session_state.image_variations = [{
-        'image': None,
-        'original_width': 100,
-        'original_height': 100,
-        'scale': 1.0,
-        'x': WIDTH // 2,
-        'y': HEIGHT // 2
-    }]
+    st.session_state.image_variations = [dict(DEFAULT_IMAGE_VARIATION)]
+
+# セッションが保持する画像・生成結果のメモリ管理（操作のあったセッションとして記録）
+session_id = get_session_id()
+session_memory = get_session_memory()
+session_memory.touch(session_id)
+
+# 一括生成のバックグラウンド実行（進捗表示のため、実行中はこの間隔で再実行する）
+BATCH_POLL_SECONDS = 1.0
+batch_queue = get_batch_queue()
 
 if 'use_red_border' not in st.session_state:
     st.session_state.use_red_border = True
@@ -786,442 +351,27 @@ if 'border_width_red' not in st.session_state: st.session_state.border_width_red
 if 'icon_size_corner' not in st.session_state: st.session_state.icon_size_corner = 100
 if 'icon_size_increase' not in st.session_state: st.session_state.icon_size_increase = 55
 
-# レイアウト：左右分割（比率調整）
-col_settings, col_preview = st.columns([1.2, 1])
-
 # ==========================================
-# 左カラム：設定エリア（タブ化による整理）
+# 設定パネルとプレビュー
 # ==========================================
-with col_settings:
-    # タブの作成
-    tab_template, tab_text, tab_image, tab_annot, tab_output = st.tabs([
-        "テンプレート選択", "テキスト設定", "画像設定", "注釈設定", "出力・保存"
-    ])
-    
-    # --- タブ1: テンプレート選択 ---
-    with tab_template:
-        st.markdown('<div class="simple-header">使用するテンプレート</div>', unsafe_allow_html=True)
-        col_t1, col_t2, col_t3 = st.columns(3)
-        with col_t1:
-            use_red_border = st.checkbox("赤枠点滅", value=st.session_state.use_red_border, key="chk_red")
-        with col_t2:
-            use_corner_icon = st.checkbox("4隅アイコン", value=st.session_state.use_corner_icon, key="chk_corner")
-        with col_t3:
-            use_icon_increase = st.checkbox("アイコン増加", value=st.session_state.use_icon_increase, key="chk_increase")
-        
-        st.session_state.use_red_border = use_red_border
-        st.session_state.use_corner_icon = use_corner_icon
-        st.session_state.use_icon_increase = use_icon_increase
-        
-        st.markdown('<div class="simple-header">詳細パラメータ</div>', unsafe_allow_html=True)
-        if use_red_border:
-            st.caption("赤枠点滅の設定")
-            col1, col2 = st.columns(2)
-            with col1: 
-                border_width_red = st.slider("枠線の太さ", 15, 45, st.session_state.border_width_red, key="border_width_red")
-            with col2: 
-                border_colors = st.multiselect("枠線の色", ["red", "blue", "green", "black", "orange"], default=["red"], key="border_colors")
-            
-            with st.expander("詳細設定（フレーム数・ループ数）", expanded=False):
-                col3, col4 = st.columns(2)
-                with col3: num_frames_red = st.slider("フレーム数", 5, 20, 5, key="num_frames_red")
-                with col4: loop_count_red = st.selectbox("ループ数", [1, 2, 3, 4], index=3, key="loop_count_red")
-            st.divider()
-        
-        if use_corner_icon:
-            st.caption("4隅アイコンの設定")
-            col1, col2 = st.columns(2)
-            with col1: 
-                icon_size_corner = st.slider("アイコンサイズ", 20, 150, st.session_state.icon_size_corner, key="icon_size_corner")
-            with col2: 
-                icon_names = st.multiselect("アイコン種類", ["check.png", "red_check.png", "！.png", "！？.png"], default=["check.png"], key="icon_names")
-            
-            with st.expander("詳細設定（フレーム数・ループ数）", expanded=False):
-                col3, col4 = st.columns(2)
-                with col3: num_frames_corner = st.slider("フレーム数", 5, 20, 5, key="num_frames_corner")
-                with col4: loop_count_corner = st.selectbox("ループ数", [1, 2, 3, 4], index=3, key="loop_count_corner")
-            st.divider()
-        
-        if use_icon_increase:
-            st.caption("アイコン増加の設定")
-            col1, col2 = st.columns(2)
-            with col1: 
-                icon_size_increase = st.slider("アイコンサイズ(増)", 20, 150, st.session_state.icon_size_increase, key="icon_size_increase")
-            with col2: 
-                icon_names_increase = st.multiselect("アイコン種類(増)", ["check.png", "red_check.png", "！.png", "！？.png"], default=["check.png"], key="icon_names_increase")
-            
-            with st.expander("詳細設定（フレーム数・ループ数）", expanded=False):
-                col3, col4 = st.columns(2)
-                with col3: num_frames_increase = st.slider("フレーム数", 3, 10, 5, key="num_frames_increase")
-                with col4: loop_count_increase = st.selectbox("ループ数", [1, 2, 3, 4], index=3, key="loop_count_increase")
-    
-    # --- タブ2: テキスト設定 ---
-    with tab_text:
-        # 第1：Text選択ラジオボタン
-        text_options = [f"Text {i+1}" for i in range(len(st.session_state.text_variations))]
-        selected_text_idx = st.radio("編集するテキストを選択", range(len(text_options)), format_func=lambda x: text_options[x], horizontal=True, index=st.session_state.get('selected_text_tab', 0))
-        st.session_state.selected_text_tab = selected_text_idx
-        
-        # 第2：テキストを追加ボタン
-        if st.button("テキストを追加", key="tab_btn_add", use_container_width=True):
-            st.session_state.text_variations.append({
-                'text': '新しいテキスト',
-                'font': 'ゴシック',
-                'weight': 'W7',
-                'size': 100,
-                'color': '#000000',
-                'char_spacing': 0,
-                'line_spacing': 0,
-                'aspect_ratio': 1.0,
-                'x': WIDTH // 2,
-                'y': HEIGHT // 2,
-                'enabled': True,
-                'icon_size': 40,
-                'icon_x': 74,
-                'icon_y': 320,
-                'icon_char_spacing': 0,
-                'icon_aspect_ratio': 1.0,
-                'icon_row_spacing': 62
-            })
-            st.session_state.selected_text_tab = len(st.session_state.text_variations) - 1
-            st.rerun()
-
-        text_var = st.session_state.text_variations[selected_text_idx]
-        st.markdown("<br>", unsafe_allow_html=True)
-        
-        # 第3：テキスト入力欄
-        new_text = st.text_area("テキスト内容", value=text_var['text'], height=80, key=f"textarea_{selected_text_idx}", placeholder="テキストを入力...")
-        st.session_state.text_variations[selected_text_idx]['text'] = new_text
-        
-        # 削除ボタン（表示トグルの代わり）
-        if st.button("このテキスト設定を削除", key=f"del_txt_{selected_text_idx}", use_container_width=True):
-            if len(st.session_state.text_variations) > 1:
-                st.session_state.text_variations.pop(selected_text_idx)
-                st.session_state.selected_text_tab = max(0, selected_text_idx - 1)
-                st.rerun()
-            else:
-                st.warning("最後のテキスト設定は削除できません")
-        
-        st.divider()
-
-        # 第5：フォント、ウェイト（太さ）
-        col1, col2 = st.columns(2)
-        with col1:
-            font = st.selectbox("フォント", ["ゴシック", "明朝"],
-                                index=["ゴシック", "明朝"].index(text_var.get('font', 'ゴシック')),
-                                key=f"font_{selected_text_idx}")
-            st.session_state.text_variations[selected_text_idx]['font'] = font
-        with col2:
-            weight = st.selectbox("太さ", ["W3", "W4", "W5", "W6", "W7", "W8", "W9"],
-                                    index=["W3", "W4", "W5", "W6", "W7", "W8", "W9"].index(text_var.get('weight', 'W7')),
-                                    key=f"weight_{selected_text_idx}")
-            st.session_state.text_variations[selected_text_idx]['weight'] = weight
-        
-        # 第6：サイズ、色
-        col3, col4 = st.columns([2, 1])
-        with col3:
-            size = st.slider("サイズ", 50, 200, text_var.get('size', 100), key=f"size_{selected_text_idx}")
-            st.session_state.text_variations[selected_text_idx]['size'] = size
-        with col4:
-            color = st.color_picker("色", text_var.get('color', '#000000'), key=f"color_{selected_text_idx}")
-            st.session_state.text_variations[selected_text_idx]['color'] = color
-        
-        # 第7：文字間、行間、縦横比
-        col5, col6, col7 = st.columns(3)
-        with col5:
-            char_spacing = st.slider("文字間", -10, 50, text_var.get('char_spacing', 0), key=f"char_{selected_text_idx}")
-            st.session_state.text_variations[selected_text_idx]['char_spacing'] = char_spacing
-        with col6:
-            line_spacing = st.slider("行間", -10, 50, text_var.get('line_spacing', 0), key=f"line_{selected_text_idx}")
-            st.session_state.text_variations[selected_text_idx]['line_spacing'] = line_spacing
-        with col7:
-            aspect_ratio = st.slider("縦横比", 50, 200, int(text_var.get('aspect_ratio', 1.0) * 100), key=f"aspect_{selected_text_idx}") / 100
-            st.session_state.text_variations[selected_text_idx]['aspect_ratio'] = aspect_ratio
-            
-        # 第8：X座標（横）、Y座標（縦）
-        col8, col9 = st.columns(2)
-        with col8:
-            pos_x = st.slider("横位置 (X)", 0, WIDTH, text_var.get('x', WIDTH // 2), key=f"x_{selected_text_idx}")
-            st.session_state.text_variations[selected_text_idx]['x'] = pos_x
-        with col9:
-            pos_y = st.slider("縦位置 (Y)", 0, HEIGHT, text_var.get('y', HEIGHT // 2), key=f"y_{selected_text_idx}")
-            st.session_state.text_variations[selected_text_idx]['y'] = pos_y
-
-        if st.button("中央に配置", key=f"center_{selected_text_idx}", use_container_width=True):
-            st.session_state.text_variations[selected_text_idx]['x'] = WIDTH // 2
-            st.session_state.text_variations[selected_text_idx]['y'] = HEIGHT // 2
-            st.rerun()
-
-        # アイコン増加専用
-        if use_icon_increase:
-            with st.expander("アイコン増加専用設定", expanded=True):
-                st.caption("※ アイコン増加テンプレート使用時のみ有効")
-                col1, col2, col3 = st.columns(3)
-                with col1:
-                    icon_size = st.slider("文字サイズ", 20, 80, text_var.get('icon_size', 40), key=f"icon_size_{selected_text_idx}")
-                    st.session_state.text_variations[selected_text_idx]['icon_size'] = icon_size
-                with col2:
-                    icon_char_spacing = st.slider("文字間", -10, 50, text_var.get('icon_char_spacing', 0), key=f"icon_char_{selected_text_idx}")
-                    st.session_state.text_variations[selected_text_idx]['icon_char_spacing'] = icon_char_spacing
-                with col3:
-                    icon_aspect_ratio = st.slider("縦横比", 50, 200, int(text_var.get('icon_aspect_ratio', 1.0) * 100), key=f"icon_aspect_{selected_text_idx}") / 100
-                    st.session_state.text_variations[selected_text_idx]['icon_aspect_ratio'] = icon_aspect_ratio
-                
-                col4, col5, col6 = st.columns(3)
-                with col4:
-                    icon_row_spacing = st.slider("行間隔", 30, 100, text_var.get('icon_row_spacing', 50), key=f"icon_row_{selected_text_idx}")
-                    st.session_state.text_variations[selected_text_idx]['icon_row_spacing'] = icon_row_spacing
-                with col5:
-                    icon_x = st.slider("開始X座標", 0, WIDTH, text_var.get('icon_x', 120), key=f"icon_x_{selected_text_idx}")
-                    st.session_state.text_variations[selected_text_idx]['icon_x'] = icon_x
-                with col6:
-                    icon_y = st.slider("開始Y座標", 0, HEIGHT, text_var.get('icon_y', 300), key=f"icon_y_{selected_text_idx}")
-                    st.session_state.text_variations[selected_text_idx]['icon_y'] = icon_y
-
-    # --- タブ3: 画像設定 ---
-    with tab_image:
-        st.markdown('<div class="simple-header">画像のアップロードと調整</div>', unsafe_allow_html=True)
-        for var_idx, img_var in enumerate(st.session_state.image_variations):
-            uploaded_file = st.file_uploader(
-                "画像を選択", 
-                type=['png', 'jpg', 'jpeg', 'webp'],
-                key=f"img_{var_idx}"
-            )
-            
-            if uploaded_file is not None:
-                uploaded_img = Image.open(uploaded_file)
-                st.session_state.image_variations[var_idx]['image'] = uploaded_img
-                
-                if st.session_state.image_variations[var_idx]['original_width'] == 100:
-                    st.session_state.image_variations[var_idx]['original_width'] = uploaded_img.width
-                    st.session_state.image_variations[var_idx]['original_height'] = uploaded_img.height
-                
-                col1, col2, col3 = st.columns(3)
-                with col1:
-                    img_scale = st.slider("サイズ倍率", 10, 200, int(img_var.get('scale', 1.0) * 100), key=f"img_scale_{var_idx}") / 100
-                    st.session_state.image_variations[var_idx]['scale'] = img_scale
-                with col2:
-                    pos_x = st.slider("X座標", 0, WIDTH, img_var.get('x', WIDTH // 2), key=f"img_x_{var_idx}")
-                    st.session_state.image_variations[var_idx]['x'] = pos_x
-                with col3:
-                    pos_y = st.slider("Y座標", 0, HEIGHT, img_var.get('y', HEIGHT // 2), key=f"img_y_{var_idx}")
-                    st.session_state.image_variations[var_idx]['y'] = pos_y
-
-    # --- タブ4: 注釈設定 ---
-    with tab_annot:
-        col_btn1, col_btn2 = st.columns(2)
-        with col_btn1:
-            if st.button("＋ 通常注釈追加", use_container_width=True):
-                st.session_state.annotation_variations.append({
-                    'text': default_annot_text, 'font': 'ゴシック', 'weight': 'W7', 'size': 10,
-                    'color': '#000000', 'x': 10, 'y': 390, 'enabled': True, 'is_neumo': False, 'aspect_ratio': 1.0
-                })
-                st.rerun()
-        with col_btn2:
-            if st.button("＋ ニューモV専用追加", use_container_width=True):
-                st.session_state.annotation_variations.append({
-                    'text': default_neumo_text, 'font': 'ゴシック', 'weight': 'W7', 'size': 10,
-                    'color': '#000000', 'x': 10, 'y': 390, 'enabled': True, 'is_neumo': True, 'aspect_ratio': 1.0
-                })
-                st.rerun()
-        
-        st.markdown("<br>", unsafe_allow_html=True)
+# 出力タブ以外の設定タブとプレビュー列を1つのフラグメントにして、設定を操作したときはそれだけを再実行する
+# （CSS・セッションの初期化・出力タブ・生成結果は再実行しない。変更のないプレビューカードは preview_cache から取り出すだけ）
+# 出力タブの表示が変わる操作（テンプレートの選択・ニューモV専用注釈の追加と削除）だけアプリ全体を再実行する
+SETTINGS_FRAGMENT_KEY = "settings"
 
-        # 注釈リストループ
-        for var_idx, annot_var in enumerate(st.session_state.annotation_variations):
-            st.markdown(f'<div class="annotation-item">', unsafe_allow_html=True)
-            
-            col_head_title, col_head_sw = st.columns([3, 1])
-            with col_head_title:
-                title_text = "ニューモV専用注釈" if annot_var.get('is_neumo', False) else f"注釈 #{var_idx + 1}"
-                st.markdown(f"**{title_text}**")
-            with col_head_sw:
-                enabled = st.toggle("有効", value=annot_var['enabled'], key=f"annot_en_{var_idx}")
-                st.session_state.annotation_variations[var_idx]['enabled'] = enabled
-
-            col1, col2 = st.columns([3, 1])
-            with col1:
-                new_text = st.text_input("テキスト内容", value=annot_var['text'], key=f"annot_{var_idx}", label_visibility="collapsed")
-                st.session_state.annotation_variations[var_idx]['text'] = new_text
-            with col2:
-                if len(st.session_state.annotation_variations) > 1:
-                    if st.button("削除", key=f"del_annot_{var_idx}", use_container_width=True):
-                        st.session_state.annotation_variations.pop(var_idx)
-                        st.rerun()
-
-            col3, col4, col5, col6 = st.columns(4)
-            with col3:
-                font = st.selectbox("フォント", ["ゴシック", "明朝"],
-                                    index=["ゴシック", "明朝"].index(annot_var.get('font', 'ゴシック')),
-                                   key=f"annot_font_{var_idx}")
-                st.session_state.annotation_variations[var_idx]['font'] = font
-            with col4:
-                size = st.number_input("サイズ", 5, 100, annot_var.get('size', 10), key=f"annot_size_{var_idx}")
-                st.session_state.annotation_variations[var_idx]['size'] = size
-            with col5:
-                pos_x = st.number_input("X", 0, WIDTH, annot_var.get('x', 10), key=f"annot_x_{var_idx}")
-                st.session_state.annotation_variations[var_idx]['x'] = pos_x
-            with col6:
-                pos_y = st.number_input("Y", 0, HEIGHT, annot_var.get('y', 390), key=f"annot_y_{var_idx}")
-                st.session_state.annotation_variations[var_idx]['y'] = pos_y
-            
-            # 注釈用の縦横比スライダー
-            aspect = st.slider("縦横比", 50, 200, int(annot_var.get('aspect_ratio', 1.0) * 100), key=f"annot_aspect_{var_idx}") / 100
-            st.session_state.annotation_variations[var_idx]['aspect_ratio'] = aspect
-            
-            st.markdown('</div>', unsafe_allow_html=True)
+# 設定パネルのウィジェットの on_change / on_click に渡し、再実行を設定のフラグメントに限定する
+# （フラグメント内のウィジェットの既定と同じ動作。AppTest でもフラグメントだけが再実行される）
+def rerun_settings():
+    st.rerun(SETTINGS_FRAGMENT_KEY)
 
-    # --- タブ5: 出力設定 ---
-    with tab_output:
-        col_name1, col_name2 = st.columns(2)
-        with col_name1:
-            product_name = st.text_input("商材名", value="商材名", placeholder="商材名を入力")
-        with col_name2:
-            custom_name = st.text_input("ファイル識別名", value="名前", placeholder="識別名を入力")
-        
-        # フォルダ名設定（ZIP用） - デフォルト値を自動生成
-        default_folder_name = f"{datetime.now().strftime('%Y%m%d')}_{product_name}_APNG_枠点滅_素材_{custom_name}"
-        save_folder_name = st.text_input("保存フォルダ名", value=default_folder_name, placeholder="フォルダ名を入力")
-        
-        st.caption(f"フォルダ構成: {save_folder_name}/...")
-        
-        has_neumo_annot = any(annot.get('is_neumo', False) for annot in st.session_state.annotation_variations)
-        if has_neumo_annot:
-            st.info("ニューモV専用注釈が含まれているため、一部ファイルの商材名は「new5」になります。")
-        
-        st.markdown("<br>", unsafe_allow_html=True)
-        
-        # 生成ボタン
-        if st.button("APNGを一括生成する", type="primary", disabled=not (use_red_border or use_corner_icon or use_icon_increase), use_container_width=True):
-            generated_files = []
-            date_str = datetime.now().strftime("%y%m%d")
-            
-            # パラメータ取得（セッションステートから）
-            border_width_red = st.session_state.get('border_width_red', 13)
-            border_colors = st.session_state.get('border_colors', ["red"])
-            num_frames_red = st.session_state.get('num_frames_red', 5)
-            loop_count_red = st.session_state.get('loop_count_red', 4)
-            
-            icon_size_corner = st.session_state.get('icon_size_corner', 85)
-            icon_names = st.session_state.get('icon_names', ["check.png"])
-            num_frames_corner = st.session_state.get('num_frames_corner', 5)
-            loop_count_corner = st.session_state.get('loop_count_corner', 4)
-            
-            icon_size_increase = st.session_state.get('icon_size_increase', 100)
-            icon_names_increase = st.session_state.get('icon_names_increase', ["check.png"])
-            num_frames_increase = st.session_state.get('num_frames_increase', 5)
-            loop_count_increase = st.session_state.get('loop_count_increase', 4)
-            
-            enabled_annotations = [annot for annot in st.session_state.annotation_variations if annot.get('enabled', True)]
-            
-            # 削除ボタン形式に変更したため、リストにあるものは全て「有効」とみなす
-            enabled_texts = st.session_state.text_variations
-            
-            if len(enabled_annotations) == 0:
-                st.error("有効な注釈がありません。注釈リストでスイッチをONにしてください。")
-            elif len(enabled_texts) == 0:
-                st.error("有効なテキストがありません。テキスト設定で追加してください。")
-            else:
-                with st.spinner("APNGを生成中..."):
-                    for annot_var in enabled_annotations:
-                        prod_name = "new5" if annot_var.get('is_neumo', False) else product_name
-                        
-                        border_counter = 1
-                        icon_counter = 1
-                        increase_counter = 1
-                        
-                        for text_var in enabled_texts:
-                            for img_idx in range(len(st.session_state.image_variations)):
-                                variant_text_elements = [text_var]
-                                variant_annotation_elements = [annot_var]
-                                variant_uploaded_image = st.session_state.image_variations[img_idx]['image']
-                                variant_image_config = st.session_state.image_variations[img_idx]
-                                
-                                # 赤枠点滅生成
-                                if use_red_border:
-                                    for border_color in border_colors:
-                                        frames = create_red_border_blink_frames(
-                                            WIDTH, HEIGHT, variant_text_elements, variant_annotation_elements,
-                                            variant_uploaded_image, variant_image_config,
-                                            border_width=border_width_red, 
-                                            border_color=border_color, 
-                                            num_frames=num_frames_red
-                                        )
-                                        apng_data = save_apng(frames, num_frames=num_frames_red, num_plays=loop_count_red)
-                                        filename = f"{date_str}_{prod_name}_APNG_枠点滅_素材_{custom_name}_{border_counter:02d}.png"
-                                        generated_files.append((filename, apng_data))
-                                        border_counter += 1
-                                
-                                # 4隅アイコン生成
-                                if use_corner_icon:
-                                    for icon_name in icon_names:
-                                        frames = create_corner_icon_blink_frames(
-                                            WIDTH, HEIGHT, variant_text_elements, variant_annotation_elements,
-                                            variant_uploaded_image, variant_image_config,
-                                            icon_name=icon_name,
-                                            icon_size=icon_size_corner,
-                                            num_frames=num_frames_corner
-                                        )
-                                        apng_data = save_apng(frames, num_frames=num_frames_corner, num_plays=loop_count_corner)
-                                        filename = f"{date_str}_{prod_name}_APNG_ikon点滅_素材_{custom_name}_{icon_counter:02d}.png"
-                                        generated_files.append((filename, apng_data))
-                                        icon_counter += 1
-                                
-                                # アイコン増加生成
-                                if use_icon_increase:
-                                    for icon_name in icon_names_increase:
-                                        frames = create_icon_increase_frames(
-                                            WIDTH, HEIGHT, text_var, variant_annotation_elements,
-                                            variant_uploaded_image, variant_image_config,
-                                            icon_name=icon_name,
-                                            icon_size=icon_size_increase,
-                                            num_frames=num_frames_increase
-                                        )
-                                        apng_data = save_apng(frames, num_frames=num_frames_increase, num_plays=loop_count_increase)
-                                        filename = f"{date_str}_{prod_name}_APNG_ikon増加_素材_{custom_name}_{increase_counter:02d}.png"
-                                        generated_files.append((filename, apng_data))
-                                        increase_counter += 1
-                    
-                    st.success(f"{len(generated_files)}個のAPNGが完成しました！")
-                    
-                    # ZIPダウンロードボタン
-                    if len(generated_files) > 0:
-                        zip_buffer = io.BytesIO()
-                        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                            for filename, data in generated_files:
-                                # フォルダ名を付与してZIPに追加
-                                zip_file.writestr(f"{save_folder_name}/{filename}", data)
-                        
-                        zip_buffer.seek(0)
-                        st.download_button(
-                            label=f"まとめてZIPでダウンロード ({len(generated_files)}個)",
-                            data=zip_buffer.getvalue(),
-                            file_name=f"{date_str}_{product_name}_APNG_all.zip",
-                            mime="application/zip",
-                            use_container_width=True,
-                            type="primary"
-                        )
-
-                    # 個別リスト
-                    with st.expander("個別ファイルダウンロード", expanded=False):
-                        for file_idx, (filename, data) in enumerate(generated_files):
-                            file_size_kb = len(data) / 1024
-                            col1, col2 = st.columns([4, 1])
-                            with col1:
-                                st.text(f"{filename} ({file_size_kb:.1f} KB)")
-                            with col2:
-                                st.download_button("DL", data=data, file_name=filename, mime="image/png", key=f"dl_{file_idx}", use_container_width=True)
-
-# ==========================================
-# 右カラム：プレビューエリア（Sticky + 横スクロール）
-# ==========================================
-with col_preview:
-    st.markdown('<div class="preview-box">', unsafe_allow_html=True)
-    st.markdown("### PREVIEW")
-    st.caption("設定変更はリアルタイムに反映されます")
-    
+# プレビュー列を描く
+def preview_panel():
     preview_annotation_elements = [annot for annot in st.session_state.annotation_variations if annot['enabled']]
+    preview_image_config = resolve_image_variation(st.session_state.image_variations[0])
     
+    use_red_border = st.session_state.use_red_border
+    use_corner_icon = st.session_state.use_corner_icon
+    use_icon_increase = st.session_state.use_icon_increase
     preview_count = sum([use_red_border, use_corner_icon, use_icon_increase])
     
     if preview_count == 0:
@@ -1242,15 +392,12 @@ with col_preview:
             p_border_color = p_border_colors[0] if p_border_colors else "red"
             
             for idx, text_var in enumerate(enabled_text_variations):
-                preview_img = create_preview_image(
-                    [text_var], preview_annotation_elements,
-                    st.session_state.image_variations[0]['image'],
-                    st.session_state.image_variations[0],
-                    "赤枠点滅", scale=0.5, border_width=p_border_width, border_color=p_border_color
+                data_uri = get_preview_data_uri(
+                    text_var, preview_annotation_elements, preview_image_config,
+                    "赤枠点滅", border_width=p_border_width, border_color=p_border_color
                 )
-                b64_img = image_to_base64(preview_img)
                 text_label = f"Text {st.session_state.text_variations.index(text_var) + 1}"
-                html_content += f'<div class="scroll-item"><img src="data:image/png;base64,{b64_img}" /><div class="scroll-item-caption">{text_label}</div></div>'
+                html_content += f'<div class="scroll-item"><img src="{data_uri}" /><div class="scroll-item-caption">{text_label}</div></div>'
             html_content += '</div>'
             st.markdown(html_content, unsafe_allow_html=True)
         
@@ -1264,15 +411,12 @@ with col_preview:
             p_icon_name = p_icon_names[0] if p_icon_names else "check.png"
             
             for idx, text_var in enumerate(enabled_text_variations):
-                preview_img = create_preview_image(
-                    [text_var], preview_annotation_elements,
-                    st.session_state.image_variations[0]['image'],
-                    st.session_state.image_variations[0],
-                    "4隅アイコン点滅", scale=0.5, icon_size=p_icon_size, icon_name=p_icon_name
+                data_uri = get_preview_data_uri(
+                    text_var, preview_annotation_elements, preview_image_config,
+                    "4隅アイコン点滅", icon_size=p_icon_size, icon_name=p_icon_name
                 )
-                b64_img = image_to_base64(preview_img)
                 text_label = f"Text {st.session_state.text_variations.index(text_var) + 1}"
-                html_content += f'<div class="scroll-item"><img src="data:image/png;base64,{b64_img}" /><div class="scroll-item-caption">{text_label}</div></div>'
+                html_content += f'<div class="scroll-item"><img src="{data_uri}" /><div class="scroll-item-caption">{text_label}</div></div>'
             html_content += '</div>'
             st.markdown(html_content, unsafe_allow_html=True)
         
@@ -1286,19 +430,623 @@ with col_preview:
             
             html_content = '<div class="scroll-container">'
             for idx, text_var in enumerate(enabled_text_variations):
-                preview_img = create_preview_image(
-                    [text_var], preview_annotation_elements,
-                    st.session_state.image_variations[0]['image'],
-                    st.session_state.image_variations[0],
-                    "アイコン増加", 
-                    scale=0.5, 
-                    icon_size=p_icon_size_inc,
-                    icon_name=p_icon_name_inc
+                data_uri = get_preview_data_uri(
+                    text_var, preview_annotation_elements, preview_image_config,
+                    "アイコン増加", icon_size=p_icon_size_inc, icon_name=p_icon_name_inc
                 )
-                b64_img = image_to_base64(preview_img)
                 text_label = f"Text {st.session_state.text_variations.index(text_var) + 1}"
-                html_content += f'<div class="scroll-item"><img src="data:image/png;base64,{b64_img}" /><div class="scroll-item-caption">{text_label}</div></div>'
+                html_content += f'<div class="scroll-item"><img src="{data_uri}" /><div class="scroll-item-caption">{text_label}</div></div>'
             html_content += '</div>'
             st.markdown(html_content, unsafe_allow_html=True)
+
+# --- タブ1: テンプレート選択 ---
+def template_settings_panel():
+    # テンプレートの選択が変わると出力タブの生成ボタンも変わるため、そのときだけアプリ全体を再実行する
+    previous_templates = (st.session_state.use_red_border, st.session_state.use_corner_icon, st.session_state.use_icon_increase)
+    st.markdown('<div class="simple-header">使用するテンプレート</div>', unsafe_allow_html=True)
+    col_t1, col_t2, col_t3 = st.columns(3)
+    with col_t1:
+        use_red_border = st.checkbox("赤枠点滅", value=st.session_state.use_red_border, key="chk_red", on_change=rerun_settings)
+    with col_t2:
+        use_corner_icon = st.checkbox("4隅アイコン", value=st.session_state.use_corner_icon, key="chk_corner", on_change=rerun_settings)
+    with col_t3:
+        use_icon_increase = st.checkbox("アイコン増加", value=st.session_state.use_icon_increase, key="chk_increase", on_change=rerun_settings)
+    
+    st.session_state.use_red_border = use_red_border
+    st.session_state.use_corner_icon = use_corner_icon
+    st.session_state.use_icon_increase = use_icon_increase
+    
+    st.markdown('<div class="simple-header">詳細パラメータ</div>', unsafe_allow_html=True)
+    if use_red_border:
+        st.caption("赤枠点滅の設定")
+        col1, col2 = st.columns(2)
+        with col1: 
+            st.slider("枠線の太さ", 15, 45, st.session_state.border_width_red, key="border_width_red", on_change=rerun_settings)
+        with col2: 
+            st.multiselect("枠線の色", ["red", "blue", "green", "black", "orange"], default=["red"], key="border_colors", on_change=rerun_settings)
+        
+        with st.expander("詳細設定（フレーム数・ループ数）", expanded=False):
+            col3, col4 = st.columns(2)
+            with col3: st.slider("フレーム数", 5, 20, 5, key="num_frames_red", on_change=rerun_settings)
+            with col4: st.selectbox("ループ数", [1, 2, 3, 4], index=3, key="loop_count_red", on_change=rerun_settings)
+        st.divider()
+    
+    if use_corner_icon:
+        st.caption("4隅アイコンの設定")
+        col1, col2 = st.columns(2)
+        with col1: 
+            st.slider("アイコンサイズ", 20, 150, st.session_state.icon_size_corner, key="icon_size_corner", on_change=rerun_settings)
+        with col2: 
+            st.multiselect("アイコン種類", ["check.png", "red_check.png", "！.png", "！？.png"], default=["check.png"], key="icon_names", on_change=rerun_settings)
+        
+        with st.expander("詳細設定（フレーム数・ループ数）", expanded=False):
+            col3, col4 = st.columns(2)
+            with col3: st.slider("フレーム数", 5, 20, 5, key="num_frames_corner", on_change=rerun_settings)
+            with col4: st.selectbox("ループ数", [1, 2, 3, 4], index=3, key="loop_count_corner", on_change=rerun_settings)
+        st.divider()
+    
+    if use_icon_increase:
+        st.caption("アイコン増加の設定")
+        col1, col2 = st.columns(2)
+        with col1: 
+            st.slider("アイコンサイズ(増)", 20, 150, st.session_state.icon_size_increase, key="icon_size_increase", on_change=rerun_settings)
+        with col2: 
+            st.multiselect("アイコン種類(増)", ["check.png", "red_check.png", "！.png", "！？.png"], default=["check.png"], key="icon_names_increase", on_change=rerun_settings)
+        
+        with st.expander("詳細設定（フレーム数・ループ数）", expanded=False):
+            col3, col4 = st.columns(2)
+            with col3: st.slider("フレーム数", 3, 10, 5, key="num_frames_increase", on_change=rerun_settings)
+            with col4: st.selectbox("ループ数", [1, 2, 3, 4], index=3, key="loop_count_increase", on_change=rerun_settings)
+    
+    if (use_red_border, use_corner_icon, use_icon_increase) != previous_templates:
+        st.rerun()
+
+# --- タブ2: テキスト設定 ---
+def text_settings_panel():
+    # 第1：Text選択ラジオボタン
+    text_options = [f"Text {i+1}" for i in range(len(st.session_state.text_variations))]
+    selected_text_idx = st.radio("編集するテキストを選択", range(len(text_options)), format_func=lambda x: text_options[x], horizontal=True, index=st.session_state.get('selected_text_tab', 0), on_change=rerun_settings)
+    st.session_state.selected_text_tab = selected_text_idx
+    
+    # 第2：テキストを追加ボタン
+    if st.button("テキストを追加", key="tab_btn_add", use_container_width=True, on_click=rerun_settings):
+        st.session_state.text_variations.append({
+            'text': '新しいテキスト',
+            'font': 'ゴシック',
+            'weight': 'W7',
+            'size': 100,
+            'color': '#000000',
+            'char_spacing': 0,
+            'line_spacing': 0,
+            'aspect_ratio': 1.0,
+            'x': WIDTH // 2,
+            'y': HEIGHT // 2,
+            'enabled': True,
+            'icon_size': 40,
+            'icon_x': 74,
+            'icon_y': 320,
+            'icon_char_spacing': 0,
+            'icon_aspect_ratio': 1.0,
+            'icon_row_spacing': 62
+        })
+        st.session_state.selected_text_tab = len(st.session_state.text_variations) - 1
+        st.rerun(scope="fragment")
+
+    text_var = st.session_state.text_variations[selected_text_idx]
+    st.markdown("<br>", unsafe_allow_html=True)
+    
+    # 第3：テキスト入力欄
+    new_text = st.text_area("テキスト内容", value=text_var['text'], height=80, key=f"textarea_{selected_text_idx}", placeholder="テキストを入力...", on_change=rerun_settings)
+    st.session_state.text_variations[selected_text_idx]['text'] = new_text
+    
+    # 削除ボタン（表示トグルの代わり）
+    if st.button("このテキスト設定を削除", key=f"del_txt_{selected_text_idx}", use_container_width=True, on_click=rerun_settings):
+        if len(st.session_state.text_variations) > 1:
+            st.session_state.text_variations.pop(selected_text_idx)
+            st.session_state.selected_text_tab = max(0, selected_text_idx - 1)
+            st.rerun(scope="fragment")
+        else:
+            st.warning("最後のテキスト設定は削除できません")
+    
+    st.divider()
+
+    # 第5：フォント、ウェイト（太さ）
+    col1, col2 = st.columns(2)
+    with col1:
+        font = st.selectbox("フォント", ["ゴシック", "明朝"],
+                            index=["ゴシック", "明朝"].index(text_var.get('font', 'ゴシック')),
+                            key=f"font_{selected_text_idx}", on_change=rerun_settings)
+        st.session_state.text_variations[selected_text_idx]['font'] = font
+    with col2:
+        weight = st.selectbox("太さ", ["W3", "W4", "W5", "W6", "W7", "W8", "W9"],
+                                index=["W3", "W4", "W5", "W6", "W7", "W8", "W9"].index(text_var.get('weight', 'W7')),
+                                key=f"weight_{selected_text_idx}", on_change=rerun_settings)
+        st.session_state.text_variations[selected_text_idx]['weight'] = weight
+    
+    # 第6：サイズ、色
+    col3, col4 = st.columns([2, 1])
+    with col3:
+        size = st.slider("サイズ", 50, 200, text_var.get('size', 100), key=f"size_{selected_text_idx}", on_change=rerun_settings)
+        st.session_state.text_variations[selected_text_idx]['size'] = size
+    with col4:
+        color = st.color_picker("色", text_var.get('color', '#000000'), key=f"color_{selected_text_idx}", on_change=rerun_settings)
+        st.session_state.text_variations[selected_text_idx]['color'] = color
+    
+    # 第7：文字間、行間、縦横比
+    col5, col6, col7 = st.columns(3)
+    with col5:
+        char_spacing = st.slider("文字間", -10, 50, text_var.get('char_spacing', 0), key=f"char_{selected_text_idx}", on_change=rerun_settings)
+        st.session_state.text_variations[selected_text_idx]['char_spacing'] = char_spacing
+    with col6:
+        line_spacing = st.slider("行間", -10, 50, text_var.get('line_spacing', 0), key=f"line_{selected_text_idx}", on_change=rerun_settings)
+        st.session_state.text_variations[selected_text_idx]['line_spacing'] = line_spacing
+    with col7:
+        aspect_ratio = st.slider("縦横比", 50, 200, int(text_var.get('aspect_ratio', 1.0) * 100), key=f"aspect_{selected_text_idx}", on_change=rerun_settings) / 100
+        st.session_state.text_variations[selected_text_idx]['aspect_ratio'] = aspect_ratio
+        
+    # 第8：X座標（横）、Y座標（縦）
+    col8, col9 = st.columns(2)
+    with col8:
+        pos_x = st.slider("横位置 (X)", 0, WIDTH, text_var.get('x', WIDTH // 2), key=f"x_{selected_text_idx}", on_change=rerun_settings)
+        st.session_state.text_variations[selected_text_idx]['x'] = pos_x
+    with col9:
+        pos_y = st.slider("縦位置 (Y)", 0, HEIGHT, text_var.get('y', HEIGHT // 2), key=f"y_{selected_text_idx}", on_change=rerun_settings)
+        st.session_state.text_variations[selected_text_idx]['y'] = pos_y
+
+    if st.button("中央に配置", key=f"center_{selected_text_idx}", use_container_width=True, on_click=rerun_settings):
+        st.session_state.text_variations[selected_text_idx]['x'] = WIDTH // 2
+        st.session_state.text_variations[selected_text_idx]['y'] = HEIGHT // 2
+        st.rerun(scope="fragment")
+
+    # アイコン増加専用
+    if st.session_state.use_icon_increase:
+        with st.expander("アイコン増加専用設定", expanded=True):
+            st.caption("※ アイコン増加テンプレート使用時のみ有効")
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                icon_size = st.slider("文字サイズ", 20, 80, text_var.get('icon_size', 40), key=f"icon_size_{selected_text_idx}", on_change=rerun_settings)
+                st.session_state.text_variations[selected_text_idx]['icon_size'] = icon_size
+            with col2:
+                icon_char_spacing = st.slider("文字間", -10, 50, text_var.get('icon_char_spacing', 0), key=f"icon_char_{selected_text_idx}", on_change=rerun_settings)
+                st.session_state.text_variations[selected_text_idx]['icon_char_spacing'] = icon_char_spacing
+            with col3:
+                icon_aspect_ratio = st.slider("縦横比", 50, 200, int(text_var.get('icon_aspect_ratio', 1.0) * 100), key=f"icon_aspect_{selected_text_idx}", on_change=rerun_settings) / 100
+                st.session_state.text_variations[selected_text_idx]['icon_aspect_ratio'] = icon_aspect_ratio
+            
+            col4, col5, col6 = st.columns(3)
+            with col4:
+                icon_row_spacing = st.slider("行間隔", 30, 100, text_var.get('icon_row_spacing', 50), key=f"icon_row_{selected_text_idx}", on_change=rerun_settings)
+                st.session_state.text_variations[selected_text_idx]['icon_row_spacing'] = icon_row_spacing
+            with col5:
+                icon_x = st.slider("開始X座標", 0, WIDTH, text_var.get('icon_x', 120), key=f"icon_x_{selected_text_idx}", on_change=rerun_settings)
+                st.session_state.text_variations[selected_text_idx]['icon_x'] = icon_x
+            with col6:
+                icon_y = st.slider("開始Y座標", 0, HEIGHT, text_var.get('icon_y', 300), key=f"icon_y_{selected_text_idx}", on_change=rerun_settings)
+                st.session_state.text_variations[selected_text_idx]['icon_y'] = icon_y
+
+# --- タブ3: 画像設定 ---
+def image_settings_panel():
+    st.markdown('<div class="simple-header">画像のアップロードと調整</div>', unsafe_allow_html=True)
+    for var_idx, img_var in enumerate(st.session_state.image_variations):
+        uploaded_file = st.file_uploader(
+            "画像を選択", 
+            type=['png', 'jpg', 'jpeg', 'webp'],
+            key=f"img_{var_idx}", on_change=rerun_settings
+        )
+        
+        if uploaded_file is not None:
+            # アップロードごとに1回だけデコードする（再実行のたびに元画像を読み直さない）
+            if img_var.get('upload_id') != uploaded_file.file_id:
+                try:
+                    uploaded_img, (original_width, original_height) = load_upload_image(uploaded_file)
+                except (ValueError, OSError, Image.DecompressionBombError) as e:
+                    st.error(f"画像を読み込めませんでした: {e}")
+                    continue
+                st.session_state.image_variations[var_idx]['image'] = SpillableImage(uploaded_img)
+                session_memory.track(session_id, f"画像{var_idx + 1}", st.session_state.image_variations[var_idx]['image'])
+                st.session_state.image_variations[var_idx]['digest'] = hashlib.sha1(uploaded_file.getvalue()).hexdigest()
+                st.session_state.image_variations[var_idx]['upload_id'] = uploaded_file.file_id
+                
+                if st.session_state.image_variations[var_idx]['original_width'] == 100:
+                    st.session_state.image_variations[var_idx]['original_width'] = original_width
+                    st.session_state.image_variations[var_idx]['original_height'] = original_height
+            
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                img_scale = st.slider("サイズ倍率", 10, int(MAX_IMAGE_SCALE * 100), int(img_var.get('scale', 1.0) * 100), key=f"img_scale_{var_idx}", on_change=rerun_settings) / 100
+                st.session_state.image_variations[var_idx]['scale'] = img_scale
+            with col2:
+                pos_x = st.slider("X座標", 0, WIDTH, img_var.get('x', WIDTH // 2), key=f"img_x_{var_idx}", on_change=rerun_settings)
+                st.session_state.image_variations[var_idx]['x'] = pos_x
+            with col3:
+                pos_y = st.slider("Y座標", 0, HEIGHT, img_var.get('y', HEIGHT // 2), key=f"img_y_{var_idx}", on_change=rerun_settings)
+                st.session_state.image_variations[var_idx]['y'] = pos_y
+
+# --- タブ4: 注釈設定 ---
+def annotation_settings_panel():
+    col_btn1, col_btn2 = st.columns(2)
+    with col_btn1:
+        if st.button("＋ 通常注釈追加", use_container_width=True, on_click=rerun_settings):
+            st.session_state.annotation_variations.append({
+                'text': default_annot_text, 'font': 'ゴシック', 'weight': 'W7', 'size': 10,
+                'color': '#000000', 'x': 10, 'y': 390, 'enabled': True, 'is_neumo': False, 'aspect_ratio': 1.0
+            })
+            st.rerun(scope="fragment")
+    with col_btn2:
+        if st.button("＋ ニューモV専用追加", use_container_width=True, on_click=rerun_settings):
+            st.session_state.annotation_variations.append({
+                'text': default_neumo_text, 'font': 'ゴシック', 'weight': 'W7', 'size': 10,
+                'color': '#000000', 'x': 10, 'y': 390, 'enabled': True, 'is_neumo': True, 'aspect_ratio': 1.0
+            })
+            # 出力タブの案内が変わるのでアプリ全体を再実行する
+            st.rerun()
     
-    st.markdown('</div>', unsafe_allow_html=True)
\ No newline at end of file
+    st.markdown("<br>", unsafe_allow_html=True)
+
+    # 注釈リストループ
+    for var_idx, annot_var in enumerate(st.session_state.annotation_variations):
+        st.markdown(f'<div class="annotation-item">', unsafe_allow_html=True)
+        
+        col_head_title, col_head_sw = st.columns([3, 1])
+        with col_head_title:
+            title_text = "ニューモV専用注釈" if annot_var.get('is_neumo', False) else f"注釈 #{var_idx + 1}"
+            st.markdown(f"**{title_text}**")
+        with col_head_sw:
+            enabled = st.toggle("有効", value=annot_var['enabled'], key=f"annot_en_{var_idx}", on_change=rerun_settings)
+            st.session_state.annotation_variations[var_idx]['enabled'] = enabled
+
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            new_text = st.text_input("テキスト内容", value=annot_var['text'], key=f"annot_{var_idx}", label_visibility="collapsed", on_change=rerun_settings)
+            st.session_state.annotation_variations[var_idx]['text'] = new_text
+        with col2:
+            if len(st.session_state.annotation_variations) > 1:
+                if st.button("削除", key=f"del_annot_{var_idx}", use_container_width=True, on_click=rerun_settings):
+                    st.session_state.annotation_variations.pop(var_idx)
+                    # ニューモV専用注釈を消した場合は出力タブの案内が変わるのでアプリ全体を再実行する
+                    if annot_var.get('is_neumo', False):
+                        st.rerun()
+                    st.rerun(scope="fragment")
+
+        col3, col4, col5, col6 = st.columns(4)
+        with col3:
+            font = st.selectbox("フォント", ["ゴシック", "明朝"],
+                                index=["ゴシック", "明朝"].index(annot_var.get('font', 'ゴシック')),
+                               key=f"annot_font_{var_idx}", on_change=rerun_settings)
+            st.session_state.annotation_variations[var_idx]['font'] = font
+        with col4:
+            size = st.number_input("サイズ", 5, 100, annot_var.get('size', 10), key=f"annot_size_{var_idx}", on_change=rerun_settings)
+            st.session_state.annotation_variations[var_idx]['size'] = size
+        with col5:
+            pos_x = st.number_input("X", 0, WIDTH, annot_var.get('x', 10), key=f"annot_x_{var_idx}", on_change=rerun_settings)
+            st.session_state.annotation_variations[var_idx]['x'] = pos_x
+        with col6:
+            pos_y = st.number_input("Y", 0, HEIGHT, annot_var.get('y', 390), key=f"annot_y_{var_idx}", on_change=rerun_settings)
+            st.session_state.annotation_variations[var_idx]['y'] = pos_y
+        
+        # 注釈用の縦横比スライダー
+        aspect = st.slider("縦横比", 50, 200, int(annot_var.get('aspect_ratio', 1.0) * 100), key=f"annot_aspect_{var_idx}", on_change=rerun_settings) / 100
+        st.session_state.annotation_variations[var_idx]['aspect_ratio'] = aspect
+        
+        st.markdown('</div>', unsafe_allow_html=True)
+
+# 出力タブ以外の設定タブとプレビュー列（アプリ全体の再実行ではタブとプレビュー列を作った後に呼ぶ）
+# 設定パネルがセッションステートを更新し終えてから、同じ再実行の中でプレビューを描く
+@st.fragment(key=SETTINGS_FRAGMENT_KEY)
+def settings_panels():
+    start = time.perf_counter()
+    with tab_template:
+        template_settings_panel()
+    with tab_text:
+        text_settings_panel()
+    with tab_image:
+        image_settings_panel()
+    with tab_annot:
+        annotation_settings_panel()
+    # フラグメントだけの再実行でも操作のあったセッションとして記録する
+    session_memory.touch(session_id)
+    with col_preview:
+        preview_panel()
+    # 設定の操作からプレビューの描き直しまでにかかった時間（目標は100ミリ秒未満）
+    st.session_state.settings_rerun_seconds = time.perf_counter() - start
+
+# 一括生成の結果（進捗・ダウンロード）
+# polling: 生成中に呼ばれた（一定間隔で再実行される）場合は真
+def batch_results_panel(polling):
+    # 生成結果（再実行やダウンロード後も表示を保つため、バッチIDをセッションに保持）
+    batch_output = st.session_state.get('batch_output')
+    active_batch = batch_queue.get(batch_output['batch_id']) if batch_output else None
+    if batch_output and active_batch is None:
+        # 保持期間を過ぎて破棄された
+        st.session_state.pop('batch_output')
+    if active_batch:
+        archive = active_batch.archive
+        finished_files = list(archive.files)
+        batch_stats = active_batch.batch_stats
+        file_stats = {stats['filename']: stats for stats in batch_stats['files']} if batch_stats else {}
+        
+        if not active_batch.finished:
+            if active_batch.status == BATCH_QUEUED:
+                progress_text = f"順番待ち中...（実行中・待機中のバッチ {batch_queue.active_count()}件）"
+            else:
+                progress_text = f"APNGを生成中... {active_batch.completed_files} / {active_batch.total_files}個"
+            st.progress(active_batch.progress, text=progress_text)
+            if st.button("生成を中止", key="cancel_batch", use_container_width=True):
+                active_batch.cancel()
+        elif active_batch.status == BATCH_DONE:
+            st.success(f"{len(finished_files)}個のAPNGが完成しました！")
+        elif active_batch.status == BATCH_CANCELLED:
+            st.warning(f"生成を中止しました（{active_batch.total_files}個中 {len(finished_files)}個完成）")
+        else:
+            st.error(f"生成中にエラーが発生しました: {active_batch.error}")
+        if archive.output_path:
+            st.caption(f"保存先: {archive.output_path}")
+        
+        if batch_stats:
+            cache_stats = batch_stats['cache']
+            truecolor_total = sum(stats.get('truecolor_bytes', 0) for stats in file_stats.values())
+            if truecolor_total:
+                palette_total = sum(stats['bytes'] for stats in file_stats.values())
+                st.caption(f"パレット化による削減: {truecolor_total / 1024:.1f} KB → {palette_total / 1024:.1f} KB（{1 - palette_total / truecolor_total:.1%} 削減）")
+            font_stats = cache_stats.get('font')
+            glyph_stats = cache_stats.get('glyph')
+            asset_stats = cache_stats.get('asset')
+            render_cache_stats = batch_stats.get('render_cache')
+            if render_cache_stats:
+                st.caption(f"生成キャッシュ: 今回 再利用 {render_cache_stats['batch_hits']} / 新規生成 {render_cache_stats['batch_misses']}"
+                           f"（{render_cache_stats['size']}件・{render_cache_stats['bytes'] / 1024 / 1024:.1f} MB / 上限 {render_cache_stats['max_bytes'] / 1024 / 1024:.0f} MB、"
+                           f"累計ヒット率 {render_cache_stats['hit_rate']:.1%}）")
+            if font_stats:
+                st.caption(f"フォントキャッシュ: ヒット {font_stats['hits']} / ミス {font_stats['misses']}（{font_stats['size']}件保持）")
+                st.caption(f"グリフキャッシュ: ヒット率 {glyph_stats['hit_rate']:.1%}（{glyph_stats['size']}件・{glyph_stats['bytes'] / 1024 / 1024:.1f} MB保持）")
+                st.caption(f"画像キャッシュ: ヒット率 {asset_stats['hit_rate']:.1%}（{asset_stats['size']}件・{asset_stats['bytes'] / 1024 / 1024:.1f} MB保持）")
+        
+        # ZIPダウンロードボタン（生成の終了後。データはクリック時にだけ読み出す）
+        if active_batch.finished and len(finished_files) > 0:
+            st.download_button(
+                label=f"まとめてZIPでダウンロード ({len(finished_files)}個・{archive.zip_size / 1024 / 1024:.1f} MB)",
+                data=archive.read_zip,
+                file_name=batch_output['zip_name'],
+                mime="application/zip",
+                use_container_width=True,
+                type="primary"
+            )
+        
+        # 処理時間の内訳（生成の終了後に1回だけ集計）
+        if batch_output['timing_report'] is None and active_batch.timings is not None and batch_stats:
+            batch_output['timing_report'] = build_timing_report(active_batch.timings, batch_stats['timings'],
+                                                                dict(batch_output['timing_settings'], files=len(finished_files),
+                                                                     encode_threads=batch_stats['encode_threads']))
+        timing_report = batch_output['timing_report']
+        if timing_report:
+            with st.expander("処理時間の内訳", expanded=True):
+                handler_timings = timing_report['handler']
+                jobs_total = timing_report['jobs_total']
+                st.caption(f"全体 {handler_timings['total_ms'] / 1000:.2f} 秒"
+                           f"（作業単位 {len(timing_report['jobs'])}件の合計 {jobs_total['total_ms'] / 1000:.2f} 秒）")
+                col_timing1, col_timing2 = st.columns(2)
+                with col_timing1:
+                    st.markdown("**全体（このプロセス）**")
+                    st.dataframe(timing_rows(handler_timings), hide_index=True, use_container_width=True)
+                with col_timing2:
+                    st.markdown("**作業単位の合計**")
+                    st.dataframe(timing_rows(jobs_total), hide_index=True, use_container_width=True)
+                slowest_jobs = sorted(timing_report['jobs'], key=lambda job: -job['total_ms'])[:5]
+                if slowest_jobs:
+                    st.markdown("**時間のかかった作業単位**")
+                    st.dataframe([
+                        {'テンプレート': job['template_type'], 'ファイル': ", ".join(job['files']), 'ms': round(job['total_ms'], 1)}
+                        for job in slowest_jobs
+                    ], hide_index=True, use_container_width=True)
+                st.download_button(
+                    "内訳をJSONでダウンロード",
+                    data=functools.partial(json.dumps, timing_report, ensure_ascii=False, indent=2, default=str),
+                    file_name=f"{archive.folder_name}_timings.json",
+                    mime="application/json",
+                    use_container_width=True,
+                )
+
+        # 個別リスト（生成中も完成したファイルからダウンロードできる）
+        with st.expander(f"個別ファイルダウンロード（{len(finished_files)}個）", expanded=False):
+            for file_idx, (filename, file_bytes) in enumerate(finished_files):
+                file_size_kb = file_bytes / 1024
+                size_label = f"{file_size_kb:.1f} KB"
+                truecolor_bytes = file_stats.get(filename, {}).get('truecolor_bytes')
+                if truecolor_bytes:
+                    size_label += f" / フルカラー {truecolor_bytes / 1024:.1f} KB から {1 - file_bytes / truecolor_bytes:.1%} 削減"
+                col1, col2 = st.columns([4, 1])
+                with col1:
+                    st.text(f"{filename} ({size_label})")
+                with col2:
+                    st.download_button("DL", data=functools.partial(archive.read_file, filename), file_name=filename, mime="image/png", key=f"dl_{file_idx}", use_container_width=True)
+    
+    # 生成が終わったらアプリ全体を再実行し、一定間隔の再実行を止める
+    if polling and (active_batch is None or active_batch.finished):
+        st.rerun()
+
+# レイアウト：左右分割（比率調整）
+col_settings, col_preview = st.columns([1.2, 1])
+
+# ==========================================
+# 右カラム：プレビューエリア（Sticky + 横スクロール）
+# ==========================================
+# プレビュー本体は設定のフラグメント（settings_panels）で描く
+with col_preview:
+    st.markdown('<div class="preview-box">', unsafe_allow_html=True)
+    st.markdown("### PREVIEW")
+    st.caption("設定変更はリアルタイムに反映されます")
+
+# ==========================================
+# 左カラム：設定エリア（タブ化による整理）
+# ==========================================
+with col_settings:
+    # タブの作成
+    tab_template, tab_text, tab_image, tab_annot, tab_output = st.tabs([
+        "テンプレート選択", "テキスト設定", "画像設定", "注釈設定", "出力・保存"
+    ])
+    
+    settings_panels()
+    
+    # --- タブ5: 出力設定 ---
+    with tab_output:
+
+        col_name1, col_name2 = st.columns(2)
+        with col_name1:
+            product_name = st.text_input("商材名", value="商材名", placeholder="商材名を入力")
+        with col_name2:
+            custom_name = st.text_input("ファイル識別名", value="名前", placeholder="識別名を入力")
+        
+        # フォルダ名設定（ZIP用） - デフォルト値を自動生成
+        save_folder_name = st.text_input("保存フォルダ名", value=default_folder_name(product_name, custom_name), placeholder="フォルダ名を入力")
+        
+        st.caption(f"フォルダ構成: {save_folder_name}/...")
+        
+        col_dir1, col_dir2 = st.columns([1, 2])
+        with col_dir1:
+            save_to_dir = st.checkbox("フォルダにも保存", value=False, key="save_to_dir",
+                                      help="ZIPに加えて、保存先ディレクトリ/保存フォルダ名/ にファイルを書き出します")
+        with col_dir2:
+            output_dir = st.text_input("保存先ディレクトリ", value="output", key="output_dir", disabled=not save_to_dir)
+        
+        has_neumo_annot = any(annot.get('is_neumo', False) for annot in st.session_state.annotation_variations)
+        if has_neumo_annot:
+            st.info("ニューモV専用注釈が含まれているため、一部ファイルの商材名は「new5」になります。")
+        
+        output_sizes_text = st.text_input("出力サイズ", value=f"{WIDTH}x{HEIGHT}", key="output_sizes",
+                                          help="「幅x高さ」をカンマ区切りで複数指定できます（例: 600x400, 300x200, 1080x1080）。"
+                                               "縦横比が同じサイズは一番大きいサイズから縮小して作り、縦横比が異なるサイズは配置し直して作ります。"
+                                               "複数指定するとファイル名の末尾にサイズが付きます")
+        
+        col_worker1, col_worker2 = st.columns(2)
+        with col_worker1:
+            max_workers = st.number_input("並列ワーカー数", 1, max(DEFAULT_MAX_WORKERS, 1), DEFAULT_MAX_WORKERS, key="max_workers",
+                                          help="一括生成をCPUコアに分散するプロセス数")
+        with col_worker2:
+            encode_threads = st.number_input("エンコードスレッド数", 1, 16, DEFAULT_ENCODE_THREADS, key="encode_threads",
+                                             help="1つのAPNG内のフレームを並行してPNGエンコードするスレッド数（1で逐次）。並列ワーカー数が1のときだけ使われます")
+        
+        delta_frames = st.checkbox("差分フレームで出力（ファイルサイズ削減）", value=True, key="delta_frames",
+                                   help="2フレーム目以降は前フレームから変化した部分だけを保存します")
+        compression = st.selectbox("圧縮プロファイル", list(COMPRESSION_PROFILE_LABELS), index=list(COMPRESSION_PROFILE_LABELS).index(DEFAULT_COMPRESSION_PROFILE),
+                                   format_func=COMPRESSION_PROFILE_LABELS.get, key="compression",
+                                   help="max は圧縮方法を総当たりして最小のファイルを作ります（生成に時間がかかります）")
+        encode_options = {'delta_frames': delta_frames, 'compression': compression}
+        
+        use_palette = st.checkbox("パレット（256色以下）で出力", value=False, key="use_palette",
+                                  help="全フレーム共通のパレットに減色し、8bitインデックスカラーのAPNGにします")
+        palette_scope = "アニメーションごと"
+        if use_palette:
+            col_palette1, col_palette2 = st.columns(2)
+            with col_palette1:
+                palette_colors = st.slider("色数", 2, 256, 256, key="palette_colors")
+                palette_dither = st.checkbox("ディザリング", value=True, key="palette_dither",
+                                             help="写真のグラデーションを滑らかに見せます（OFFにするとサイズがさらに小さくなります）")
+            with col_palette2:
+                palette_scope = st.radio("パレットの範囲", ["アニメーションごと", "一括（画像共通）"], key="palette_scope",
+                                         help="一括では、アップロード画像と文字・枠線・アイコンの色から1つのパレットを作り全ファイルで共有します")
+            encode_options.update({'palette_colors': palette_colors, 'dither': palette_dither})
+        
+        use_render_cache = st.checkbox("生成済みのAPNGを再利用する（キャッシュ）", value=True, key="use_render_cache",
+                                       help="設定が同じファイルは前回までの生成結果を使い、変更のあった組み合わせだけ生成します")
+        collect_timings = st.checkbox("処理時間の内訳を記録する", value=False, key="collect_timings",
+                                      help="フォント読み込み・文字描画・リサンプリング・PNGエンコード・APNG組み立て・ZIP書き込みなどの時間を計測します")
+        
+        st.markdown("<br>", unsafe_allow_html=True)
+        
+        # 選択中のテンプレート（テンプレート選択タブで設定）
+        use_red_border = st.session_state.use_red_border
+        use_corner_icon = st.session_state.use_corner_icon
+        use_icon_increase = st.session_state.use_icon_increase
+        
+        # 生成ボタン
+        if st.button("APNGを一括生成する", type="primary", disabled=not (use_red_border or use_corner_icon or use_icon_increase), use_container_width=True):
+            date_str = datetime.now().strftime("%y%m%d")
+            
+            # パラメータ取得（セッションステートから）
+            templates = {}
+            if use_red_border:
+                templates["赤枠点滅"] = {
+                    'border_width': st.session_state.get('border_width_red', 13),
+                    'border_colors': st.session_state.get('border_colors', ["red"]),
+                    'num_frames': st.session_state.get('num_frames_red', 5),
+                    'loop_count': st.session_state.get('loop_count_red', 4),
+                }
+            if use_corner_icon:
+                templates["4隅アイコン点滅"] = {
+                    'icon_size': st.session_state.get('icon_size_corner', 85),
+                    'icon_names': st.session_state.get('icon_names', ["check.png"]),
+                    'num_frames': st.session_state.get('num_frames_corner', 5),
+                    'loop_count': st.session_state.get('loop_count_corner', 4),
+                }
+            if use_icon_increase:
+                templates["アイコン増加"] = {
+                    'icon_size': st.session_state.get('icon_size_increase', 100),
+                    'icon_names': st.session_state.get('icon_names_increase', ["check.png"]),
+                    'num_frames': st.session_state.get('num_frames_increase', 5),
+                    'loop_count': st.session_state.get('loop_count_increase', 4),
+                }
+            
+            # 処理時間の内訳（無効時は記録しない）
+            timings = StageTimings() if collect_timings else None
+            try:
+                with collect_stage_timings(timings), stage_timer('plan'):
+                    output_sizes = parse_output_sizes(output_sizes_text)
+                    batch_jobs, batch_images = build_batch_matrix(
+                        st.session_state.text_variations, st.session_state.annotation_variations,
+                        [resolve_image_variation(img_var) for img_var in st.session_state.image_variations], templates, product_name, custom_name,
+                        encode_options=encode_options, date_str=date_str,
+                        palette_scope='batch' if palette_scope == "一括（画像共通）" else 'animation',
+                        output_sizes=output_sizes
+                    )
+            except ValueError as e:
+                st.error(str(e))
+            else:
+                # 前回の生成結果を破棄（生成中なら中止）
+                previous_output = st.session_state.pop('batch_output', None)
+                if previous_output:
+                    batch_queue.discard(previous_output['batch_id'])
+                # 完成したAPNGは順次一時ファイル上のZIP（と指定時は保存先フォルダ）へ書き出す
+                archive = BatchArchive(save_folder_name, output_dir=output_dir if save_to_dir else None)
+                session_memory.track(session_id, "生成結果", archive)
+                # 生成はサーバープロセスのバックグラウンドで行い、セッションにはバッチIDだけを保持する（画面操作で中断されない）
+                batch = batch_queue.submit(batch_jobs, batch_images, archive, timings=timings,
+                                           max_workers=max_workers, collect_timings=collect_timings, encode_threads=encode_threads,
+                                           cache=get_render_cache() if use_render_cache else None)
+                st.session_state.batch_output = {
+                    'batch_id': batch.batch_id,
+                    'zip_name': default_zip_name(product_name, date_str),
+                    'timing_settings': {
+                        'max_workers': max_workers,
+                        'encode_options': encode_options,
+                        'palette_scope': palette_scope,
+                        'output_sizes': ", ".join(f"{width}x{height}" for width, height in output_sizes),
+                        'jobs': len(batch_jobs),
+                    },
+                    'timing_report': None,
+                }
+        
+        # 生成結果（再実行やダウンロード後も表示を保つため、バッチIDをセッションに保持）
+        # 生成中はこの部分だけを一定間隔で再実行して進捗を更新する
+        batch_output = st.session_state.get('batch_output')
+        active_batch = batch_queue.get(batch_output['batch_id']) if batch_output else None
+        batch_running = active_batch is not None and not active_batch.finished
+        st.fragment(batch_results_panel, run_every=BATCH_POLL_SECONDS if batch_running else None)(batch_running)
+        
+        # このセッションが保持しているメモリ（画像・プレビュー・生成結果）
+        memory_usage = session_memory.usage()
+        session_usage = memory_usage.get(session_id, {'bytes': 0, 'objects': {}})
+        memory_details = "・".join(
+            f"{name} {nbytes / 1024 / 1024:.1f} MB"
+            for name, nbytes in sorted(session_usage['objects'].items()) if nbytes
+        )
+        st.caption(f"このセッションのメモリ使用量: {session_usage['bytes'] / 1024 / 1024:.1f} MB"
+                   + (f"（{memory_details}）" if memory_details else "")
+                   + f" / 全セッション {sum(usage['bytes'] for usage in memory_usage.values()) / 1024 / 1024:.1f} MB"
+                   + f"（上限 {session_memory.budget_bytes / 1024 / 1024:.0f} MB）")
+
+# プレビューエリアの終わり
+with col_preview:
+    st.markdown('</div>', unsafe_allow_html=True)
+
+# 放置されたセッションと上限を超えた分のメモリを解放（このセッションの分は解放しない）
+session_memory.enforce(session_id)
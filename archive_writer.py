@@ -0,0 +1,100 @@
+import os
+import tempfile
+import threading
+import time
+import zipfile
+
+# 一括生成の出力先
+# 完成したAPNGを1つずつ一時ファイル上のZIPへ追記する（全ファイルをメモリに溜めない）
+# 一定サイズまではメモリ上、それを超えるとディスクへ退避する（SpooledTemporaryFile）
+# output_dir を指定すると、同じファイルを output_dir/フォルダ名/ にも書き出す
+# zip_path を指定すると、一時ファイルの代わりにそのパスへZIPを書き出す
+
+ZIP_SPOOL_MAX_SIZE = 32 * 1024 * 1024
+
+# 既に圧縮済みの形式はDEFLATEしても縮まないため無圧縮で格納する
+STORED_EXTENSIONS = ('.png', '.apng', '.webp', '.jpg', '.jpeg', '.gif', '.zip')
+
+class BatchArchive:
+    def __init__(self, folder_name, output_dir=None, spool_max_size=ZIP_SPOOL_MAX_SIZE, zip_path=None):
+        self.folder_name = folder_name
+        self.output_path = None
+        if output_dir:
+            self.output_path = os.path.join(output_dir, folder_name)
+            os.makedirs(self.output_path, exist_ok=True)
+        self.zip_path = zip_path
+        self.spool_max_size = spool_max_size
+        self._spilled = False
+        if zip_path:
+            self.zip_file = open(zip_path, 'w+b')
+        else:
+            self.zip_file = tempfile.SpooledTemporaryFile(max_size=spool_max_size, suffix='.zip')
+        self._zip = zipfile.ZipFile(self.zip_file, 'w', zipfile.ZIP_DEFLATED)
+        self._lock = threading.Lock()
+        self.files = []
+
+    def member_name(self, filename):
+        return f"{self.folder_name}/{filename}"
+
+    # ファイルを1つ追加（呼び出し後は data を保持しなくてよい）
+    def add(self, filename, data):
+        compress_type = zipfile.ZIP_STORED if filename.lower().endswith(STORED_EXTENSIONS) else zipfile.ZIP_DEFLATED
+        zip_info = zipfile.ZipInfo(self.member_name(filename), date_time=time.localtime()[:6])
+        zip_info.compress_type = compress_type
+        with self._lock:
+            self._zip.writestr(zip_info, data)
+            self.files.append((filename, len(data)))
+        if self.output_path:
+            with open(os.path.join(self.output_path, filename), 'wb') as f:
+                f.write(data)
+
+    # ZIPの中央ディレクトリを書き込んで完成させる
+    def close(self):
+        with self._lock:
+            if self._zip is not None:
+                self._zip.close()
+                self._zip = None
+
+    @property
+    def zip_size(self):
+        with self._lock:
+            self.zip_file.seek(0, os.SEEK_END)
+            return self.zip_file.tell()
+
+    # メモリ上に保持しているバイト数（ファイルに書き出している場合・退避済みの場合は0）
+    def memory_bytes(self):
+        if self.zip_path or self._spilled or self.zip_file.closed:
+            return 0
+        size = self.zip_size
+        return size if size <= self.spool_max_size else 0
+
+    # メモリ上のZIPを一時ファイルへ退避する（以降の追記・読み出しはディスク上で行う）
+    def release_memory(self):
+        released = self.memory_bytes()
+        if released:
+            with self._lock:
+                self.zip_file.rollover()
+                self._spilled = True
+        return released
+
+    # 完成したZIP全体（ダウンロード時にだけ読み出す）
+    def read_zip(self):
+        self.close()
+        with self._lock:
+            self.zip_file.seek(0)
+            return self.zip_file.read()
+
+    # ZIPから1ファイルを取り出す（書き込み中でも、追加済みのファイルは読み出せる）
+    def read_file(self, filename):
+        with self._lock:
+            if self._zip is not None:
+                return self._zip.read(self.member_name(filename))
+            self.zip_file.seek(0)
+            with zipfile.ZipFile(self.zip_file) as archive:
+                return archive.read(self.member_name(filename))
+
+    # 一時ファイルを破棄する
+    def discard(self):
+        self.close()
+        with self._lock:
+            self.zip_file.close()
@@ -0,0 +1,144 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import uuid
+
+from renderer import job_output_sizes, run_batch_jobs
+from stage_timing import collect_stage_timings, stage_timer
+
+# 一括生成のバックグラウンド実行
+# バッチはStreamlitのスクリプト実行ではなくサーバープロセスが所有するため、画面操作による再実行でも中断されない
+# セッションはバッチIDだけを保持し、再実行のたびに進捗と完成済みファイルを参照する
+
+# 同時に実行するバッチ数（超えた分は順番待ち）と、完了したバッチを保持する時間
+MAX_CONCURRENT_BATCHES = 2
+BATCH_RETENTION_SECONDS = 60 * 60
+
+BATCH_QUEUED = 'queued'
+BATCH_RUNNING = 'running'
+BATCH_DONE = 'done'
+BATCH_CANCELLED = 'cancelled'
+BATCH_FAILED = 'failed'
+
+# 1回の一括生成
+# 完成したファイルは archive（BatchArchive）へ順次追加され、実行中でも archive.read_file で取り出せる
+# run_options は run_batch_jobs へ渡す（max_workers, collect_timings, cache, encode_threads）
+class BackgroundBatch:
+    def __init__(self, batch_id, jobs, images, archive, timings=None, **run_options):
+        self.batch_id = batch_id
+        self.archive = archive
+        self.timings = timings
+        self.total_files = sum(len(job['outputs']) * len(job_output_sizes(job)) for job in jobs)
+        self.completed_files = 0
+        self.status = BATCH_QUEUED
+        self.error = None
+        self.batch_stats = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+        self._jobs = jobs
+        self._images = images
+        self._run_options = run_options
+
+    @property
+    def finished(self):
+        return self.status in (BATCH_DONE, BATCH_CANCELLED, BATCH_FAILED)
+
+    @property
+    def progress(self):
+        return self.completed_files / self.total_files if self.total_files else 1.0
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    # run_batch_jobs の出力先（ZIPへ書き込み、完成数を数える）
+    def add(self, filename, data):
+        self.archive.add(filename, data)
+        self.completed_files += 1
+
+    def run(self):
+        if self.cancel_event.is_set():
+            self._finish(BATCH_CANCELLED)
+            return
+        self.status = BATCH_RUNNING
+        try:
+            with collect_stage_timings(self.timings):
+                _, self.batch_stats = run_batch_jobs(self._jobs, self._images, sink=self, cancel_event=self.cancel_event, **self._run_options)
+                with stage_timer('zip_finalize'):
+                    self.archive.close()
+        except Exception as e:
+            self.error = str(e)
+            self.archive.close()
+            self._finish(BATCH_FAILED)
+            return
+        self._finish(BATCH_CANCELLED if self.batch_stats['cancelled'] else BATCH_DONE)
+
+    def _finish(self, status):
+        # 画像・作業単位はもう使わないので手放す
+        self._jobs = None
+        self._images = None
+        self.finished_at = time.time()
+        self.status = status
+
+class BatchQueue:
+    def __init__(self, max_concurrent=MAX_CONCURRENT_BATCHES, retention_seconds=BATCH_RETENTION_SECONDS):
+        self.retention_seconds = retention_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="batch")
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def submit(self, jobs, images, archive, timings=None, **run_options):
+        self.purge()
+        batch = BackgroundBatch(uuid.uuid4().hex, jobs, images, archive, timings, **run_options)
+        with self._lock:
+            self._batches[batch.batch_id] = batch
+        self._executor.submit(batch.run)
+        return batch
+
+    def get(self, batch_id):
+        with self._lock:
+            return self._batches.get(batch_id)
+
+    # 実行中・待機中のバッチ数
+    def active_count(self):
+        with self._lock:
+            return sum(1 for batch in self._batches.values() if not batch.finished)
+
+    # 保持期間を過ぎた完了済みバッチを破棄する（一時ファイルも削除）
+    def purge(self):
+        now = time.time()
+        with self._lock:
+            expired = [batch for batch in self._batches.values() if batch.finished and now - batch.finished_at > self.retention_seconds]
+            for batch in expired:
+                del self._batches[batch.batch_id]
+        for batch in expired:
+            batch.archive.discard()
+
+    # セッションが不要になったバッチを破棄する（実行中なら中止する）
+    def discard(self, batch_id):
+        with self._lock:
+            batch = self._batches.pop(batch_id, None)
+        if batch is None:
+            return
+        batch.cancel()
+        if batch.finished:
+            batch.archive.discard()
+        else:
+            # 実行中のバッチは中止の完了後に破棄する
+            threading.Thread(target=self._discard_when_finished, args=(batch,), daemon=True).start()
+
+    def _discard_when_finished(self, batch):
+        while not batch.finished:
+            time.sleep(0.1)
+        batch.archive.discard()
+
+_batch_queue = None
+_batch_queue_lock = threading.Lock()
+
+# プロセス内で共有するキュー
+def get_batch_queue():
+    global _batch_queue
+    with _batch_queue_lock:
+        if _batch_queue is None:
+            _batch_queue = BatchQueue()
+        return _batch_queue
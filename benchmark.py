@@ -0,0 +1,425 @@
+from PIL import Image
+import PIL
+import argparse
+import functools
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import threading
+import time
+
+import renderer
+from apng_writer import COMPRESSION_PROFILES
+from engine import (
+    DEFAULT_ANNOTATION_VARIATION, DEFAULT_IMAGE_VARIATION, DEFAULT_NEUMO_ANNOTATION_TEXT, DEFAULT_TEXT_VARIATION,
+    build_batch_matrix,
+)
+
+# ベンチマーク（オフラインで実行。Linuxでは Noto CJK フォントを入れた環境で計測する）
+# 入力は固定（アプリの既定値＋合成写真）なので、同じ環境なら結果は再現できる
+#
+# suite: テンプレート関数・プレビュー・save_apng・一括生成の計測と、ベースラインとの比較
+#   python benchmark.py suite --save-baseline baseline.json
+#   python benchmark.py suite --baseline baseline.json --max-regression 0.2
+#   回帰があれば終了コード1で終了する
+#
+# compression: 圧縮プロファイルごとの1フレームあたりのバイト数とミリ秒
+#   python benchmark.py compression --profiles fast max --repeat 5 --palette-colors 256 --json result.json
+
+STANDARD_TEXT = DEFAULT_TEXT_VARIATION
+STANDARD_ANNOTATION = DEFAULT_ANNOTATION_VARIATION
+
+# (テンプレート名, 追加の引数) アプリの既定値と同じ
+STANDARD_TEMPLATES = [
+    ("赤枠点滅", {'border_width': 13, 'border_color': 'red', 'num_frames': 5}),
+    ("4隅アイコン点滅", {'icon_size': 85, 'icon_name': 'check.png', 'num_frames': 5}),
+    ("アイコン増加", {'icon_size': 100, 'icon_name': 'check.png', 'num_frames': 5}),
+]
+
+# 再現可能な合成写真（グラデーションとマンデルブロ集合）
+def create_standard_photo(size=(800, 600)):
+    red = Image.linear_gradient('L').resize(size)
+    green = Image.effect_mandelbrot(size, (-2.0, -1.2, 1.0, 1.2), 64)
+    blue = Image.radial_gradient('L').resize(size)
+    return Image.merge('RGB', (red, green, blue))
+
+def build_standard_frames():
+    photo = create_standard_photo()
+    image_config = {
+        'original_width': photo.width,
+        'original_height': photo.height,
+        'scale': 0.5,
+        'x': renderer.WIDTH // 2,
+        'y': renderer.HEIGHT // 2,
+    }
+    standard_frames = []
+    for template_type, kwargs in STANDARD_TEMPLATES:
+        frame_builder = renderer.TEMPLATE_FRAME_BUILDERS[template_type]
+        text_arg = STANDARD_TEXT if template_type == "アイコン増加" else [STANDARD_TEXT]
+        frames = frame_builder(renderer.WIDTH, renderer.HEIGHT, text_arg, [STANDARD_ANNOTATION], photo, image_config, **kwargs)
+        standard_frames.append((template_type, kwargs['num_frames'], frames))
+    return standard_frames
+
+def run_compression_benchmark(profiles, repeat=3, encode_options=None):
+    encode_options = encode_options or {}
+    results = []
+    for template_type, num_frames, frames in build_standard_frames():
+        for profile in profiles:
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                apng_data = renderer.save_apng(frames, num_frames=num_frames, compression=profile, **encode_options)
+                timings.append(time.perf_counter() - start)
+            results.append({
+                'template': template_type,
+                'profile': profile,
+                'frames': len(frames),
+                'bytes': len(apng_data),
+                'bytes_per_frame': len(apng_data) / len(frames),
+                'ms_per_frame': statistics.median(timings) * 1000 / len(frames),
+            })
+    return results
+
+def print_compression_results(results):
+    print(f"{'テンプレート':<12} {'プロファイル':<10} {'bytes':>10} {'bytes/frame':>12} {'ms/frame':>10}")
+    for result in results:
+        print(f"{result['template']:<12} {result['profile']:<10} {result['bytes']:>10} "
+              f"{result['bytes_per_frame']:>12.0f} {result['ms_per_frame']:>10.1f}")
+
+
+# ---- 計測スイート ----
+
+SUITE_TEXTS = {
+    'short': "サンプルテキスト",
+    'long': "定期初回限定クーポン配布中\n今だけ送料無料・初回半額\nお早めにお申し込みください",
+}
+SUITE_ANNOTATIONS = {
+    'short': DEFAULT_ANNOTATION_VARIATION['text'],
+    'long': DEFAULT_NEUMO_ANNOTATION_TEXT + DEFAULT_NEUMO_ANNOTATION_TEXT,
+}
+
+# 基準の条件と、1項目ずつ変えた条件
+SUITE_BASE_PARAMS = {
+    'frames': 5,
+    'text': 'short',
+    'font': 'ゴシック/W7',
+    'aspect_ratio': 1.0,
+    'image_size': '800x600',
+}
+SUITE_VARIATIONS = [
+    {},
+    {'frames': 10},
+    {'text': 'long'},
+    {'font': '明朝/W8'},
+    {'aspect_ratio': 0.8},
+    {'image_size': '3000x2000'},
+]
+# 一括生成の組み合わせ数（テキスト数 x 注釈数 x 画像数）。全テンプレートを有効にする
+SUITE_MATRIX_SIZES = ['1x1x1', '4x2x2']
+
+TEMPLATE_KWARGS = {template_type: {key: value for key, value in kwargs.items() if key != 'num_frames'}
+                   for template_type, kwargs in STANDARD_TEMPLATES}
+
+def parse_size(value):
+    width, height = value.split('x')
+    return int(width), int(height)
+
+def suite_text(params):
+    font_type, weight = params['font'].split('/')
+    return dict(DEFAULT_TEXT_VARIATION, text=SUITE_TEXTS[params['text']], font=font_type, weight=weight,
+                aspect_ratio=params['aspect_ratio'], icon_aspect_ratio=params['aspect_ratio'])
+
+def suite_annotation(params):
+    font_type, weight = params['font'].split('/')
+    return dict(DEFAULT_ANNOTATION_VARIATION, text=SUITE_ANNOTATIONS[params['text']], font=font_type, weight=weight,
+                aspect_ratio=params['aspect_ratio'])
+
+# 計測用写真はサイズごとに1回だけ作る
+@functools.lru_cache(maxsize=None)
+def suite_photo(size):
+    return create_standard_photo(size)
+
+def suite_image(params):
+    photo = suite_photo(parse_size(params['image_size']))
+    # 画像サイズによらず、キャンバス上では同じ大きさで配置する
+    image_config = dict(DEFAULT_IMAGE_VARIATION, image=photo, original_width=photo.width, original_height=photo.height,
+                        scale=400 / photo.width, digest=f"suite_photo_{params['image_size']}")
+    return photo, image_config
+
+def case_name(kind, label, params, base=SUITE_BASE_PARAMS):
+    changed = [f"{key}={value}" for key, value in params.items() if base.get(key) != value]
+    return "/".join([kind, label] + changed)
+
+# 計測ケースの一覧（kind, name, params, 実行関数）
+# 実行関数は (フレーム数, APNG数, バイト数) を返す
+def build_suite_cases():
+    cases = []
+    for template_type, _ in STANDARD_TEMPLATES:
+        frame_builder = renderer.TEMPLATE_FRAME_BUILDERS[template_type]
+        for variation in SUITE_VARIATIONS:
+            params = dict(SUITE_BASE_PARAMS, **variation)
+
+            def run_template(template_type=template_type, frame_builder=frame_builder, params=params):
+                photo, image_config = suite_image(params)
+                text_var = suite_text(params)
+                text_arg = text_var if template_type == "アイコン増加" else [text_var]
+                frames = frame_builder(renderer.WIDTH, renderer.HEIGHT, text_arg, [suite_annotation(params)], photo, image_config,
+                                       num_frames=params['frames'], **TEMPLATE_KWARGS[template_type])
+                return len(frames), 0, None
+            cases.append(('template', case_name('template', template_type, params), params, run_template))
+
+        params = dict(SUITE_BASE_PARAMS)
+
+        def run_preview(template_type=template_type, params=params):
+            photo, image_config = suite_image(params)
+            renderer.create_preview_image([suite_text(params)], [suite_annotation(params)], photo, image_config,
+                                          template_type, scale=0.5, **TEMPLATE_KWARGS[template_type])
+            return 1, 0, None
+        cases.append(('preview', case_name('preview', template_type, params), params, run_preview))
+
+        for num_frames in (5, 10):
+            params = dict(SUITE_BASE_PARAMS, frames=num_frames)
+            photo, image_config = suite_image(params)
+            text_var = suite_text(params)
+            text_arg = text_var if template_type == "アイコン増加" else [text_var]
+            frames = frame_builder(renderer.WIDTH, renderer.HEIGHT, text_arg, [suite_annotation(params)], photo, image_config,
+                                   num_frames=num_frames, **TEMPLATE_KWARGS[template_type])
+
+            def run_save(frames=frames, num_frames=num_frames):
+                apng_data = renderer.save_apng(frames, num_frames=num_frames)
+                return len(frames), 1, len(apng_data)
+            cases.append(('save_apng', case_name('save_apng', template_type, params), params, run_save))
+
+    for matrix_size in SUITE_MATRIX_SIZES:
+        params = dict(SUITE_BASE_PARAMS, matrix=matrix_size)
+
+        def run_batch(params=params):
+            num_texts, num_annotations, num_images = (int(value) for value in params['matrix'].split('x'))
+            text_variations = [dict(suite_text(params), text=f"{SUITE_TEXTS[params['text']]}{idx + 1}") for idx in range(num_texts)]
+            annotation_variations = [dict(suite_annotation(params), y=390 - idx * 12) for idx in range(num_annotations)]
+            photo, image_config = suite_image(params)
+            image_variations = [dict(image_config, x=200 + idx * 100) for idx in range(num_images)]
+            templates = {template_type: {'num_frames': params['frames']} for template_type, _ in STANDARD_TEMPLATES}
+            jobs, images = build_batch_matrix(text_variations, annotation_variations, image_variations, templates, "bench", "suite")
+            generated_files, _ = renderer.run_batch_jobs(jobs, images, max_workers=params.get('workers', 1))
+            frames = sum(params['frames'] for _ in generated_files)
+            return frames, len(generated_files), sum(len(data) for _, data in generated_files)
+        cases.append(('batch', case_name('batch', 'matrix', params, dict(SUITE_BASE_PARAMS, matrix=None)), params, run_batch))
+    return cases
+
+# 計測中のプロセスの最大常駐メモリ（RSS）を一定間隔で記録する（/proc を使うためLinuxのみ。それ以外では None）
+class PeakMemorySampler:
+    def __init__(self, interval=0.002):
+        self.interval = interval
+        self.page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+        self.start_rss = None
+        self.peak_rss = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def read_rss(self):
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * self.page_size
+        except OSError:
+            return None
+
+    def _run(self):
+        while not self._stop.is_set():
+            rss = self.read_rss()
+            if rss is not None and rss > self.peak_rss:
+                self.peak_rss = rss
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.start_rss = self.peak_rss = self.read_rss()
+        if self.start_rss is not None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            rss = self.read_rss()
+            if rss is not None and rss > self.peak_rss:
+                self.peak_rss = rss
+
+    @property
+    def peak_increase_mb(self):
+        if self.start_rss is None:
+            return None
+        return (self.peak_rss - self.start_rss) / 1024 / 1024
+
+def clear_render_caches():
+    for cache in (renderer.get_font_cache(), renderer.get_glyph_cache(), renderer.get_asset_cache(), renderer.get_metrics_cache()):
+        cache.clear()
+
+# 1ケースを計測（ウォームアップ1回の後、repeat回の中央値）
+def measure_case(run, repeat=3, cold=False):
+    run()
+    timings = []
+    peak_memory = []
+    for _ in range(repeat):
+        if cold:
+            clear_render_caches()
+        gc.collect()
+        with PeakMemorySampler() as sampler:
+            start = time.perf_counter()
+            frames, apngs, total_bytes = run()
+            timings.append(time.perf_counter() - start)
+        peak_memory.append(sampler.peak_increase_mb)
+    seconds = statistics.median(timings)
+    return {
+        'ms': seconds * 1000,
+        'frames': frames,
+        'apngs': apngs,
+        'frames_per_s': frames / seconds if frames and seconds else None,
+        'ms_per_apng': seconds * 1000 / apngs if apngs else None,
+        'bytes': total_bytes,
+        'peak_memory_mb': max(peak_memory) if None not in peak_memory else None,
+    }
+
+def run_suite(repeat=3, name_filter=None, cold=False):
+    results = []
+    for kind, name, params, run in build_suite_cases():
+        if name_filter and name_filter not in name:
+            continue
+        result = measure_case(run, repeat, cold)
+        result.update({'name': name, 'kind': kind, 'params': params})
+        results.append(result)
+        print_suite_result(result)
+    return results
+
+def suite_environment():
+    registry = renderer.get_font_registry()
+    return {
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'fonts': {f"{font_type}/{weight}": (paths[0] if paths else None)
+                  for (font_type, weight), paths in registry.items() if weight in ("W7", "W8")},
+    }
+
+def format_metric(value, spec):
+    width = int(spec.split('.')[0].rstrip('d'))
+    return format(value, spec) if value is not None else "-".rjust(width)
+
+def print_suite_result(result, comparison=None):
+    line = (f"{result['name']:<58} {format_metric(result['ms'], '9.1f')} ms "
+            f"{format_metric(result['frames_per_s'], '8.1f')} f/s "
+            f"{format_metric(result['ms_per_apng'], '8.1f')} ms/apng "
+            f"{format_metric(result['bytes'], '10d')} B "
+            f"{format_metric(result['peak_memory_mb'], '7.1f')} MB")
+    if comparison:
+        line += "  " + " ".join(comparison)
+    print(line)
+
+# 計測誤差に埋もれる小さな差は回帰として扱わない（指標ごとの絶対量）
+REGRESSION_MIN_DELTA = {'ms': 1.0, 'bytes': 0, 'peak_memory_mb': 1.0}
+
+# ベースラインと比較し、閾値を超えた回帰の一覧を返す
+# thresholds: {指標名: 許容する増加率}（ms 0.2 なら20%以上遅くなると回帰）
+def compare_with_baseline(results, baseline, thresholds):
+    baseline_results = {result['name']: result for result in baseline['results']}
+    regressions = []
+    print("\nベースラインとの比較")
+    for result in results:
+        base = baseline_results.get(result['name'])
+        if base is None:
+            print_suite_result(result, ["(ベースラインなし)"])
+            continue
+        comparison = []
+        for metric, threshold in thresholds.items():
+            value, base_value = result.get(metric), base.get(metric)
+            if value is None or not base_value:
+                continue
+            change = value / base_value - 1
+            comparison.append(f"{metric} {change:+.1%}")
+            if threshold is not None and change > threshold and value - base_value > REGRESSION_MIN_DELTA.get(metric, 0):
+                regressions.append({'name': result['name'], 'metric': metric, 'baseline': base_value, 'value': value, 'change': change})
+        print_suite_result(result, comparison)
+    return regressions
+
+def main_suite(args):
+    environment = suite_environment()
+    if args.require_fonts and not all(environment['fonts'].values()):
+        print("日本語フォント（Noto CJK など）が見つかりません: " + json.dumps(environment['fonts'], ensure_ascii=False))
+        return 2
+    renderer.set_encode_threads(args.threads)
+    results = run_suite(args.repeat, args.filter, args.cold)
+    report = {'environment': environment, 'options': vars(args), 'results': results}
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        thresholds = {
+            'ms': args.max_regression,
+            'bytes': args.max_size_regression,
+            'peak_memory_mb': args.max_memory_regression,
+        }
+        regressions = compare_with_baseline(results, baseline, thresholds)
+        report['regressions'] = regressions
+        if regressions:
+            print(f"\n回帰 {len(regressions)} 件:")
+            for regression in regressions:
+                print(f"  {regression['name']} {regression['metric']}: {regression['baseline']:.1f} -> {regression['value']:.1f} ({regression['change']:+.1%})")
+            exit_code = 1
+        else:
+            print("\n回帰なし")
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return exit_code
+
+def main_compression(args):
+    renderer.set_encode_threads(args.threads)
+    encode_options = {'delta_frames': not args.no_delta, 'palette_colors': args.palette_colors}
+    results = run_compression_benchmark(args.profiles, args.repeat, encode_options)
+    print_compression_results(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'options': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="APNG生成のベンチマーク")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    suite_parser = subparsers.add_parser('suite', help="描画・エンコード・一括生成の計測とベースライン比較")
+    suite_parser.add_argument('--repeat', type=int, default=3, help="計測回数（中央値を採用）")
+    suite_parser.add_argument('--threads', type=int, default=1, help="エンコードスレッド数（既定1：逐次で計測）")
+    suite_parser.add_argument('--filter', default=None, help="名前にこの文字列を含むケースだけ計測")
+    suite_parser.add_argument('--cold', action='store_true', help="計測ごとにフォント・グリフ・画像キャッシュを空にする")
+    suite_parser.add_argument('--require-fonts', action='store_true', help="日本語フォントがなければ計測せず終了コード2で終了")
+    suite_parser.add_argument('--baseline', default=None, help="比較するベースラインのJSON")
+    suite_parser.add_argument('--save-baseline', default=None, help="結果をベースラインとして保存するパス")
+    suite_parser.add_argument('--max-regression', type=float, default=0.2, help="許容する処理時間の増加率")
+    suite_parser.add_argument('--max-size-regression', type=float, default=0.02, help="許容するファイルサイズの増加率")
+    suite_parser.add_argument('--max-memory-regression', type=float, default=0.5, help="許容するピークメモリの増加率")
+    suite_parser.add_argument('--json', default=None, help="結果をJSONで保存するパス")
+
+    compression_parser = subparsers.add_parser('compression', help="圧縮プロファイルごとのサイズと速度")
+    compression_parser.add_argument('--profiles', nargs='+', default=list(COMPRESSION_PROFILES), choices=list(COMPRESSION_PROFILES))
+    compression_parser.add_argument('--repeat', type=int, default=3, help="計測回数（中央値を採用）")
+    compression_parser.add_argument('--threads', type=int, default=1, help="エンコードスレッド数（既定1：逐次で計測）")
+    compression_parser.add_argument('--palette-colors', type=int, default=None, help="指定するとパレットモードで計測")
+    compression_parser.add_argument('--no-delta', action='store_true', help="差分フレームを使わない")
+    compression_parser.add_argument('--json', default=None, help="結果をJSONで保存するパス")
+
+    args = parser.parse_args(argv)
+    if args.command == 'suite':
+        return main_suite(args)
+    return main_compression(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
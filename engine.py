@@ -0,0 +1,353 @@
+from datetime import datetime
+import argparse
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+
+from apng_writer import DEFAULT_COMPRESSION_PROFILE
+from archive_writer import BatchArchive
+from renderer import (
+    WIDTH, HEIGHT, DEFAULT_MAX_WORKERS, MAX_OUTPUT_SIZE,
+    build_batch_job, build_batch_palette, load_upload_image, run_batch_jobs,
+)
+
+# 一括生成エンジン（Streamlitに依存しない）
+# テキスト×注釈×画像×テンプレートの組み合わせから作業単位を作り、APNGとZIPを出力する
+# CLI: python engine.py spec.json [--output-dir DIR] [--summary summary.json]
+#   標準出力に結果（タイミング・ファイル数など）を1つのJSONとして出力し、終了コードで成否を返す
+
+# 終了コード
+EXIT_OK = 0
+EXIT_RENDER_ERROR = 1
+EXIT_USAGE_ERROR = 2  # argparse の引数エラー
+EXIT_SPEC_ERROR = 3
+EXIT_OUTPUT_ERROR = 4
+
+# 段階ごとの失敗を終了コード付きで伝える例外
+class BatchEngineError(Exception):
+    def __init__(self, exit_code, message):
+        super().__init__(message)
+        self.exit_code = exit_code
+
+DEFAULT_ANNOTATION_TEXT = "※定期初回限定クーポンのこと。定期初回価格、1世帯1回限り。すでにキャンペーンで購入済みの方は対象外"
+DEFAULT_NEUMO_ANNOTATION_TEXT = "※定期初回限定のクーポンのこと※定期初回価格。初回限定、1世帯1回限り。既にニューモVをキャンペーンで購入済みの方は対象外となります"
+
+DEFAULT_TEXT_VARIATION = {
+    'text': 'サンプルテキスト',
+    'font': 'ゴシック',
+    'weight': 'W7',
+    'size': 100,
+    'color': '#000000',
+    'char_spacing': 0,
+    'line_spacing': 0,
+    'aspect_ratio': 1.0,
+    'x': WIDTH // 2,
+    'y': HEIGHT // 2,
+    'enabled': True,
+    'icon_size': 40,
+    'icon_x': 74,
+    'icon_y': 320,
+    'icon_char_spacing': 0,
+    'icon_aspect_ratio': 1.0,
+    'icon_row_spacing': 62
+}
+
+DEFAULT_ANNOTATION_VARIATION = {
+    'text': DEFAULT_ANNOTATION_TEXT,
+    'font': 'ゴシック',
+    'weight': 'W7',
+    'size': 10,
+    'color': '#000000',
+    'x': 10,
+    'y': 390,
+    'enabled': True,
+    'is_neumo': False,
+    'aspect_ratio': 1.0
+}
+
+DEFAULT_IMAGE_VARIATION = {
+    'image': None,
+    'original_width': 100,
+    'original_height': 100,
+    'scale': 1.0,
+    'x': WIDTH // 2,
+    'y': HEIGHT // 2
+}
+
+# テンプレートごとの既定パラメータ
+TEMPLATE_DEFAULTS = {
+    "赤枠点滅": {'border_width': 13, 'border_colors': ["red"], 'num_frames': 5, 'loop_count': 4},
+    "4隅アイコン点滅": {'icon_size': 85, 'icon_names': ["check.png"], 'num_frames': 5, 'loop_count': 4},
+    "アイコン増加": {'icon_size': 100, 'icon_names': ["check.png"], 'num_frames': 5, 'loop_count': 4},
+}
+# ファイルを作り分けるパラメータ（仕様のキー, フレーム生成関数の引数名）
+TEMPLATE_VARIANTS = {
+    "赤枠点滅": ('border_colors', 'border_color'),
+    "4隅アイコン点滅": ('icon_names', 'icon_name'),
+    "アイコン増加": ('icon_names', 'icon_name'),
+}
+# 全ファイル共通でフレーム生成関数へ渡すパラメータ
+TEMPLATE_FIXED_PARAMS = {
+    "赤枠点滅": ('border_width',),
+    "4隅アイコン点滅": ('icon_size',),
+    "アイコン増加": ('icon_size',),
+}
+# ファイル名に入るテンプレート名
+TEMPLATE_FILE_LABELS = {
+    "赤枠点滅": "枠点滅",
+    "4隅アイコン点滅": "ikon点滅",
+    "アイコン増加": "ikon増加",
+}
+# 仕様ファイルで使える英語名
+TEMPLATE_ALIASES = {
+    'red_border': "赤枠点滅",
+    'corner_icon': "4隅アイコン点滅",
+    'icon_increase': "アイコン増加",
+}
+
+# date_str: ファイル名と同じ YYMMDD（省略時は今日）。フォルダ名には YYYYMMDD で入れる
+def default_folder_name(product_name, custom_name, date_str=None):
+    date = datetime.strptime(date_str, "%y%m%d") if date_str else datetime.now()
+    return f"{date.strftime('%Y%m%d')}_{product_name}_APNG_枠点滅_素材_{custom_name}"
+
+def default_zip_name(product_name, date_str=None):
+    date_str = date_str or datetime.now().strftime("%y%m%d")
+    return f"{date_str}_{product_name}_APNG_all.zip"
+
+# 出力サイズの指定を [(幅, 高さ), ...] にする
+# value: "600x400, 300x200" のような文字列、または ["600x400", [300, 200], ...] のようなリスト
+def parse_output_sizes(value):
+    if isinstance(value, str):
+        value = [item for item in value.replace('、', ',').split(',') if item.strip()]
+    sizes = []
+    for item in value:
+        if isinstance(item, str):
+            parts = item.strip().lower().replace('×', 'x').split('x')
+        else:
+            parts = list(item)
+        try:
+            width, height = (int(part) for part in parts)
+        except (TypeError, ValueError):
+            raise ValueError(f"出力サイズは「幅x高さ」で指定してください: {item}")
+        if not (1 <= width <= MAX_OUTPUT_SIZE and 1 <= height <= MAX_OUTPUT_SIZE):
+            raise ValueError(f"出力サイズは1〜{MAX_OUTPUT_SIZE}pxで指定してください: {item}")
+        if (width, height) not in sizes:
+            sizes.append((width, height))
+    if not sizes:
+        raise ValueError("出力サイズを1つ以上指定してください。")
+    return sizes
+
+# 一括生成の作業単位を組み立てる
+# templates: {テンプレート名: パラメータ}（有効なテンプレートのみ。パラメータは TEMPLATE_DEFAULTS を上書き）
+# palette_scope='batch' かつ encode_options に palette_colors がある場合は、全ファイル共通のパレットを作る
+# output_sizes: 出力サイズ [(幅, 高さ), ...]（None で WIDTH x HEIGHT のみ。複数の場合はファイル名にサイズが付く）
+# 戻り値: (作業単位のリスト, {画像キー: 画像})
+def build_batch_matrix(text_variations, annotation_variations, image_variations, templates, product_name, custom_name,
+                       encode_options=None, date_str=None, palette_scope='animation', output_sizes=None):
+    date_str = date_str or datetime.now().strftime("%y%m%d")
+    encode_options = dict(encode_options or {})
+    enabled_annotations = [annot for annot in annotation_variations if annot.get('enabled', True)]
+    # テキストはリストにあるものを全て「有効」とみなす
+    enabled_texts = list(text_variations)
+    if len(enabled_annotations) == 0:
+        raise ValueError("有効な注釈がありません。注釈リストでスイッチをONにしてください。")
+    if len(enabled_texts) == 0:
+        raise ValueError("有効なテキストがありません。テキスト設定で追加してください。")
+    template_params = {}
+    for template_type, params in templates.items():
+        template_type = TEMPLATE_ALIASES.get(template_type, template_type)
+        if template_type not in TEMPLATE_DEFAULTS:
+            raise ValueError(f"不明なテンプレートです: {template_type}")
+        template_params[template_type] = dict(TEMPLATE_DEFAULTS[template_type], **(params or {}))
+    if not template_params:
+        raise ValueError("テンプレートが1つも選択されていません。")
+
+    # アップロード画像は作業単位とは別に、ワーカーへ一度だけ渡す
+    batch_images = {}
+    image_keys = []
+    for img_idx, img_var in enumerate(image_variations):
+        image_key = img_var.get('digest') or f"image_{img_idx}"
+        if img_var.get('image') is not None:
+            batch_images[image_key] = img_var['image']
+        image_keys.append(image_key)
+
+    if encode_options.get('palette_colors') and palette_scope == 'batch':
+        flat_colors = ["white"] + [text_var.get('color', '#000000') for text_var in enabled_texts]
+        flat_colors += [annot_var.get('color', '#000000') for annot_var in enabled_annotations]
+        flat_colors += template_params.get("赤枠点滅", {}).get('border_colors', [])
+        palette_icon_names = [icon_name for template_type in ("4隅アイコン点滅", "アイコン増加")
+                              for icon_name in template_params.get(template_type, {}).get('icon_names', [])]
+        encode_options['palette'] = build_batch_palette(
+            [img_var.get('image') for img_var in image_variations], image_variations, flat_colors, palette_icon_names,
+            palette_colors=encode_options['palette_colors'], reserve_transparent=encode_options.get('delta_frames', True)
+        )
+
+    batch_jobs = []
+    for annot_var in enabled_annotations:
+        prod_name = "new5" if annot_var.get('is_neumo', False) else product_name
+        counters = {template_type: 1 for template_type in template_params}
+        for text_var in enabled_texts:
+            for img_idx, img_var in enumerate(image_variations):
+                # 同じ組み合わせの色違い・アイコン違いは同じ静的レイヤーを共有する
+                for template_type in TEMPLATE_DEFAULTS:
+                    if template_type not in template_params:
+                        continue
+                    params = template_params[template_type]
+                    variants_key, output_key = TEMPLATE_VARIANTS[template_type]
+                    outputs = []
+                    for variant in params[variants_key]:
+                        filename = f"{date_str}_{prod_name}_APNG_{TEMPLATE_FILE_LABELS[template_type]}_素材_{custom_name}_{counters[template_type]:02d}.png"
+                        outputs.append((filename, {output_key: variant}))
+                        counters[template_type] += 1
+                    batch_jobs.append(build_batch_job(
+                        template_type, [text_var], [annot_var],
+                        image_keys[img_idx], img_var, outputs,
+                        num_frames=params['num_frames'], num_plays=params['loop_count'],
+                        encode_options=encode_options, sizes=output_sizes,
+                        **{key: params[key] for key in TEMPLATE_FIXED_PARAMS[template_type]}
+                    ))
+    return batch_jobs, batch_images
+
+# 仕様ファイル（JSON / YAML）を読み込む
+def load_spec(path):
+    with open(path, encoding='utf-8') as f:
+        if path.lower().endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("YAMLの仕様ファイルを読むには PyYAML が必要です（pip install pyyaml）")
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+    if not isinstance(spec, dict):
+        raise ValueError("仕様ファイルの最上位はオブジェクトにしてください")
+    return spec
+
+# 仕様の画像バリエーションを読み込む（path は仕様ファイルからの相対パスも可）
+def load_image_variations(image_specs, base_dir='.'):
+    image_variations = []
+    for image_spec in image_specs or [{}]:
+        img_var = dict(DEFAULT_IMAGE_VARIATION, **{key: value for key, value in image_spec.items() if key != 'path'})
+        path = image_spec.get('path')
+        if path:
+            path = os.path.join(base_dir, path)
+            with open(path, 'rb') as f:
+                image_bytes = f.read()
+            img_var['image'], (original_width, original_height) = load_upload_image(io.BytesIO(image_bytes))
+            img_var['digest'] = hashlib.sha1(image_bytes).hexdigest()
+            if 'original_width' not in image_spec:
+                img_var['original_width'] = original_width
+                img_var['original_height'] = original_height
+        image_variations.append(img_var)
+    return image_variations
+
+# 仕様に従って一括生成し、結果のサマリーを返す
+# 仕様の形式:
+#   product_name, custom_name, save_folder_name, date（YYMMDD）
+#   text_variations / annotation_variations: アプリと同じ形式（省略した項目は既定値）
+#   image_variations: [{path, scale, x, y, ...}]
+#   templates: {テンプレート名 または red_border / corner_icon / icon_increase: パラメータ}
+#   output: {dir, zip, files, sizes, compression, delta_frames, palette_colors, dither, palette_scope, max_workers, encode_threads}
+#     sizes: 出力サイズ（"600x400, 300x200" または ["600x400", [300, 200]]。省略時は WIDTH x HEIGHT）
+def run_spec(spec, base_dir='.', output_dir=None, max_workers=None):
+    timings = {}
+    start = time.perf_counter()
+
+    try:
+        product_name = spec.get('product_name', "商材名")
+        custom_name = spec.get('custom_name', "名前")
+        folder_name = spec.get('save_folder_name') or default_folder_name(product_name, custom_name, spec.get('date'))
+        output = spec.get('output', {})
+        output_dir = output_dir or os.path.join(base_dir, output.get('dir', 'output'))
+        text_variations = [dict(DEFAULT_TEXT_VARIATION, **text_var) for text_var in spec.get('text_variations', [{}])]
+        annotation_variations = [dict(DEFAULT_ANNOTATION_VARIATION, **annot_var) for annot_var in spec.get('annotation_variations', [{}])]
+        image_variations = load_image_variations(spec.get('image_variations'), base_dir)
+        templates = spec.get('templates', {"赤枠点滅": {}})
+        output_sizes = parse_output_sizes(output['sizes']) if output.get('sizes') else None
+        encode_options = {
+            'delta_frames': output.get('delta_frames', True),
+            'compression': output.get('compression', DEFAULT_COMPRESSION_PROFILE),
+        }
+        if output.get('palette_colors'):
+            encode_options.update({'palette_colors': output['palette_colors'], 'dither': output.get('dither', True)})
+        timings['load'] = time.perf_counter() - start
+
+        stage_start = time.perf_counter()
+        batch_jobs, batch_images = build_batch_matrix(
+            text_variations, annotation_variations, image_variations, templates, product_name, custom_name,
+            encode_options=encode_options, date_str=spec.get('date'), palette_scope=output.get('palette_scope', 'animation'),
+            output_sizes=output_sizes
+        )
+        timings['plan'] = time.perf_counter() - stage_start
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        raise BatchEngineError(EXIT_SPEC_ERROR, f"仕様の読み込みに失敗しました: {type(e).__name__}: {e}") from e
+
+    stage_start = time.perf_counter()
+    try:
+        zip_path = None
+        if output.get('zip', True):
+            os.makedirs(output_dir, exist_ok=True)
+            zip_path = os.path.join(output_dir, output.get('zip_name') or default_zip_name(product_name, spec.get('date')))
+        archive = BatchArchive(folder_name, output_dir=output_dir if output.get('files', True) else None, zip_path=zip_path)
+    except OSError as e:
+        raise BatchEngineError(EXIT_OUTPUT_ERROR, f"出力先を作成できません: {e}") from e
+    timings['prepare_output'] = time.perf_counter() - stage_start
+
+    stage_start = time.perf_counter()
+    try:
+        _, batch_stats = run_batch_jobs(batch_jobs, batch_images, max_workers=max_workers or output.get('max_workers', DEFAULT_MAX_WORKERS), sink=archive,
+                                        encode_threads=output.get('encode_threads', 1))
+    except OSError as e:
+        raise BatchEngineError(EXIT_OUTPUT_ERROR, f"出力に失敗しました: {e}") from e
+    except Exception as e:
+        raise BatchEngineError(EXIT_RENDER_ERROR, f"生成に失敗しました: {type(e).__name__}: {e}") from e
+    finally:
+        archive.close()
+    timings['render'] = time.perf_counter() - stage_start
+    timings['total'] = time.perf_counter() - start
+
+    return {
+        'files': len(archive.files),
+        'jobs': len(batch_jobs),
+        'bytes': sum(file_bytes for _, file_bytes in archive.files),
+        'output_path': archive.output_path,
+        'zip_path': zip_path,
+        'timings_ms': {stage: round(seconds * 1000, 1) for stage, seconds in timings.items()},
+        'cache': batch_stats['cache'],
+        'file_stats': batch_stats['files'],
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="仕様ファイルからAPNGを一括生成する")
+    parser.add_argument('spec', help="仕様ファイル（.json / .yaml）")
+    parser.add_argument('--output-dir', default=None, help="出力先ディレクトリ（仕様の output.dir より優先）")
+    parser.add_argument('--max-workers', type=int, default=None, help="並列ワーカー数")
+    parser.add_argument('--summary', default=None, help="結果のJSONを保存するパス（標準出力にも出力）")
+    args = parser.parse_args(argv)
+
+    summary = {'spec': args.spec}
+    exit_code = EXIT_OK
+    try:
+        try:
+            spec = load_spec(args.spec)
+        except (OSError, ValueError) as e:
+            raise BatchEngineError(EXIT_SPEC_ERROR, f"仕様ファイルを読み込めません: {type(e).__name__}: {e}") from e
+        summary.update(run_spec(spec, base_dir=os.path.dirname(os.path.abspath(args.spec)),
+                                output_dir=args.output_dir, max_workers=args.max_workers))
+    except BatchEngineError as e:
+        exit_code, summary['error'] = e.exit_code, str(e)
+    summary['status'] = 'ok' if exit_code == EXIT_OK else 'error'
+    summary['exit_code'] = exit_code
+
+    output = json.dumps(summary, ensure_ascii=False)
+    print(output)
+    if args.summary:
+        with open(args.summary, 'w', encoding='utf-8') as f:
+            f.write(output)
+    return exit_code
+
+if __name__ == '__main__':
+    sys.exit(main())
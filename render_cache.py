@@ -0,0 +1,182 @@
+import PIL
+import json
+import os
+import tempfile
+import threading
+import time
+
+from renderer import HEIGHT, ICON_DIR, WIDTH, config_digest, get_font_registry, image_digest, job_output_sizes, output_master_size
+
+# 生成済みAPNGのディスクキャッシュ（プロセス・セッションをまたいで再利用する）
+# キーは1ファイルの出力に影響する全設定（テキスト・注釈・画像のダイジェスト・テンプレートと引数・フレーム数・ループ数・エンコード設定・出力サイズ）のハッシュ
+# 合計サイズが上限を超えたら、最後に使われた時刻（ファイルの更新時刻）が古いものから削除する
+# エントリは「統計情報のJSON 1行 + APNGデータ」の1ファイルで、一時ファイルに書いてから置き換える
+
+# 描画結果が変わる変更をした場合は上げる（古いキャッシュを使わないようにする）
+RENDER_CACHE_VERSION = 1
+
+# 保存先と上限（環境変数で変更可能）
+RENDER_CACHE_DIR = os.environ.get('APNG_RENDER_CACHE_DIR') or os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'apng_generator', 'render'
+)
+RENDER_CACHE_MAX_BYTES = int(float(os.environ.get('APNG_RENDER_CACHE_MB', 1024)) * 1024 * 1024)
+
+# 上限を超えたときは、この割合まで減らす（削除のたびに全体を並べ替えないため）
+RENDER_CACHE_EVICT_RATIO = 0.9
+
+# 描画に影響しない画像設定
+IMAGE_CONFIG_IGNORED_KEYS = ('image', 'upload_id')
+
+# 描画結果に影響する実行環境（フォント・アイコン・Pillowのバージョン）
+def render_environment_digest():
+    registry = sorted([f"{font_type}/{weight}", paths] for (font_type, weight), paths in get_font_registry().items())
+    icons = {}
+    if os.path.isdir(ICON_DIR):
+        for entry in os.scandir(ICON_DIR):
+            icons[entry.name] = entry.stat().st_mtime
+    return config_digest(RENDER_CACHE_VERSION, PIL.__version__, WIDTH, HEIGHT, registry, icons)
+
+class RenderCache:
+    def __init__(self, cache_dir=RENDER_CACHE_DIR, max_bytes=RENDER_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_bytes = 0
+        self._environment_digest = None
+        # キー -> [バイト数, 最終使用時刻]
+        self._index = {}
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+        if self.total_bytes > self.max_bytes:
+            self._evict(int(self.max_bytes * RENDER_CACHE_EVICT_RATIO))
+
+    def _load_index(self):
+        for subdir in os.scandir(self.cache_dir):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith('.bin'):
+                    stat = entry.stat()
+                    self._index[entry.name[:-4]] = [stat.st_size, stat.st_mtime]
+                    self.total_bytes += stat.st_size
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.bin")
+
+    # 作業単位の1出力・1サイズ分のキー
+    # image_id: アップロード画像のダイジェスト（画像がなければ None）
+    # size: 出力サイズ（None で WIDTH x HEIGHT）。縮小元のマスターが変わると結果も変わるため、マスターのサイズもキーに含める
+    def output_key(self, job, output_kwargs, image_id=None, size=None):
+        size = tuple(size or (WIDTH, HEIGHT))
+        if self._environment_digest is None:
+            self._environment_digest = render_environment_digest()
+        image_config = job['image_config']
+        if image_config is not None:
+            image_config = {key: value for key, value in image_config.items() if key not in IMAGE_CONFIG_IGNORED_KEYS}
+        return config_digest(
+            self._environment_digest, job['template_type'], job['text_elements'], job['annotation_elements'],
+            image_id, image_config, job['kwargs'], output_kwargs, job['num_frames'], job['num_plays'], job['encode_options'],
+            list(size), list(output_master_size(job_output_sizes(job), size)),
+        )
+
+    # 画像の識別子（設定にダイジェストがあればそれを使う）
+    def image_id(self, image, image_config):
+        if image is None:
+            return None
+        return (image_config or {}).get('digest') or image_digest(image)
+
+    # 戻り値: (APNGデータ, 統計情報) またはキャッシュにない場合は None
+    def get(self, key):
+        path = self._path(key)
+        with self._lock:
+            if key not in self._index:
+                self.misses += 1
+                return None
+        try:
+            with open(path, 'rb') as f:
+                meta_line = f.readline()
+                data = f.read()
+            stats = json.loads(meta_line)
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self._forget(key)
+                self.misses += 1
+            return None
+        with self._lock:
+            if key in self._index:
+                self._index[key][1] = time.time()
+            self.hits += 1
+        return data, stats
+
+    def put(self, key, data, stats):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        payload = json.dumps(stats, ensure_ascii=False).encode('utf-8') + b'\n' + data
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+            os.replace(temp_path, path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        with self._lock:
+            self._forget(key)
+            self._index[key] = [len(payload), time.time()]
+            self.total_bytes += len(payload)
+            if self.total_bytes > self.max_bytes:
+                self._evict(int(self.max_bytes * RENDER_CACHE_EVICT_RATIO))
+
+    def _forget(self, key):
+        entry = self._index.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[0]
+
+    def _evict(self, target_bytes):
+        for key, _ in sorted(self._index.items(), key=lambda item: item[1][1]):
+            if self.total_bytes <= target_bytes:
+                break
+            self._forget(key)
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._index):
+                self._forget(key)
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self._index),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+            }
+
+_render_cache = None
+_render_cache_lock = threading.Lock()
+
+# プロセス内で共有するキャッシュ
+def get_render_cache():
+    global _render_cache
+    with _render_cache_lock:
+        if _render_cache is None:
+            _render_cache = RenderCache()
+        return _render_cache
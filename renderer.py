@@ -0,0 +1,1217 @@
+from PIL import Image, ImageChops, ImageColor, ImageDraw, ImageFont
+from apng_writer import DEFAULT_COMPRESSION_PROFILE, build_delta_frames, build_palette, compress_frame_with_profile, encode_apng, quantize_frames
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from stage_timing import StageTimings, collect_stage_timings, count_stage, stage_timer, timed_stage
+import contextlib
+import functools
+import hashlib
+import io
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import threading
+import warnings
+from collections import OrderedDict, deque
+
+# 描画・エンコード処理（Streamlitに依存しないため、ワーカープロセスからも利用できる）
+
+# グローバル設定
+WIDTH = 600
+HEIGHT = 400
+ICON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "icons")
+
+# アップロード画像の設定
+# 画像の配置サイズは元画像の寸法 × 倍率（上限 MAX_IMAGE_SCALE）で決まり、元画像より大きくなることもある
+# 元画像は全解像度で保持し、キャンバスの MAX_IMAGE_SCALE 倍を覆う縮小版（作業用画像）は配置サイズがそれに収まるときだけ使う
+MAX_IMAGE_SCALE = 2.0
+WORKING_IMAGE_SIZE = (int(WIDTH * MAX_IMAGE_SCALE), int(HEIGHT * MAX_IMAGE_SCALE))
+MAX_UPLOAD_PIXELS = 50_000_000
+
+# キャッシュ設定
+FONT_TYPES = ["ゴシック", "明朝"]
+FONT_WEIGHTS = ["W3", "W4", "W5", "W6", "W7", "W8", "W9"]
+FONT_CACHE_MAX_SIZE = 64
+GLYPH_CACHE_MAX_SIZE = 4096
+GLYPH_CACHE_MAX_BYTES = 64 * 1024 * 1024
+ASSET_CACHE_MAX_SIZE = 256
+ASSET_CACHE_MAX_BYTES = 256 * 1024 * 1024
+METRICS_CACHE_MAX_SIZE = 64
+METRICS_MAX_LINES = 4096
+
+# ヒット・ミス数を記録するスレッドセーフなLRUキャッシュ
+# max_bytes を指定した場合は sizeof で見積もったバイト数でも上限を管理
+class LRUCache:
+    def __init__(self, max_size, max_bytes=None, sizeof=None):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_create(self, key, factory):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key][0]
+            self.misses += 1
+        value = factory()
+        item_bytes = self.sizeof(value) if self.sizeof else 0
+        with self._lock:
+            if key in self._items:
+                self.total_bytes -= self._items.pop(key)[1]
+            self._items[key] = (value, item_bytes)
+            self.total_bytes += item_bytes
+            while len(self._items) > self.max_size or (self.max_bytes is not None and self.total_bytes > self.max_bytes and len(self._items) > 1):
+                self.total_bytes -= self._items.popitem(last=False)[1][1]
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.total_bytes = 0
+
+    # セッションのメモリ管理（session_memory）用：保持しているバイト数と、全件の破棄
+    def memory_bytes(self):
+        with self._lock:
+            return self.total_bytes
+
+    def release_memory(self):
+        with self._lock:
+            released = self.total_bytes
+            self._items.clear()
+            self.total_bytes = 0
+            return released
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self._items),
+                "max_size": self.max_size,
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+# 画像のおおよそのメモリ使用量
+def image_nbytes(img):
+    if img is None:
+        return 0
+    return img.width * img.height * len(img.getbands())
+
+# プロセス内で共有するキャッシュ（モジュールはStreamlitの再実行をまたいで保持される）
+_font_cache = LRUCache(FONT_CACHE_MAX_SIZE)
+_glyph_cache = LRUCache(GLYPH_CACHE_MAX_SIZE, GLYPH_CACHE_MAX_BYTES, lambda glyph: image_nbytes(glyph['image']))
+_asset_cache = LRUCache(ASSET_CACHE_MAX_SIZE, ASSET_CACHE_MAX_BYTES, image_nbytes)
+_metrics_cache = LRUCache(METRICS_CACHE_MAX_SIZE)
+
+# (パス, フェイス番号, サイズ) をキーにした FreeTypeFont のキャッシュ
+def get_font_cache():
+    return _font_cache
+
+# 文字・行単位のグリフ画像キャッシュ
+def get_glyph_cache():
+    return _glyph_cache
+
+# リサイズ済み画像（アップロード画像・アイコン）のキャッシュ
+def get_asset_cache():
+    return _asset_cache
+
+# フォント・サイズごとの寸法テーブルのキャッシュ
+def get_metrics_cache():
+    return _metrics_cache
+
+# 全キャッシュの統計
+def get_cache_stats():
+    return {
+        'font': _font_cache.stats(),
+        'glyph': _glyph_cache.stats(),
+        'asset': _asset_cache.stats(),
+        'metrics': _metrics_cache.stats(),
+    }
+
+# 画像内容のダイジェスト（アップロード時に計算済みの値がない場合のフォールバック）
+def image_digest(img):
+    return hashlib.sha1(img.tobytes()).hexdigest()
+
+# 設定値（dict / list / 数値 / 文字列）から安定したハッシュを作る（dictはキー順に依存しない）
+# 画像が含まれる場合は内容のダイジェストで代用する
+def config_digest(*parts):
+    def encode_value(value):
+        if isinstance(value, Image.Image):
+            return image_digest(value)
+        return repr(value)
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, ensure_ascii=False, default=encode_value).encode('utf-8')).hexdigest()
+
+# (ダイジェスト, サイズ, モード) 単位でリサイズ結果を再利用
+@timed_stage('image_resample')
+def get_resized_image(img, size, digest=None):
+    if digest is None:
+        digest = image_digest(img)
+    size = tuple(size)
+    key = (digest, size, img.mode)
+    def resize():
+        # 作業用画像が配置サイズ以上ならそこから縮小し、そうでなければ元画像からリサイズする（縮小版を拡大しない）
+        working = get_working_image(img, digest)
+        source = working if working.width >= size[0] and working.height >= size[1] else img
+        return source.resize(size, Image.Resampling.LANCZOS)
+    return get_asset_cache().get_or_create(key, resize)
+
+# 作業用画像（max_size を覆う最小の大きさの縮小版）。元画像がそれ以下ならそのまま返す
+# 整数分の1の縮小（reduce）で大まかに縮めてから仕上げのリサイズを行う
+def get_working_image(img, digest, max_size=WORKING_IMAGE_SIZE):
+    ratio = max(max_size[0] / img.width, max_size[1] / img.height)
+    if ratio >= 1:
+        return img
+    target_size = (max(1, math.ceil(img.width * ratio)), max(1, math.ceil(img.height * ratio)))
+    def reduce_image():
+        factor = min(img.width // target_size[0], img.height // target_size[1])
+        working = img.reduce(factor) if factor >= 2 else img
+        return working if working.size == target_size else working.resize(target_size, Image.Resampling.LANCZOS)
+    return get_asset_cache().get_or_create((digest, 'working', max_size, img.mode), reduce_image)
+
+# アップロード画像を全解像度で1回だけデコードする（配置サイズが元画像より大きくなることもあるため縮小しない）
+# モードは RGB（透過がある場合は RGBA）に揃え、画素数の上限を超える画像は読み込まない
+# 戻り値: (画像, 元画像の (幅, 高さ))。配置サイズの計算には元画像の寸法を使う
+def load_upload_image(fp, max_pixels=MAX_UPLOAD_PIXELS):
+    with Image.open(fp) as img:
+        original_size = img.size
+        if img.width * img.height > max_pixels:
+            raise ValueError(f"画像が大きすぎます（{img.width}x{img.height}、{max_pixels / 1_000_000:g}メガピクセルまで）")
+        has_alpha = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+        mode = 'RGBA' if has_alpha else 'RGB'
+        img.load()
+        image = img.convert(mode) if img.mode != mode else img.copy()
+    return image, original_size
+
+# 使用可能なフォントファイルを (font_type, weight) ごとにプロセス内で一度だけ解決
+@functools.lru_cache(maxsize=None)
+def get_font_registry():
+    loadable = {}
+    registry = {}
+    for font_type in FONT_TYPES:
+        for weight in FONT_WEIGHTS:
+            paths = []
+            for font_path in get_font_candidates(font_type, weight):
+                if font_path not in loadable:
+                    try:
+                        ImageFont.truetype(font_path, 10)
+                        loadable[font_path] = True
+                    except Exception:
+                        loadable[font_path] = False
+                if loadable[font_path]:
+                    paths.append(font_path)
+            registry[(font_type, weight)] = paths
+    return registry
+
+# フォント候補パス一覧（優先順）
+def get_font_candidates(font_type="ゴシック", weight="W7"):
+    font_paths = []
+    if font_type == "ゴシック":
+        linux_paths = [
+            "/usr/share/fonts/opentype/noto/NotoSansCJK-Bold.ttc",
+            "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+            "/usr/share/fonts/truetype/noto/NotoSansCJK-Bold.ttc",
+            "/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc",
+            "/usr/share/fonts/opentype/noto/NotoSansMonoCJKjp-Bold.otf",
+            "/usr/share/fonts/opentype/noto/NotoSansMonoCJKjp-Regular.otf",
+        ]
+        font_paths.extend(linux_paths)
+        hiragino_std_paths = {
+            "W3": "/Library/Fonts/ヒラギノ角ゴ Std W4.otf",
+            "W4": "/Library/Fonts/ヒラギノ角ゴ Std W4.otf",
+            "W5": "/Library/Fonts/ヒラギノ角ゴ Std W6.otf",
+            "W6": "/Library/Fonts/ヒラギノ角ゴ Std W6.otf",
+            "W7": "/Library/Fonts/ヒラギノ角ゴ Std W8.otf",
+            "W8": "/Library/Fonts/ヒラギノ角ゴ Std W8.otf",
+            "W9": "/Library/Fonts/ヒラギノ角ゴ Std W8.otf",
+        }
+        hiragino_paths = {
+            "W3": "/System/Library/Fonts/ヒラギノ角ゴシック W3.ttc",
+            "W4": "/System/Library/Fonts/ヒラギノ角ゴシック W4.ttc",
+            "W5": "/System/Library/Fonts/ヒラギノ角ゴシック W5.ttc",
+            "W6": "/System/Library/Fonts/ヒラギノ角ゴシック W6.ttc",
+            "W7": "/System/Library/Fonts/ヒラギノ角ゴシック W7.ttc",
+            "W8": "/System/Library/Fonts/ヒラギノ角ゴシック W8.ttc",
+            "W9": "/System/Library/Fonts/ヒラギノ角ゴシック W9.ttc",
+        }
+        windows_paths = {
+            "W3": ["C:\\Windows\\Fonts\\meiryo.ttc", "C:\\Windows\\Fonts\\YuGothL.ttc"],
+            "W4": ["C:\\Windows\\Fonts\\meiryo.ttc", "C:\\Windows\\Fonts\\YuGothR.ttc"],
+            "W5": ["C:\\Windows\\Fonts\\meiryo.ttc", "C:\\Windows\\Fonts\\YuGothM.ttc"],
+            "W6": ["C:\\Windows\\Fonts\\meiryob.ttc", "C:\\Windows\\Fonts\\YuGothB.ttc"],
+            "W7": ["C:\\Windows\\Fonts\\meiryob.ttc", "C:\\Windows\\Fonts\\YuGothB.ttc"],
+            "W8": ["C:\\Windows\\Fonts\\meiryob.ttc", "C:\\Windows\\Fonts\\YuGothB.ttc"],
+            "W9": ["C:\\Windows\\Fonts\\meiryob.ttc", "C:\\Windows\\Fonts\\YuGothB.ttc"],
+        }
+        if weight in hiragino_std_paths: font_paths.append(hiragino_std_paths[weight])
+        if weight in hiragino_paths: font_paths.append(hiragino_paths[weight])
+        if weight in windows_paths: font_paths.extend(windows_paths[weight])
+        font_paths.extend(["msgothic.ttc", "C:\\Windows\\Fonts\\msgothic.ttc"])
+    else:
+        linux_paths = [
+            "/usr/share/fonts/opentype/noto/NotoSerifCJK-Bold.ttc",
+            "/usr/share/fonts/opentype/noto/NotoSerifCJK-Regular.ttc",
+            "/usr/share/fonts/truetype/noto/NotoSerifCJK-Bold.ttc",
+            "/usr/share/fonts/truetype/noto/NotoSerifCJK-Regular.ttc",
+            "/usr/share/fonts/opentype/noto/NotoSansCJK-Bold.ttc",
+            "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+        ]
+        font_paths.extend(linux_paths)
+        font_paths.extend([
+            "/System/Library/Fonts/ヒラギノ明朝 ProN W6.ttc",
+            "/Library/Fonts/ヒラギノ明朝 Std W6.otf",
+            "/System/Library/Fonts/ヒラギノ明朝 ProN W3.ttc",
+            "/Library/Fonts/ヒラギノ明朝 Std W3.otf",
+            "C:\\Windows\\Fonts\\msmincho.ttc",
+            "msmincho.ttc"
+        ])
+    return font_paths
+
+# 日本語フォント読み込み関数
+@timed_stage('font_load')
+def get_font(font_type="ゴシック", weight="W7", size=40):
+    registry = get_font_registry()
+    font_paths = registry.get((font_type, weight))
+    if font_paths is None:
+        font_paths = get_font_candidates(font_type, weight)
+    font_cache = get_font_cache()
+    for font_path in font_paths:
+        try:
+            return font_cache.get_or_create((font_path, 0, size), lambda: ImageFont.truetype(font_path, size, index=0))
+        except Exception as e:
+            continue
+    warnings.warn("日本語フォントが見つかりませんでした。デフォルトフォントを使用します。")
+    return ImageFont.load_default()
+
+# フォントの寸法テーブル（文字のbbox・行の高さを初回の1回だけ測り、以降は表引きする）
+class FontMetrics:
+    def __init__(self, font):
+        self.font = font
+        self.char_bboxes = {}
+        self.line_heights = {}
+
+    def char_bbox(self, char):
+        bbox = self.char_bboxes.get(char)
+        if bbox is None:
+            bbox = self.char_bboxes[char] = self.font.getbbox(char)
+        return bbox
+
+    def char_width(self, char):
+        bbox = self.char_bbox(char)
+        return bbox[2] - bbox[0]
+
+    # 行の高さ（空行は "A" の高さ）
+    def line_height(self, line):
+        height = self.line_heights.get(line)
+        if height is None:
+            if len(self.line_heights) >= METRICS_MAX_LINES:
+                self.line_heights.clear()
+            bbox = self.font.getbbox(line or "A")
+            height = self.line_heights[line] = bbox[3] - bbox[1]
+        return height
+
+# プレビューと本番描画で共有するフォントの寸法テーブルを取得
+def get_font_metrics(font):
+    return get_metrics_cache().get_or_create((font, font.size), lambda: FontMetrics(font))
+
+# 描画関連関数群
+@timed_stage('glyph_render')
+def draw_text_bold(draw, position, text, font, fill, anchor="mm", is_mincho_bold=False):
+    x, y = position
+    if is_mincho_bold:
+        offsets = [(0, 0), (1, 0), (0, 1), (1, 1)]
+        for dx, dy in offsets:
+            draw.text((x + dx, y + dy), text, fill=fill, font=font, anchor=anchor)
+    else:
+        draw.text((x, y), text, fill=fill, font=font, anchor=anchor)
+
+# アイコン原画像の読み込み（ファイル更新時刻が変わらない限り再読み込みしない）
+@functools.lru_cache(maxsize=32)
+def load_icon_source(icon_path, mtime):
+    with open(icon_path, 'rb') as f:
+        data = f.read()
+    icon = Image.open(io.BytesIO(data)).convert("RGBA")
+    return hashlib.sha1(data).hexdigest(), icon
+
+def load_icon_image(icon_name, size):
+    icon_path = os.path.join(ICON_DIR, icon_name)
+    if os.path.exists(icon_path):
+        digest, icon = load_icon_source(icon_path, os.path.getmtime(icon_path))
+        return get_resized_image(icon, (size, size), digest)
+    return None
+
+# 透過画像の貼り付け（貼り付け先がRGBAの場合はアルファ合成）
+def paste_with_alpha(img, overlay, position):
+    if img.mode != 'RGBA':
+        img.paste(overlay, position, overlay)
+        return
+    x, y = position
+    src_x, src_y = max(0, -x), max(0, -y)
+    if src_x >= overlay.width or src_y >= overlay.height or x >= img.width or y >= img.height:
+        return
+    img.alpha_composite(overlay, (x + src_x, y + src_y), (src_x, src_y))
+
+# 1文字分のグリフ画像を生成（文字中心を基準に描画し、縦横比を適用後に切り抜く）
+@timed_stage('glyph_render')
+def render_glyph(font, char, color, aspect_ratio=1.0, is_mincho_bold=False):
+    temp_size = int(font.size * 3)
+    temp_img = Image.new('RGBA', (temp_size, temp_size), (255, 255, 255, 0))
+    temp_draw = ImageDraw.Draw(temp_img)
+    if is_mincho_bold:
+        offsets = [(0, 0), (1, 0), (0, 1), (1, 1)]
+        for dx, dy in offsets:
+            temp_draw.text((temp_size // 2 + dx, temp_size // 2 + dy), char, fill=color, font=font, anchor="mm")
+    else:
+        temp_draw.text((temp_size // 2, temp_size // 2), char, fill=color, font=font, anchor="mm")
+    
+    
+    if aspect_ratio != 1.0:
+        new_width = int(temp_img.width * aspect_ratio)
+        temp_img = temp_img.resize((new_width, temp_img.height), Image.Resampling.LANCZOS)
+    
+    bbox_img = temp_img.getbbox()
+    return {
+        'image': temp_img.crop(bbox_img) if bbox_img else None,
+        'bbox': bbox_img,
+        'canvas_size': temp_img.size,
+        'width': get_font_metrics(font).char_width(char),
+    }
+
+# キャッシュ済みのグリフを取得
+def get_glyph(font, char, color, aspect_ratio=1.0, is_mincho_bold=False):
+    key = (font, font.size, char, color, aspect_ratio, is_mincho_bold)
+    return get_glyph_cache().get_or_create(key, lambda: render_glyph(font, char, color, aspect_ratio, is_mincho_bold))
+
+# マスクを右・下・右下に1pxずらして重ねる疑似ボールド（4回描画した場合と同じ重なり方になるよう screen で合成）
+def embolden_mask(mask):
+    width, height = mask.size
+    result = mask
+    for dx, dy in [(1, 0), (0, 1), (1, 1)]:
+        shifted = Image.new('L', mask.size, 0)
+        shifted.paste(mask.crop((0, 0, width - dx, height - dy)), (dx, dy))
+        result = ImageChops.screen(result, shifted)
+    return result
+
+# 1行分の文字画像を生成
+# 全文字を文字間隔どおりの位置で1枚のマスクに描画し、疑似ボールドと縦横比の変換は行単位で1回だけ行う
+# offset は行の左端 (start_x) と行の中心 (y) から見た画像の位置、width は行の幅（縦横比・文字間隔込み）
+@timed_stage('glyph_render')
+def render_text_line(font, line, color, char_spacing=0, aspect_ratio=1.0, is_mincho_bold=False):
+    metrics = get_font_metrics(font)
+    canvas_height = int(font.size * 3)
+    margin = font.size
+    char_centers = []
+    current_x = margin
+    for char in line:
+        scaled_width = metrics.char_width(char) * aspect_ratio
+        char_centers.append(current_x + scaled_width / 2)
+        current_x += scaled_width + char_spacing
+    line_width = current_x - char_spacing - margin
+    
+    # 縦横比変換前の座標で描画する
+    mask = Image.new('L', (max(1, int((line_width + margin * 2) / aspect_ratio + 0.5)), canvas_height), 0)
+    mask_draw = ImageDraw.Draw(mask)
+    for char, center_x in zip(line, char_centers):
+        mask_draw.text((center_x / aspect_ratio, canvas_height // 2), char, fill=255, font=font, anchor="mm")
+    if is_mincho_bold:
+        mask = embolden_mask(mask)
+    if aspect_ratio != 1.0:
+        mask = mask.resize((max(1, int(mask.width * aspect_ratio + 0.5)), canvas_height), Image.Resampling.LANCZOS)
+    
+    bbox_img = mask.getbbox()
+    if not bbox_img:
+        return {'image': None, 'offset': (0, 0), 'width': line_width}
+    mask = mask.crop(bbox_img)
+    line_img = Image.new('RGBA', mask.size, color)
+    line_img.putalpha(mask)
+    return {
+        'image': line_img,
+        'offset': (bbox_img[0] - margin, bbox_img[1] - canvas_height // 2),
+        'width': line_width,
+    }
+
+# キャッシュ済みの行画像を取得
+def get_text_line(font, line, color, char_spacing=0, aspect_ratio=1.0, is_mincho_bold=False):
+    key = ('line', font, font.size, line, color, char_spacing, aspect_ratio, is_mincho_bold)
+    return get_glyph_cache().get_or_create(key, lambda: render_text_line(font, line, color, char_spacing, aspect_ratio, is_mincho_bold))
+
+# 文字描画関数（アラインメント対応）
+def draw_text_with_spacing(img, draw, text, x, y, font, color, char_spacing=0, line_spacing=0, aspect_ratio=1.0, is_mincho_bold=False, align="center"):
+    lines = text.split('\n')
+    current_y = y
+    metrics = get_font_metrics(font)
+    
+    for line in lines:
+        if not line:
+            current_y += metrics.line_height(line) + line_spacing
+            continue
+        
+        if char_spacing != 0 or aspect_ratio != 1.0 or align != "center":
+            text_line = get_text_line(font, line, color, char_spacing, aspect_ratio, is_mincho_bold)
+            
+            # アラインメントによる開始位置計算
+            if align == "left":
+                start_x = x
+            elif align == "right":
+                start_x = x - text_line['width']
+            else: # center
+                start_x = x - text_line['width'] / 2
+            
+            if text_line['image'] is not None:
+                offset_x, offset_y = text_line['offset']
+                paste_with_alpha(img, text_line['image'], (int(start_x) + offset_x, int(current_y) + offset_y))
+        else:
+            # 標準描画（アスペクト比1.0、文字間0、中央揃え）
+            draw_text_bold(draw, (x, current_y), line, font, color, "mm", is_mincho_bold)
+        
+        current_y += metrics.line_height(line) + line_spacing
+    
+    return current_y
+
+# 静的レイヤー生成（背景画像）
+def render_background_layer(width, height, uploaded_image, image_config):
+    img = Image.new('RGB', (width, height), 'white')
+    if uploaded_image is not None and image_config is not None:
+        img_scale = image_config.get('scale', 1.0)
+        original_width = image_config.get('original_width', 100)
+        original_height = image_config.get('original_height', 100)
+        img_width = int(original_width * img_scale)
+        img_height = int(original_height * img_scale)
+        img_x = image_config.get('x', width // 2)
+        img_y = image_config.get('y', height // 2)
+        resized_img = get_resized_image(uploaded_image, (img_width, img_height), image_config.get('digest'))
+        paste_x = img_x - img_width // 2
+        paste_y = img_y - img_height // 2
+        if uploaded_image.mode == 'RGBA':
+            img.paste(resized_img, (paste_x, paste_y), resized_img)
+        else:
+            img.paste(resized_img, (paste_x, paste_y))
+    return img
+
+# 静的レイヤー生成（テキスト・注釈、透過RGBA）
+def render_text_layer(width, height, text_elements, annotation_elements):
+    layer = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(layer)
+    for elem in text_elements:
+        if elem.get('enabled', True):
+            font = get_font(elem['font'], elem.get('weight', 'W7'), elem['size'])
+            is_mincho_bold = elem['font'] == "明朝" and elem.get('weight', 'W7') in ["W7", "W8", "W9"]
+            draw_text_with_spacing(layer, draw, elem['text'], elem['x'], elem['y'], font, elem['color'],
+                                 char_spacing=elem.get('char_spacing', 0),
+                                 line_spacing=elem.get('line_spacing', 0),
+                                 aspect_ratio=elem.get('aspect_ratio', 1.0),
+                                 is_mincho_bold=is_mincho_bold,
+                                 align="center")
+    
+    for elem in annotation_elements:
+        if elem.get('enabled', True):
+            font = get_font(elem['font'], elem.get('weight', 'W7'), elem['size'])
+            is_mincho_bold = elem['font'] == "明朝" and elem.get('weight', 'W7') in ["W7", "W8", "W9"]
+            # 注釈は左揃え、アスペクト比対応
+            draw_text_with_spacing(layer, draw, elem['text'], elem['x'], elem['y'], font, elem['color'],
+                                 aspect_ratio=elem.get('aspect_ratio', 1.0),
+                                 is_mincho_bold=is_mincho_bold,
+                                 align="left")
+    return layer
+
+# バリエーション単位の静的レイヤー（背景・テキスト）を生成
+# border_colors / icon_names の全要素で共有できるよう、アニメーション部分は含めない
+@timed_stage('static_layers')
+def render_static_layers(width, height, text_elements, annotation_elements, uploaded_image, image_config):
+    background = render_background_layer(width, height, uploaded_image, image_config)
+    text_layer = render_text_layer(width, height, text_elements, annotation_elements)
+    return {
+        'background': background,
+        'text_layer': text_layer,
+        'text_bbox': text_layer.getbbox(),
+    }
+
+# 背景（＋アニメーション部分）の上にテキストレイヤーを重ねる
+def composite_text_layer(img, static_layers):
+    text_bbox = static_layers['text_bbox']
+    if text_bbox:
+        text_region = static_layers['text_layer'].crop(text_bbox)
+        img.paste(text_region, text_bbox[:2], text_region)
+    return img
+
+# フレームを圧縮（PNGファイル化せず、APNGのフレームデータとして直接使う）
+def encode_frame(img, compression=DEFAULT_COMPRESSION_PROFILE):
+    return compress_frame_with_profile(img, compression)
+
+# フレーム圧縮用スレッドプール（zlib圧縮中はGILが解放されるため複数フレームを並行して圧縮できる）
+# スレッド数1以下ではプールを使わず逐次エンコードする
+# スレッド数はプロセスの既定値（set_encode_threads）を、encode_threads_scope の範囲だけそのスレッドで上書きできる
+# プールはスレッド数ごとに作って使い回し、途中で閉じない（他のバッチが使用中のプールを止めないため）
+DEFAULT_ENCODE_THREADS = min(4, os.cpu_count() or 1)
+_encode_threads = DEFAULT_ENCODE_THREADS
+_encode_executors = {}
+_encode_executor_lock = threading.Lock()
+_encode_state = threading.local()
+
+# プロセスの既定のスレッド数（CLI・ベンチマーク・ワーカープロセスの初期化用）
+def set_encode_threads(num_threads):
+    global _encode_threads
+    _encode_threads = max(1, int(num_threads))
+
+# 現在のスレッドで使うスレッド数
+def get_encode_threads():
+    num_threads = getattr(_encode_state, 'threads', None)
+    return _encode_threads if num_threads is None else num_threads
+
+# with の範囲で現在のスレッドのスレッド数を num_threads にする（None なら既定値のまま）
+@contextlib.contextmanager
+def encode_threads_scope(num_threads):
+    previous = getattr(_encode_state, 'threads', None)
+    _encode_state.threads = previous if num_threads is None else max(1, int(num_threads))
+    try:
+        yield
+    finally:
+        _encode_state.threads = previous
+
+def get_encode_executor():
+    num_threads = get_encode_threads()
+    if num_threads <= 1:
+        return None
+    with _encode_executor_lock:
+        executor = _encode_executors.get(num_threads)
+        if executor is None:
+            executor = _encode_executors[num_threads] = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="frame-encode")
+        return executor
+
+# 圧縮を非同期に開始し Future を返す（逐次モードでは完了済みの Future）
+def encode_frame_async(img, compression=DEFAULT_COMPRESSION_PROFILE):
+    executor = get_encode_executor()
+    if executor is None:
+        future = Future()
+        future.set_result(encode_frame(img, compression))
+        return future
+    return executor.submit(encode_frame, img, compression)
+
+# フレーム画像をまとめて圧縮（同じ画像オブジェクトは1回だけ圧縮する）
+@timed_stage('png_encode')
+def encode_frames(frames, compression=DEFAULT_COMPRESSION_PROFILE):
+    futures = {}
+    for frame in frames:
+        if id(frame) not in futures:
+            futures[id(frame)] = encode_frame_async(frame, compression)
+    return [futures[id(frame)].result() for frame in frames]
+
+# テンプレート関数群
+@timed_stage('frame_build')
+def create_red_border_blink_frames(width, height, text_elements, annotation_elements, uploaded_image, image_config, border_width=13, border_color="red", num_frames=5, static_layers=None):
+    color_map = {"red": "#FF0000", "blue": "#0000FF", "green": "#00FF00", "black": "#000000", "orange": "#FF6600"}
+    border_rgb = color_map.get(border_color, "#FF0000")
+    if static_layers is None:
+        static_layers = render_static_layers(width, height, text_elements, annotation_elements, uploaded_image, image_config)
+    # 点灯・消灯の2種類のみ描画し、各フレームで同じ画像を使い回す
+    on_img = static_layers['background'].copy()
+    draw = ImageDraw.Draw(on_img)
+    draw.rectangle([0, 0, width-1, height-1], outline=border_rgb, width=border_width)
+    composite_text_layer(on_img, static_layers)
+    off_img = composite_text_layer(static_layers['background'].copy(), static_layers)
+    return [on_img if i % 2 == 0 else off_img for i in range(num_frames)]
+
+@timed_stage('frame_build')
+def create_corner_icon_blink_frames(width, height, text_elements, annotation_elements, uploaded_image, image_config, icon_name="check.png", icon_size=85, num_frames=5, static_layers=None):
+    if static_layers is None:
+        static_layers = render_static_layers(width, height, text_elements, annotation_elements, uploaded_image, image_config)
+    off_img = composite_text_layer(static_layers['background'].copy(), static_layers)
+    icon_img = load_icon_image(icon_name, icon_size)
+    if not icon_img:
+        return [off_img] * num_frames
+    on_img = static_layers['background'].copy()
+    positions = [(10, 10), (width - icon_size - 10, 10),
+                (10, height - icon_size - 10), (width - icon_size - 10, height - icon_size - 10)]
+    for pos in positions:
+        on_img.paste(icon_img, pos, icon_img)
+    composite_text_layer(on_img, static_layers)
+    return [on_img if i % 2 == 0 else off_img for i in range(num_frames)]
+
+# アイコン増加用の静的レイヤー（テキスト行はアニメーション部分なので注釈のみ）
+def render_icon_increase_static_layers(width, height, annotation_elements, uploaded_image, image_config):
+    return render_static_layers(width, height, [], annotation_elements, uploaded_image, image_config)
+
+# アイコン増加の1行分（左揃えのテキストと、1文字目の左に置くアイコン）を透過画像に描画
+# 戻り値: (行画像, (x, y))。行の中心が y の位置にあるとき、行画像を (x, y + offset_y) に貼る
+def render_icon_increase_row(width, font, text_content, text_color, text_x, char_spacing, aspect_ratio, is_mincho_bold, icon_img, icon_size, icon_gap):
+    row_height = max(int(font.size * 3), icon_size) * 2
+    row_y = row_height // 2
+    row_img = Image.new('RGBA', (width, row_height), (0, 0, 0, 0))
+    
+    first_char_left_edge = None
+    current_x = text_x
+    for char_idx, char in enumerate(text_content):
+        glyph = get_glyph(font, char, text_color, aspect_ratio, is_mincho_bold)
+        scaled_char_width = glyph['width'] * aspect_ratio
+        
+        bbox_img = glyph['bbox']
+        if bbox_img:
+            paste_x = int(current_x + bbox_img[0])
+            paste_y = int(row_y - glyph['canvas_size'][1] // 2 + bbox_img[1])
+            if char_idx == 0: first_char_left_edge = paste_x
+            paste_with_alpha(row_img, glyph['image'], (paste_x, paste_y))
+            current_x += scaled_char_width + char_spacing
+        else:
+            current_x += scaled_char_width + char_spacing
+            if char_idx == 0: first_char_left_edge = current_x
+    
+    if first_char_left_edge is not None:
+        icon_x = int(first_char_left_edge - icon_size - icon_gap)
+    else:
+        icon_x = text_x - icon_size - icon_gap
+    
+    if icon_img:
+        paste_with_alpha(row_img, icon_img, (icon_x, row_y - icon_size // 2))
+    
+    bbox_row = row_img.getbbox()
+    if not bbox_row:
+        return None, (0, 0)
+    return row_img.crop(bbox_row), (bbox_row[0], bbox_row[1] - row_y)
+
+@timed_stage('frame_build')
+def create_icon_increase_frames(width, height, icon_text_config, annotation_elements, uploaded_image, image_config, icon_name="check.png", icon_size=60, num_frames=5, static_layers=None):
+    frames = []
+    text_content = icon_text_config.get('text', 'サンプルテキスト').replace('\n', '')
+    text_font_type = icon_text_config.get('font', 'ゴシック')
+    text_weight = icon_text_config.get('weight', 'W7')
+    text_size = icon_text_config.get('icon_size', 40)
+    text_color = icon_text_config.get('color', '#000000')
+    text_x = icon_text_config.get('icon_x', 74)
+    text_y_base = icon_text_config.get('icon_y', 320)
+    char_spacing = icon_text_config.get('icon_char_spacing', 0)
+    aspect_ratio = icon_text_config.get('icon_aspect_ratio', 1.0)
+    row_spacing = icon_text_config.get('icon_row_spacing', 62)
+    is_mincho_bold = text_font_type == "明朝" and text_weight in ["W7", "W8", "W9"]
+    if static_layers is None:
+        static_layers = render_icon_increase_static_layers(width, height, annotation_elements, uploaded_image, image_config)
+    icon_img = load_icon_image(icon_name, icon_size)
+    font = get_font(text_font_type, text_weight, text_size)
+    
+    # 1行分（テキスト＋アイコン）を1回だけ描画し、フレームごとに1行ずつ上へ積み重ねる
+    # フレームNの行はフレームN-1と同じ位置にあり、一番上に1行増えるだけなので、行が重ならなければ前フレームに1行貼るだけでよい
+    # 行同士が重なる場合は、下の行が手前になる元の描画順を保つため全行を上から貼り直す
+    row_img, (row_offset_x, row_offset_y) = render_icon_increase_row(
+        width, font, text_content, text_color, text_x, char_spacing, aspect_ratio, is_mincho_bold, icon_img, icon_size, 5
+    )
+    rows_overlap = row_img is not None and row_img.height > row_spacing
+    rows_img = static_layers['background'].copy()
+    for frame_idx in range(num_frames):
+        if row_img is None:
+            img = rows_img.copy()
+        elif rows_overlap:
+            img = static_layers['background'].copy()
+            start_y = text_y_base - frame_idx * row_spacing
+            for line_idx in range(frame_idx + 1):
+                img.paste(row_img, (row_offset_x, start_y + line_idx * row_spacing + row_offset_y), row_img)
+        else:
+            rows_img.paste(row_img, (row_offset_x, text_y_base - frame_idx * row_spacing + row_offset_y), row_img)
+            img = rows_img.copy()
+        
+        composite_text_layer(img, static_layers)
+        frames.append(img)
+    return frames
+
+# 連続する同一フレームを1フレームにまとめ、表示時間を合算する
+# 同じ画像オブジェクトは比較を省略し、それ以外はピクセル比較（圧縮済みフレームはデータ比較）
+def dedupe_frames(frames, delays):
+    merged_frames = []
+    merged_delays = []
+    for frame, delay in zip(frames, delays):
+        if merged_frames and is_same_frame(merged_frames[-1], frame):
+            merged_delays[-1] += delay
+        else:
+            merged_frames.append(frame)
+            merged_delays.append(delay)
+    return merged_frames, merged_delays
+
+def is_same_frame(a, b):
+    if a is b:
+        return True
+    if isinstance(a, Image.Image) and isinstance(b, Image.Image):
+        if a.size != b.size or a.mode != b.mode:
+            return False
+        return ImageChops.difference(a, b).getbbox() is None
+    return a == b
+
+# フレーム画像からAPNGを生成
+# delta_frames: 2フレーム目以降を前フレームとの差分矩形だけで出力する
+# palette_colors: 指定するとアニメーション全体で共通のパレットに減色し、8bitインデックスカラーで出力する
+# palette: 一括生成で共有するパレット画像（build_batch_palette で作成）。指定時は palette_colors より優先
+# compression: 圧縮プロファイル（fast / balanced / max）
+def save_apng(frames, num_frames, num_plays=4, delays=None, delta_frames=True, palette_colors=None, dither=True, palette=None, compression=DEFAULT_COMPRESSION_PROFILE):
+    if delays is None:
+        delays = [1000 // num_frames] * len(frames)
+    count_stage('frames', len(frames))
+    with stage_timer('apng_assemble'):
+        frames, delays = dedupe_frames(frames, delays)
+    use_delta = delta_frames and len(frames) > 1
+    if palette_colors or palette is not None:
+        with stage_timer('quantize'):
+            if palette is None:
+                palette = build_palette(frames, palette_colors, reserve_transparent=use_delta)
+            transparent_index = None
+            if use_delta:
+                transparent_index = len(palette.getpalette()) // 3
+                if transparent_index > 255:
+                    raise ValueError("差分フレームで使う透明色のためにパレットを255色以下にしてください")
+            frames = quantize_frames(frames, palette, dither, transparent_index)
+    frame_options = {}
+    if use_delta:
+        with stage_timer('delta'):
+            frames, frame_options = build_delta_frames(frames)
+    encoded_frames = encode_frames(frames, compression)
+    count_stage('encoded_frames', len(encoded_frames))
+    with stage_timer('apng_assemble'):
+        apng_data = encode_apng(encoded_frames, delays, num_plays=num_plays, **frame_options)
+    count_stage('apng_files')
+    count_stage('apng_bytes', len(apng_data))
+    return apng_data
+
+def create_preview_image(text_elements, annotation_elements, uploaded_image, image_config, template_type, scale=0.5, **kwargs):
+    preview_width = int(WIDTH * scale)
+    preview_height = int(HEIGHT * scale)
+    img = Image.new('RGB', (preview_width, preview_height), 'white')
+    draw = ImageDraw.Draw(img)
+    if uploaded_image is not None and image_config is not None:
+        img_scale = image_config.get('scale', 1.0)
+        original_width = image_config.get('original_width', 100)
+        original_height = image_config.get('original_height', 100)
+        img_width = int(original_width * img_scale * scale)
+        img_height = int(original_height * img_scale * scale)
+        img_x = int(image_config.get('x', WIDTH // 2) * scale)
+        img_y = int(image_config.get('y', HEIGHT // 2) * scale)
+        resized_img = get_resized_image(uploaded_image, (img_width, img_height), image_config.get('digest'))
+        paste_x = img_x - img_width // 2
+        paste_y = img_y - img_height // 2
+        if uploaded_image.mode == 'RGBA':
+            img.paste(resized_img, (paste_x, paste_y), resized_img)
+        else:
+            img.paste(resized_img, (paste_x, paste_y))
+    
+    if template_type == "赤枠点滅":
+        border_width = max(1, int(kwargs.get('border_width', 13) * scale))
+        border_color = kwargs.get('border_color', 'red')
+        color_map = {"red": "#FF0000", "blue": "#0000FF", "green": "#00FF00", "black": "#000000", "orange": "#FF6600"}
+        draw.rectangle([0, 0, preview_width-1, preview_height-1], outline=color_map.get(border_color, "#FF0000"), width=border_width)
+    elif template_type == "4隅アイコン点滅":
+        icon_size = int(kwargs.get('icon_size', 85) * scale)
+        icon_name = kwargs.get('icon_name', 'check.png')
+        icon_img = load_icon_image(icon_name, icon_size)
+        if icon_img:
+            positions = [(10, 10), (preview_width - icon_size - 10, 10),
+                        (10, preview_height - icon_size - 10), (preview_width - icon_size - 10, preview_height - icon_size - 10)]
+            for pos in positions: img.paste(icon_img, pos, icon_img)
+    elif template_type == "アイコン増加":
+        icon_text_config = text_elements[0]
+        text_content = icon_text_config.get('text', 'サンプルテキスト').replace('\n', '')
+        text_font_type = icon_text_config.get('font', 'ゴシック')
+        text_weight = icon_text_config.get('weight', 'W7')
+        text_size = int(icon_text_config.get('icon_size', 40) * scale)
+        text_color = icon_text_config.get('color', '#000000')
+        text_x = int(icon_text_config.get('icon_x', 74) * scale)
+        text_y_base = int(icon_text_config.get('icon_y', 320) * scale)
+        char_spacing = int(icon_text_config.get('icon_char_spacing', 0) * scale)
+        aspect_ratio = icon_text_config.get('icon_aspect_ratio', 1.0)
+        row_spacing = int(icon_text_config.get('icon_row_spacing', 62) * scale)
+        icon_size = int(kwargs.get('icon_size', 60) * scale)
+        icon_name = kwargs.get('icon_name', 'check.png')
+        is_mincho_bold = text_font_type == "明朝" and text_weight in ["W7", "W8", "W9"]
+        num_lines = 5
+        start_y = text_y_base - ((num_lines - 1) * row_spacing)
+        icon_img = load_icon_image(icon_name, icon_size)
+        font = get_font(text_font_type, text_weight, text_size)
+        
+        row_img, (row_offset_x, row_offset_y) = render_icon_increase_row(
+            preview_width, font, text_content, text_color, text_x, char_spacing, aspect_ratio, is_mincho_bold, icon_img, icon_size, int(5 * scale)
+        )
+        if row_img is not None:
+            for line_idx in range(num_lines):
+                current_y = start_y + (line_idx * row_spacing)
+                img.paste(row_img, (row_offset_x, current_y + row_offset_y), row_img)
+    
+    if template_type != "アイコン増加":
+        for elem in text_elements:
+            if elem.get('enabled', True):
+                font = get_font(elem['font'], elem.get('weight', 'W7'), int(elem['size'] * scale))
+                scaled_x = int(elem['x'] * scale)
+                scaled_y = int(elem['y'] * scale)
+                scaled_char_spacing = int(elem.get('char_spacing', 0) * scale)
+                scaled_line_spacing = int(elem.get('line_spacing', 0) * scale)
+                is_mincho_bold = elem['font'] == "明朝" and elem.get('weight', 'W7') in ["W7", "W8", "W9"]
+                draw_text_with_spacing(img, draw, elem['text'], scaled_x, scaled_y, font, elem['color'],
+                                     char_spacing=scaled_char_spacing,
+                                     line_spacing=scaled_line_spacing,
+                                     aspect_ratio=elem.get('aspect_ratio', 1.0),
+                                     is_mincho_bold=is_mincho_bold,
+                                     align="center")
+    
+    for elem in annotation_elements:
+        if elem.get('enabled', True):
+            font = get_font(elem['font'], elem.get('weight', 'W7'), int(elem['size'] * scale))
+            is_mincho_bold = elem['font'] == "明朝" and elem.get('weight', 'W7') in ["W7", "W8", "W9"]
+            draw_text_with_spacing(img, draw, elem['text'], int(elem['x'] * scale), int(elem['y'] * scale), font, elem['color'],
+                                 aspect_ratio=elem.get('aspect_ratio', 1.0),
+                                 is_mincho_bold=is_mincho_bold,
+                                 align="left")
+    
+    return img
+
+# 一括生成で共有するパレット（アップロード画像を配置した背景と、テキスト・枠線・アイコンの色から作成）
+def build_batch_palette(images, image_configs, flat_colors, icon_names=(), palette_colors=256, reserve_transparent=True):
+    samples = [render_background_layer(WIDTH, HEIGHT, image, image_config) for image, image_config in zip(images, image_configs)]
+    swatch_size = 16
+    swatches = Image.new('RGB', (swatch_size * max(1, len(flat_colors)), swatch_size), 'white')
+    for color_idx, color in enumerate(flat_colors):
+        swatches.paste(ImageColor.getrgb(color), (color_idx * swatch_size, 0, (color_idx + 1) * swatch_size, swatch_size))
+    samples.append(swatches)
+    for icon_name in icon_names:
+        icon_img = load_icon_image(icon_name, 64)
+        if icon_img:
+            icon_sample = Image.new('RGB', icon_img.size, 'white')
+            icon_sample.paste(icon_img, (0, 0), icon_img)
+            samples.append(icon_sample)
+    return build_palette(samples, palette_colors, reserve_transparent=reserve_transparent)
+
+# 一括生成のワーカー数（既定はCPUコア数）
+DEFAULT_MAX_WORKERS = os.cpu_count() or 1
+
+# テンプレート名とフレーム生成関数の対応
+TEMPLATE_FRAME_BUILDERS = {
+    "赤枠点滅": create_red_border_blink_frames,
+    "4隅アイコン点滅": create_corner_icon_blink_frames,
+    "アイコン増加": create_icon_increase_frames,
+}
+
+# ワーカープロセスが保持するアップロード画像（プール初期化時に一度だけ受け取る）
+_worker_images = {}
+
+def _init_worker(images):
+    global _worker_images
+    _worker_images = images
+    # プロセス並列時はフレーム単位のスレッド並列を使わない（コアの奪い合いを避ける）
+    set_encode_threads(1)
+
+# 出力サイズ
+# レイアウト（座標・文字サイズ・間隔・枠線幅など）は WIDTH x HEIGHT のキャンバス基準で指定する
+# 縦横比が同じサイズは一番大きいサイズ（マスター）で1回だけ描画し、他のサイズはマスターのフレームを縮小して作る
+# 縦横比が異なるサイズは、座標を幅・高さそれぞれの比率で、大きさを小さい方の比率で配置し直したマスターを別に描画する
+OUTPUT_ASPECT_TOLERANCE = 0.01
+MAX_OUTPUT_SIZE = 4096
+
+# 配置し直すときに横・縦の比率を掛ける座標と、小さい方の比率を掛ける大きさ（1以上）・間隔
+LAYOUT_X_KEYS = ('x', 'icon_x')
+LAYOUT_Y_KEYS = ('y', 'icon_y')
+LAYOUT_SIZE_KEYS = ('size', 'icon_size', 'border_width')
+LAYOUT_SPACING_KEYS = ('char_spacing', 'line_spacing', 'icon_char_spacing', 'icon_row_spacing')
+
+# 作業単位の出力サイズのリスト（指定がなければ WIDTH x HEIGHT のみ）
+def job_output_sizes(job):
+    return [tuple(size) for size in job.get('sizes') or [(WIDTH, HEIGHT)]]
+
+# 出力サイズが複数ある場合は、ファイル名の拡張子の前にサイズを付ける（例: a.png -> a_300x200.png）
+def sized_filename(filename, size, sizes):
+    if len(sizes) <= 1:
+        return filename
+    base, ext = os.path.splitext(filename)
+    return f"{base}_{size[0]}x{size[1]}{ext}"
+
+# 縦横比ごとにまとめる
+# 戻り値: [(マスターのサイズ, [そのマスターから作るサイズ...]), ...]
+def group_output_sizes(sizes):
+    groups = []
+    for size in sorted(set(sizes), key=lambda size: -size[0] * size[1]):
+        aspect = size[0] / size[1]
+        for master, members in groups:
+            master_aspect = master[0] / master[1]
+            if abs(aspect - master_aspect) <= master_aspect * OUTPUT_ASPECT_TOLERANCE:
+                members.append(size)
+                break
+        else:
+            groups.append((size, [size]))
+    return groups
+
+# size の縮小元になるマスターのサイズ
+def output_master_size(sizes, size):
+    for master, members in group_output_sizes(sizes):
+        if tuple(size) in members:
+            return master
+    return tuple(size)
+
+# WIDTH x HEIGHT 基準の要素（テキスト・注釈・画像設定・テンプレート引数）を横 sx 倍・縦 sy 倍のキャンバスに合わせる
+def scale_layout(elem, sx, sy):
+    if elem is None or (sx == 1 and sy == 1):
+        return elem
+    s = min(sx, sy)
+    scaled = dict(elem)
+    for key in LAYOUT_X_KEYS:
+        if key in scaled:
+            scaled[key] = int(round(scaled[key] * sx))
+    for key in LAYOUT_Y_KEYS:
+        if key in scaled:
+            scaled[key] = int(round(scaled[key] * sy))
+    for key in LAYOUT_SIZE_KEYS:
+        if key in scaled:
+            scaled[key] = max(1, int(round(scaled[key] * s)))
+    for key in LAYOUT_SPACING_KEYS:
+        if key in scaled:
+            scaled[key] = int(round(scaled[key] * s))
+    if 'scale' in scaled:
+        scaled['scale'] = scaled['scale'] * s
+    return scaled
+
+# マスターのフレームを縮小する（同じフレームオブジェクトは1回だけ縮小する）
+# 整数分の1の縮小は画素の平均（reduce）で、それ以外は LANCZOS で縮小する
+@timed_stage('downscale')
+def downscale_frames(frames, size):
+    size = tuple(size)
+    if not frames or frames[0].size == size:
+        return frames
+    master_width, master_height = frames[0].size
+    if master_width % size[0] == 0 and master_height % size[1] == 0:
+        factor = (master_width // size[0], master_height // size[1])
+        resize = lambda frame: frame.reduce(factor)
+    else:
+        resize = lambda frame: frame.resize(size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+    resized = {}
+    result = []
+    for frame in frames:
+        if id(frame) not in resized:
+            resized[id(frame)] = resize(frame)
+        result.append(resized[id(frame)])
+    return result
+
+# 一括生成の作業単位（テキスト×注釈×画像の1組・1テンプレート分）を作成
+# outputs は (ファイル名, テンプレート固有パラメータ) のリストで、同じ静的レイヤーを共有する
+# 画像本体は image_key で参照し、作業単位ごとには送らない
+# encode_options は save_apng へ渡すエンコード設定
+# sizes: 出力サイズ [(幅, 高さ), ...]（None で WIDTH x HEIGHT のみ）。出力ファイルは outputs ごとに sizes の順に並ぶ
+def build_batch_job(template_type, text_elements, annotation_elements, image_key, image_config, outputs, num_frames, num_plays, encode_options=None, sizes=None, **kwargs):
+    if image_config is not None:
+        image_config = {key: value for key, value in image_config.items() if key != 'image'}
+    return {
+        'template_type': template_type,
+        'text_elements': text_elements,
+        'annotation_elements': annotation_elements,
+        'image_key': image_key,
+        'image_config': image_config,
+        'outputs': outputs,
+        'num_frames': num_frames,
+        'num_plays': num_plays,
+        'encode_options': encode_options or {},
+        'sizes': [tuple(size) for size in sizes] if sizes else None,
+        'kwargs': kwargs,
+    }
+
+# 作業単位を1つ処理し、(ファイル名, APNGデータ) のリストとキャッシュ統計を返す
+# job['collect_timings'] が真の場合は処理段階ごとの所要時間（'timings'）も返す
+def render_batch_job(job, images=None):
+    timings = StageTimings() if job.get('collect_timings') else None
+    with collect_stage_timings(timings):
+        result = _render_batch_job(job, images)
+    if timings is not None:
+        result['timings'] = dict(timings.to_dict(), template_type=job['template_type'],
+                                 files=[filename for filename, _ in job['outputs']], pid=result['pid'])
+    return result
+
+def _render_batch_job(job, images=None):
+    if images is None:
+        images = _worker_images
+    uploaded_image = images.get(job['image_key'])
+    template_type = job['template_type']
+    frame_builder = TEMPLATE_FRAME_BUILDERS[template_type]
+    encode_options = job['encode_options']
+    is_palette_mode = bool(encode_options.get('palette_colors') or encode_options.get('palette') is not None)
+    sizes = job_output_sizes(job)
+    # job['render_sizes']: エンコードするサイズ（キャッシュにあるサイズを除く。縮小元のマスターは sizes 全体で決まる）
+    render_sizes = [tuple(size) for size in job.get('render_sizes') or sizes]
+    rendered = {}
+    for master_size, group_sizes in group_output_sizes(sizes):
+        group_sizes = [size for size in group_sizes if size in render_sizes]
+        if not group_sizes:
+            continue
+        # 縦横比ごとにマスターのサイズで配置し直して描画する
+        width, height = master_size
+        sx, sy = width / WIDTH, height / HEIGHT
+        text_elements = [scale_layout(elem, sx, sy) for elem in job['text_elements']]
+        annotation_elements = [scale_layout(elem, sx, sy) for elem in job['annotation_elements']]
+        image_config = scale_layout(job['image_config'], sx, sy)
+        template_kwargs = scale_layout(job['kwargs'], sx, sy)
+        if template_type == "アイコン増加":
+            text_arg = text_elements[0]
+            static_layers = render_icon_increase_static_layers(width, height, annotation_elements, uploaded_image, image_config)
+        else:
+            text_arg = text_elements
+            static_layers = render_static_layers(width, height, text_elements, annotation_elements, uploaded_image, image_config)
+        for filename, output_kwargs in job['outputs']:
+            master_frames = frame_builder(
+                width, height, text_arg, annotation_elements,
+                uploaded_image, image_config,
+                num_frames=job['num_frames'],
+                static_layers=static_layers,
+                **template_kwargs, **output_kwargs
+            )
+            for size in group_sizes:
+                frames = downscale_frames(master_frames, size)
+                apng_data = save_apng(frames, num_frames=job['num_frames'], num_plays=job['num_plays'], **encode_options)
+                stats = {'bytes': len(apng_data)}
+                if is_palette_mode:
+                    # 削減量を報告するため、フルカラーでのサイズも計測する（内訳はエンコード段階に含めない）
+                    truecolor_options = {key: value for key, value in encode_options.items() if key not in ('palette_colors', 'palette', 'dither')}
+                    with stage_timer('truecolor_reference'), collect_stage_timings(None):
+                        stats['truecolor_bytes'] = len(save_apng(frames, num_frames=job['num_frames'], num_plays=job['num_plays'], **truecolor_options))
+                rendered[(filename, size)] = (apng_data, stats)
+    files = []
+    file_stats = []
+    for filename, _ in job['outputs']:
+        for size in sizes:
+            if (filename, size) not in rendered:
+                continue
+            apng_data, stats = rendered[(filename, size)]
+            output_filename = sized_filename(filename, size, sizes)
+            files.append((output_filename, apng_data))
+            file_stats.append(dict(stats, filename=output_filename))
+    return {'files': files, 'file_stats': file_stats, 'pid': os.getpid(), 'cache_stats': get_cache_stats()}
+
+# プロセスごとのキャッシュ統計を合算
+def merge_cache_stats(stats_list):
+    merged = {}
+    for stats in stats_list:
+        for name, cache_stats in stats.items():
+            total = merged.setdefault(name, {key: 0 for key in ("hits", "misses", "size", "bytes")})
+            for key in total:
+                total[key] += cache_stats[key]
+    for total in merged.values():
+        lookups = total["hits"] + total["misses"]
+        total["hit_rate"] = total["hits"] / lookups if lookups else 0.0
+    return merged
+
+# 作業単位をプロセスプールで並列処理し、結果を投入順に1つずつ返す
+# 同時に投入する作業単位を制限し、未回収の結果がバッチ全体分メモリに溜まらないようにする
+# encode_threads: プロセス内で処理する場合（max_workers が1）のフレームエンコードのスレッド数（None でプロセスの既定値）
+def iter_batch_results(jobs, images, max_workers=DEFAULT_MAX_WORKERS, encode_threads=None):
+    max_workers = max(1, min(max_workers, len(jobs)))
+    if max_workers == 1:
+        for job in jobs:
+            with encode_threads_scope(encode_threads):
+                result = render_batch_job(job, images)
+            yield result
+        return
+    # Streamlitサーバーのスレッドを引き継がないよう spawn で起動
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context,
+                             initializer=_init_worker, initargs=(images,)) as executor:
+        job_iter = iter(jobs)
+        pending = deque(executor.submit(render_batch_job, job) for job in itertools.islice(job_iter, max_workers * 2))
+        try:
+            while pending:
+                result = pending.popleft().result()
+                for job in itertools.islice(job_iter, 1):
+                    pending.append(executor.submit(render_batch_job, job))
+                yield result
+        finally:
+            # 途中で打ち切られた場合は、開始前の作業単位を取り消してから終了を待つ
+            for future in pending:
+                future.cancel()
+
+# 作業単位を並列処理する
+# 結果は作業単位の投入順（＝ファイル名の連番順）で返す
+# sink（add(ファイル名, データ) を持つ出力先。BatchArchive など）を指定すると、完成したファイルを順次 sink へ渡し、
+# 戻り値のリストにはデータを溜めない
+# collect_timings: 作業単位ごとに処理段階の所要時間を計測し、統計の 'timings' に作業単位の順で入れる
+# cache: 生成済みAPNGのキャッシュ（render_cache.RenderCache）。ヒットした出力は描画せず、統計の 'render_cache' にヒット数を入れる
+# cancel_event: セットされると残りの作業単位を処理せずに終了し、統計の 'cancelled' を真にする
+# encode_threads: プロセス内で処理する場合のフレームエンコードのスレッド数（ワーカープロセスでは常に1）。実際に使った値は統計の 'encode_threads' に入れる
+# 戻り値: (ファイル名, APNGデータ) のリストと、統計 {'cache': キャッシュ統計, 'files': ファイルごとのサイズ}
+def run_batch_jobs(jobs, images, max_workers=DEFAULT_MAX_WORKERS, sink=None, collect_timings=False, cache=None, cancel_event=None, encode_threads=None):
+    if collect_timings:
+        jobs = [dict(job, collect_timings=True) for job in jobs]
+    
+    # キャッシュにある出力は描画せず、残りの出力だけの作業単位を処理する
+    plans = []
+    render_jobs = []
+    cache_hits = 0
+    with stage_timer('cache_lookup'):
+        image_ids = {}
+        for job in jobs:
+            keys = {}
+            cached = {}
+            sizes = job_output_sizes(job)
+            if cache is not None:
+                if job['image_key'] not in image_ids:
+                    image_ids[job['image_key']] = cache.image_id(images.get(job['image_key']), job['image_config'])
+                for filename, output_kwargs in job['outputs']:
+                    for size in sizes:
+                        output_filename = sized_filename(filename, size, sizes)
+                        keys[output_filename] = cache.output_key(job, output_kwargs, image_ids[job['image_key']], size)
+                        entry = cache.get(keys[output_filename])
+                        if entry is not None:
+                            cached[output_filename] = entry
+                cache_hits += len(cached)
+            # 一部のサイズだけキャッシュにない出力は、マスターから描画してキャッシュにないサイズだけエンコードする
+            missing = []
+            missing_sizes = []
+            for output in job['outputs']:
+                output_missing_sizes = [size for size in sizes if sized_filename(output[0], size, sizes) not in cached]
+                if output_missing_sizes:
+                    missing.append(output)
+                    missing_sizes.extend(size for size in output_missing_sizes if size not in missing_sizes)
+            if missing:
+                render_jobs.append(dict(job, outputs=missing, render_sizes=missing_sizes) if cached else job)
+            plans.append((job, keys, cached, bool(missing)))
+    
+    generated_files = []
+    file_stats = []
+    job_timings = []
+    latest_stats = {}
+    cancelled = False
+    with stage_timer('render_jobs'):
+        results = iter_batch_results(render_jobs, images, max_workers, encode_threads)
+        for job, keys, cached, needs_render in plans:
+            if cancel_event is not None and cancel_event.is_set():
+                cancelled = True
+                break
+            rendered = {}
+            if needs_render:
+                result = next(results)
+                latest_stats[result['pid']] = result['cache_stats']
+                if 'timings' in result:
+                    job_timings.append(result['timings'])
+                rendered_stats = {stats['filename']: stats for stats in result['file_stats']}
+                for filename, apng_data in result['files']:
+                    stats = {key: value for key, value in rendered_stats[filename].items() if key != 'filename'}
+                    rendered[filename] = (apng_data, stats)
+                    if cache is not None and filename not in cached:
+                        with stage_timer('cache_store'):
+                            cache.put(keys[filename], apng_data, stats)
+            sizes = job_output_sizes(job)
+            for filename, _ in job['outputs']:
+                for size in sizes:
+                    output_filename = sized_filename(filename, size, sizes)
+                    apng_data, stats = cached[output_filename] if output_filename in cached else rendered[output_filename]
+                    file_stats.append(dict(stats, filename=output_filename, cached=output_filename in cached))
+                    if sink is None:
+                        generated_files.append((output_filename, apng_data))
+                    else:
+                        with stage_timer('output_write'):
+                            sink.add(output_filename, apng_data)
+        results.close()
+    batch_stats = {
+        'cache': merge_cache_stats(latest_stats.values()),
+        'files': file_stats,
+        'cancelled': cancelled,
+        'encode_threads': 1 if min(max_workers, len(render_jobs)) > 1 else (get_encode_threads() if encode_threads is None else max(1, int(encode_threads))),
+    }
+    if collect_timings:
+        batch_stats['timings'] = job_timings
+    if cache is not None:
+        batch_stats['render_cache'] = dict(cache.stats(), batch_hits=cache_hits, batch_misses=len(file_stats) - cache_hits)
+    return generated_files, batch_stats
@@ -0,0 +1,157 @@
+from PIL import Image
+import os
+import tempfile
+import threading
+import time
+import weakref
+
+from renderer import image_nbytes
+
+# セッションが保持する大きなオブジェクト（アップロード画像・プレビュー・生成結果）のプロセス全体のメモリ管理
+# 管理対象は memory_bytes()（メモリ上にあるバイト数）と release_memory()（メモリを解放し、解放したバイト数を返す）を持つ
+# 合計が上限を超えたときは最後に操作された時刻が古いセッションから、一定時間操作のないセッションは上限に関係なく解放する
+# 解放後、アップロード画像とZIPは一時ファイルから読み直し、プレビューは次の表示時に再描画される
+# 管理対象は弱参照で保持するため、セッションが破棄されれば自動的に対象から外れる
+
+# 上限と、放置とみなすまでの時間（環境変数で変更可能）
+SESSION_MEMORY_BUDGET = int(float(os.environ.get('APNG_SESSION_MEMORY_MB', 1024)) * 1024 * 1024)
+SESSION_IDLE_SECONDS = float(os.environ.get('APNG_SESSION_IDLE_SECONDS', 30 * 60))
+
+_spill_dir = None
+_spill_dir_lock = threading.Lock()
+
+# 退避先の一時ディレクトリ（プロセスごとに1つ）
+def get_spill_dir():
+    global _spill_dir
+    with _spill_dir_lock:
+        if _spill_dir is None:
+            _spill_dir = tempfile.mkdtemp(prefix='apng_session_')
+        return _spill_dir
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+# ディスクへ退避できる画像（退避後は get() の呼び出し時に読み直す）
+class SpillableImage:
+    def __init__(self, image):
+        self._image = image
+        self._path = None
+        self._lock = threading.Lock()
+        self.size = image.size
+        self.mode = image.mode
+
+    def get(self):
+        with self._lock:
+            if self._image is None:
+                with Image.open(self._path) as img:
+                    img.load()
+                    self._image = img.copy()
+            return self._image
+
+    @property
+    def spilled(self):
+        return self._image is None
+
+    def memory_bytes(self):
+        return image_nbytes(self._image)
+
+    # PNG（低圧縮・可逆）で一時ファイルへ書き出してから手放す。書き出しは初回だけ
+    def release_memory(self):
+        with self._lock:
+            if self._image is None:
+                return 0
+            if self._path is None:
+                fd, path = tempfile.mkstemp(suffix='.png', dir=get_spill_dir())
+                os.close(fd)
+                self._image.save(path, format='PNG', compress_level=1)
+                self._path = path
+                weakref.finalize(self, remove_file, path)
+            released = image_nbytes(self._image)
+            self._image = None
+            return released
+
+class SessionMemoryAccountant:
+    def __init__(self, budget_bytes=SESSION_MEMORY_BUDGET, idle_seconds=SESSION_IDLE_SECONDS):
+        self.budget_bytes = budget_bytes
+        self.idle_seconds = idle_seconds
+        self.released_bytes = 0
+        self.release_count = 0
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _session(self, session_id):
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = self._sessions[session_id] = {'last_access': time.monotonic(), 'objects': weakref.WeakValueDictionary()}
+        return session
+
+    # セッションの操作（スクリプトの再実行）を記録する
+    def touch(self, session_id):
+        with self._lock:
+            self._session(session_id)['last_access'] = time.monotonic()
+
+    # 管理対象を登録する（同じ名前の登録は置き換える）
+    def track(self, session_id, name, obj):
+        with self._lock:
+            self._session(session_id)['objects'][name] = obj
+
+    # セッションごとの使用量 {session_id: {'bytes', 'idle_seconds', 'objects': {名前: バイト数}}}
+    def usage(self):
+        now = time.monotonic()
+        with self._lock:
+            sessions = [(session_id, session['last_access'], list(session['objects'].items())) for session_id, session in self._sessions.items()]
+        report = {}
+        for session_id, last_access, objects in sessions:
+            object_bytes = {name: obj.memory_bytes() for name, obj in objects}
+            report[session_id] = {
+                'bytes': sum(object_bytes.values()),
+                'idle_seconds': now - last_access,
+                'objects': object_bytes,
+            }
+        return report
+
+    def total_bytes(self):
+        return sum(session['bytes'] for session in self.usage().values())
+
+    # 放置されたセッションと、上限を超えた分を解放する
+    # active_session_id（実行中のセッション）の管理対象は解放しない
+    # 戻り値: 解放したバイト数
+    def enforce(self, active_session_id=None):
+        usage = self.usage()
+        with self._lock:
+            for session_id in [session_id for session_id, session in self._sessions.items() if not session['objects']]:
+                del self._sessions[session_id]
+            sessions = {session_id: list(session['objects'].items()) for session_id, session in self._sessions.items()}
+        total = sum(session['bytes'] for session in usage.values())
+        released = 0
+        # 最後の操作が古い順、同じセッション内では大きいものから
+        for session_id in sorted(usage, key=lambda session_id: -usage[session_id]['idle_seconds']):
+            if session_id == active_session_id or session_id not in sessions:
+                continue
+            is_idle = usage[session_id]['idle_seconds'] >= self.idle_seconds
+            if not is_idle and total - released <= self.budget_bytes:
+                break
+            object_bytes = usage[session_id]['objects']
+            for name, obj in sorted(sessions[session_id], key=lambda item: -object_bytes.get(item[0], 0)):
+                if not is_idle and total - released <= self.budget_bytes:
+                    break
+                released += obj.release_memory()
+        with self._lock:
+            self.released_bytes += released
+            if released:
+                self.release_count += 1
+        return released
+
+_accountant = None
+_accountant_lock = threading.Lock()
+
+# プロセス内で共有する管理オブジェクト
+def get_session_memory():
+    global _accountant
+    with _accountant_lock:
+        if _accountant is None:
+            _accountant = SessionMemoryAccountant()
+        return _accountant
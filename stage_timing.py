@@ -0,0 +1,146 @@
+import contextlib
+import functools
+import threading
+import time
+
+# 処理段階ごとの所要時間・回数の計測
+# collect_stage_timings() で有効にしたスレッドでだけ記録する（既定は無効。無効時は記録先の有無を確認するだけ）
+# 段階が入れ子になった場合は内側の時間を外側から差し引くため、各段階の合計が計測全体の時間に近くなる
+
+# 表示用の段階名
+STAGE_LABELS = {
+    'plan': "作業単位の作成",
+    'render_jobs': "APNG生成（並列時はワーカー待ち）",
+    'font_load': "フォント読み込み",
+    'glyph_render': "文字描画",
+    'image_resample': "画像リサンプリング",
+    'static_layers': "静的レイヤー合成",
+    'frame_build': "フレーム合成",
+    'downscale': "出力サイズへの縮小",
+    'quantize': "パレット化",
+    'delta': "差分フレーム作成",
+    'png_encode': "PNGエンコード",
+    'apng_assemble': "APNG組み立て",
+    'truecolor_reference': "フルカラー比較用の生成",
+    'cache_lookup': "生成キャッシュの検索",
+    'cache_store': "生成キャッシュへの保存",
+    'output_write': "ZIP・フォルダへの書き込み",
+    'zip_finalize': "ZIP完成処理",
+}
+
+_state = threading.local()
+_null_timer = contextlib.nullcontext()
+
+class StageTimings:
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+        self.counters = {}
+        self.started_at = time.perf_counter()
+        self.elapsed = None
+        # 実行中の段階の [段階名, 計測再開時刻]
+        self._stack = []
+
+    def enter(self, stage):
+        now = time.perf_counter()
+        if self._stack:
+            parent = self._stack[-1]
+            self.seconds[parent[0]] = self.seconds.get(parent[0], 0.0) + now - parent[1]
+        self._stack.append([stage, now])
+        self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    def exit(self):
+        now = time.perf_counter()
+        stage, resumed_at = self._stack.pop()
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + now - resumed_at
+        if self._stack:
+            self._stack[-1][1] = now
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.started_at
+
+    # JSONに書き出せる形式（時間はミリ秒、段階は時間の長い順）
+    def to_dict(self):
+        elapsed = self.elapsed if self.elapsed is not None else time.perf_counter() - self.started_at
+        stages = {
+            stage: {'ms': seconds * 1000, 'calls': self.calls.get(stage, 0)}
+            for stage, seconds in sorted(self.seconds.items(), key=lambda item: -item[1])
+        }
+        return {
+            'total_ms': elapsed * 1000,
+            'untracked_ms': max(0.0, elapsed - sum(self.seconds.values())) * 1000,
+            'stages': stages,
+            'counters': dict(self.counters),
+        }
+
+class _StageTimer:
+    __slots__ = ('timings', 'stage')
+
+    def __init__(self, timings, stage):
+        self.timings = timings
+        self.stage = stage
+
+    def __enter__(self):
+        self.timings.enter(self.stage)
+
+    def __exit__(self, *exc_info):
+        self.timings.exit()
+
+# with stage_timer('png_encode'): ... の範囲を計測する
+def stage_timer(stage):
+    timings = getattr(_state, 'timings', None)
+    if timings is None:
+        return _null_timer
+    return _StageTimer(timings, stage)
+
+# 関数呼び出し全体を計測するデコレーター
+def timed_stage(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            timings = getattr(_state, 'timings', None)
+            if timings is None:
+                return func(*args, **kwargs)
+            timings.enter(stage)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings.exit()
+        return wrapper
+    return decorator
+
+# 回数・量のカウンター（フレーム数・バイト数など）
+def count_stage(name, amount=1):
+    timings = getattr(_state, 'timings', None)
+    if timings is not None:
+        timings.count(name, amount)
+
+# with の範囲で現在のスレッドの記録先を timings にする（None で一時的に無効化）
+@contextlib.contextmanager
+def collect_stage_timings(timings):
+    previous = getattr(_state, 'timings', None)
+    _state.timings = timings
+    try:
+        yield timings
+    finally:
+        _state.timings = previous
+        if timings is not None:
+            timings.finish()
+
+# to_dict() の結果を合算する（作業単位ごとの計測をバッチ全体の内訳にまとめる）
+def merge_stage_timings(timings_list):
+    merged = {'total_ms': 0.0, 'untracked_ms': 0.0, 'stages': {}, 'counters': {}}
+    for timings in timings_list:
+        merged['total_ms'] += timings['total_ms']
+        merged['untracked_ms'] += timings['untracked_ms']
+        for stage, stage_stats in timings['stages'].items():
+            total = merged['stages'].setdefault(stage, {'ms': 0.0, 'calls': 0})
+            total['ms'] += stage_stats['ms']
+            total['calls'] += stage_stats['calls']
+        for name, amount in timings['counters'].items():
+            merged['counters'][name] = merged['counters'].get(name, 0) + amount
+    merged['stages'] = dict(sorted(merged['stages'].items(), key=lambda item: -item[1]['ms']))
+    return merged
@@ -0,0 +1,116 @@
+# 設定パネルを操作したときに、設定タブとプレビュー列のフラグメントだけが再実行されることを確認する
+# フラグメントだけの再実行では、それ以外の部分（CSS・出力タブなど）の要素は結果に含まれない
+import io
+
+from PIL import Image
+from streamlit.testing.v1 import AppTest
+
+from engine import DEFAULT_TEXT_VARIATION
+
+APP_PATH = __file__.replace("test_app_fragments.py", "app.py")
+APP_TIMEOUT = 300
+# 設定の操作からプレビューの描き直しまでの目標時間（テキスト20件以上）
+INTERACTION_TARGET_SECONDS = 0.1
+
+def start_app(text_count=1):
+    at = AppTest.from_file(APP_PATH, default_timeout=APP_TIMEOUT)
+    if text_count > 1:
+        at.session_state.text_variations = [dict(DEFAULT_TEXT_VARIATION, text=f"Text {i + 1}") for i in range(text_count)]
+    at.run()
+    assert not at.exception, at.exception
+    assert ran_full_app(at)
+    return at
+
+def run(at):
+    at.run()
+    assert not at.exception, at.exception
+    return at
+
+# CSS と出力タブが描かれていればアプリ全体が再実行されている
+def ran_full_app(at):
+    has_css = any(md.value.startswith('<style>') for md in at.markdown)
+    has_output_tab = any(widget.key == "output_sizes" for widget in at.text_input)
+    assert has_css == has_output_tab
+    return has_output_tab
+
+# プレビュー列に描かれたカードのHTML
+def preview_html(at):
+    return [md.value for md in at.markdown if md.value.startswith('<div class="scroll-container">')]
+
+def test_template_parameter_reruns_settings_only():
+    at = start_app()
+    before = preview_html(at)
+    at.slider(key="border_width_red").set_value(30)
+    run(at)
+    assert not ran_full_app(at)
+    assert preview_html(at) and preview_html(at) != before
+
+def test_template_selection_reruns_app():
+    # テンプレートの選択は出力タブの生成ボタンにも影響するのでアプリ全体を再実行する
+    at = start_app()
+    at.checkbox(key="chk_corner").check()
+    run(at)
+    assert ran_full_app(at)
+    assert len(preview_html(at)) == 2
+
+def test_text_settings_rerun_settings_only():
+    at = start_app()
+    before = preview_html(at)
+    at.text_area(key="textarea_0").set_value("Sample")
+    run(at)
+    assert not ran_full_app(at)
+    after = preview_html(at)
+    assert after and after != before
+    at.slider(key="size_0").set_value(150)
+    run(at)
+    assert not ran_full_app(at)
+    assert preview_html(at) != after
+
+def test_add_text_reruns_settings_only():
+    at = start_app()
+    at.button(key="tab_btn_add").click()
+    run(at)
+    assert not ran_full_app(at)
+    assert len(at.session_state.text_variations) == 2
+    assert preview_html(at)[0].count('scroll-item-caption') == 2
+
+def test_image_settings_rerun_settings_only():
+    at = start_app()
+    buffered = io.BytesIO()
+    Image.radial_gradient('L').convert('RGB').save(buffered, format='PNG')
+    at.file_uploader(key="img_0").upload("photo.png", buffered.getvalue(), "image/png")
+    run(at)
+    assert not ran_full_app(at)
+    uploaded = preview_html(at)
+    at.slider(key="img_scale_0").set_value(50)
+    run(at)
+    assert not ran_full_app(at)
+    assert preview_html(at) and preview_html(at) != uploaded
+
+def test_annotation_settings_rerun_settings_only():
+    at = start_app()
+    before = preview_html(at)
+    at.toggle(key="annot_en_0").set_value(True)
+    run(at)
+    at.text_input(key="annot_0").set_value("* Note")
+    run(at)
+    assert not ran_full_app(at)
+    assert preview_html(at) and preview_html(at) != before
+
+def test_neumo_annotation_reruns_app():
+    # ニューモV専用注釈の有無は出力タブの案内に影響するのでアプリ全体を再実行する
+    at = start_app()
+    next(button for button in at.button if button.label == "＋ ニューモV専用追加").click()
+    run(at)
+    assert ran_full_app(at)
+    assert any(annot['is_neumo'] for annot in at.session_state.annotation_variations)
+
+def test_text_size_latency_with_many_texts():
+    at = start_app(text_count=20)
+    assert preview_html(at)[0].count('scroll-item-caption') == 20
+    at.slider(key="size_0").set_value(150)
+    run(at)
+    assert not ran_full_app(at)
+    # AppTest は実行のたびにスクリプトをコンパイルし直すので、アプリが記録した設定のフラグメントの所要時間で比べる
+    elapsed = at.session_state.settings_rerun_seconds
+    assert elapsed < INTERACTION_TARGET_SECONDS, f"{elapsed * 1000:.0f} ms"
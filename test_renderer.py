@@ -0,0 +1,54 @@
+# アップロード画像の配置が、元画像から直接リサイズした結果（ベースライン）と一致することを確認する
+import io
+
+from PIL import Image, ImageChops, ImageStat
+
+from renderer import HEIGHT, WIDTH, get_asset_cache, load_upload_image, render_background_layer
+
+PHOTO_SIZE = (1920, 1080)
+
+# キャンバスの MAX_IMAGE_SCALE 倍より大きい写真（作業用画像より大きく配置される）
+def create_photo(size=PHOTO_SIZE):
+    red = Image.linear_gradient('L').resize(size)
+    green = Image.effect_mandelbrot(size, (-2.0, -1.2, 1.0, 1.2), 64)
+    blue = Image.radial_gradient('L').resize(size)
+    return Image.merge('RGB', (red, green, blue))
+
+def upload(photo):
+    buffered = io.BytesIO()
+    photo.save(buffered, format='PNG')
+    buffered.seek(0)
+    return load_upload_image(buffered)
+
+def image_config(photo, scale):
+    return {'original_width': photo.width, 'original_height': photo.height, 'scale': scale,
+            'x': WIDTH // 2, 'y': HEIGHT // 2, 'digest': f"test-{scale}"}
+
+# 元画像を配置サイズへ直接リサイズして貼り付ける
+def baseline_background(photo, scale):
+    img = Image.new('RGB', (WIDTH, HEIGHT), 'white')
+    size = (int(photo.width * scale), int(photo.height * scale))
+    img.paste(photo.resize(size, Image.Resampling.LANCZOS), (WIDTH // 2 - size[0] // 2, HEIGHT // 2 - size[1] // 2))
+    return img
+
+def mean_difference(a, b):
+    return sum(ImageStat.Stat(ImageChops.difference(a, b)).mean) / 3
+
+def render(photo, scale):
+    get_asset_cache().clear()
+    image, (original_width, original_height) = upload(photo)
+    assert (original_width, original_height) == photo.size
+    return render_background_layer(WIDTH, HEIGHT, image, image_config(photo, scale))
+
+def test_scale_1_matches_baseline():
+    photo = create_photo()
+    assert render(photo, 1.0).tobytes() == baseline_background(photo, 1.0).tobytes()
+
+def test_scale_2_matches_baseline():
+    photo = create_photo()
+    assert render(photo, 2.0).tobytes() == baseline_background(photo, 2.0).tobytes()
+
+def test_reduced_scale_is_close_to_baseline():
+    # 作業用画像から縮小する場合も、見た目はベースラインとほぼ同じ
+    photo = create_photo()
+    assert mean_difference(render(photo, 0.3), baseline_background(photo, 0.3)) < 1.0